@@ -0,0 +1,225 @@
+"""Partitioned Parquet archive of raw source pulls, and an offline rebuild.
+
+Every month fetched from an upstream source is kept as it arrived, before
+any parsing into lake_data / met_data rows:
+
+    {ARCHIVE_DIR}/source=kingcounty_profile/year=2024/month=07/part.parquet
+
+  kingcounty_profile, kingcounty_met   DataScrape table cells, one string
+                                       column per header
+  openmeteo_weather, openmeteo_aqi     the "hourly" block of the response
+
+A refetch of a month replaces its file, so the archive always holds the
+latest pull. Because rows are stored raw, the tables can be re-derived
+after a parser or schema change without hitting King County or Open-Meteo:
+
+    python scripts/archive.py list
+    python scripts/archive.py rebuild [--source kingcounty_profile] [--start 2023-01]
+
+Writes need pandas and pyarrow; without them (or with ARCHIVE_DIR set to an
+empty string) archiving is skipped with a warning and ingest carries on.
+"""
+
+import os
+import sys
+import argparse
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", ".cache/archive")
+
+SOURCES = ("kingcounty_profile", "kingcounty_met", "openmeteo_weather", "openmeteo_aqi")
+
+# Rows per copy_upsert during rebuild
+REBUILD_BATCH_ROWS = 200000
+
+_disabled = not ARCHIVE_DIR
+
+
+def partition_path(source, year, month):
+    return os.path.join(ARCHIVE_DIR, f"source={source}", f"year={int(year)}",
+                        f"month={int(month):02d}", "part.parquet")
+
+
+def _write(source, year, month, frame):
+    path = partition_path(source, year, month)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    frame.to_parquet(tmp, engine="pyarrow", index=False)
+    os.replace(tmp, path)
+
+
+def _pandas():
+    """pandas, or None (after one warning) if archiving is off or unavailable."""
+    global _disabled
+    if _disabled:
+        return None
+    try:
+        import pandas as pd
+        import pyarrow  # noqa: F401  (to_parquet engine)
+        return pd
+    except ImportError as e:
+        print(f"Raw archive disabled: {e}")
+        _disabled = True
+        return None
+
+
+def archive_table(source, year, month, headers, rows):
+    """Archive a DataScrape month table (header list + string cell rows)."""
+    pd = _pandas()
+    if pd is None or not headers:
+        return
+    # Column names must be unique; DataScrape headers are, but don't rely on it
+    columns = [h if headers.index(h) == i else f"{h}_{i}" for i, h in enumerate(headers)]
+    frame = pd.DataFrame(rows, columns=columns, dtype="string")
+    _write(source, year, month, frame)
+
+
+def archive_hourly(source, period, hourly):
+    """Archive an Open-Meteo "hourly" block for the YYYY-MM period."""
+    pd = _pandas()
+    if pd is None or not hourly or not hourly.get("time"):
+        return
+    year, month = period.split("-")
+    frame = pd.DataFrame({key: pd.array(values, dtype="string" if key == "time" else "Float64")
+                          for key, values in hourly.items()})
+    _write(source, year, month, frame)
+
+
+def partitions(source, start=None, end=None):
+    """Yield (period, path) for the archived months of source, oldest first."""
+    root = os.path.join(ARCHIVE_DIR, f"source={source}")
+    if not os.path.isdir(root):
+        return
+    found = []
+    for year_dir in os.listdir(root):
+        for month_dir in os.listdir(os.path.join(root, year_dir)):
+            path = os.path.join(root, year_dir, month_dir, "part.parquet")
+            if os.path.exists(path):
+                period = f"{year_dir.split('=')[1]}-{month_dir.split('=')[1]}"
+                if (start is None or period >= start) and (end is None or period <= end):
+                    found.append((period, path))
+    yield from sorted(found)
+
+
+def read_table(path):
+    """Archived DataScrape month -> (headers, rows) as parse_table returned them."""
+    import pandas as pd
+
+    frame = pd.read_parquet(path)
+    return list(frame.columns), frame.astype(object).where(frame.notna(), "").values.tolist()
+
+
+def read_hourly(path):
+    """Archived Open-Meteo month -> "hourly" dict of lists (nulls as None)."""
+    import pandas as pd
+
+    frame = pd.read_parquet(path)
+    return {key: frame[key].astype(object).where(frame[key].notna(), None).tolist()
+            for key in frame.columns}
+
+
+def _flush(conn, cursor, upsert, batch, label):
+    if batch:
+        upsert(cursor, batch)
+        conn.commit()
+        print(f"  {label}: {len(batch)} rows")
+    return []
+
+
+def rebuild_kingcounty(conn, data_type, start=None, end=None):
+    """Re-parse archived DataScrape months and upsert them. Returns row count."""
+    from buoy_records import iter_profile_records, iter_met_records
+    from import_data import upsert_profile, upsert_met
+
+    parse, upsert = {
+        "profile": (iter_profile_records, upsert_profile),
+        "met": (iter_met_records, upsert_met),
+    }[data_type]
+    cursor = conn.cursor()
+    total, batch, first = 0, [], None
+    for period, path in partitions(f"kingcounty_{data_type}", start, end):
+        first = first or period
+        batch.extend(parse(*read_table(path)))
+        if len(batch) >= REBUILD_BATCH_ROWS:
+            total += len(batch)
+            batch = _flush(conn, cursor, upsert, batch, f"{data_type} {first}..{period}")
+            first = None
+    if batch:
+        total += len(batch)
+        _flush(conn, cursor, upsert, batch, f"{data_type} {first}..{period}")
+    cursor.close()
+    return total
+
+
+def rebuild_openmeteo(conn, start=None, end=None):
+    """Re-merge archived weather + AQI months and upsert them. Returns row count."""
+    from backfill_openmeteo import merge_rows, upsert_weather as upsert
+
+    aqi_paths = dict(partitions("openmeteo_aqi", start, end))
+    cursor = conn.cursor()
+    total, batch, first = 0, [], None
+    for period, path in partitions("openmeteo_weather", start, end):
+        first = first or period
+        aqi = read_hourly(aqi_paths[period]) if period in aqi_paths else None
+        batch.extend(merge_rows(read_hourly(path), aqi))
+        if len(batch) >= REBUILD_BATCH_ROWS:
+            total += len(batch)
+            batch = _flush(conn, cursor, upsert, batch, f"openmeteo {first}..{period}")
+            first = None
+    if batch:
+        total += len(batch)
+        _flush(conn, cursor, upsert, batch, f"openmeteo {first}..{period}")
+    cursor.close()
+    return total
+
+
+def cmd_list(args):
+    import pyarrow.parquet as pq
+
+    for source in SOURCES:
+        parts = list(partitions(source, args.start, args.end))
+        if not parts:
+            continue
+        rows = sum(pq.ParquetFile(path).metadata.num_rows for _, path in parts)
+        size = sum(os.path.getsize(path) for _, path in parts)
+        print(f"{source:<20}{len(parts):>5} months  {parts[0][0]}..{parts[-1][0]}"
+              f"{rows:>12,} rows{size / 1e6:>9.1f} MB")
+
+
+def cmd_rebuild(args):
+    from db_utils import connect_with_retry
+
+    sources = args.source or ["kingcounty", "openmeteo"]
+    conn = connect_with_retry()
+    print("Connected to database")
+
+    # Buoy rows first: the Open-Meteo upsert only fills what the buoy left empty
+    if "kingcounty" in sources or "kingcounty_profile" in sources:
+        print(f"lake_data: {rebuild_kingcounty(conn, 'profile', args.start, args.end)} rows")
+    if "kingcounty" in sources or "kingcounty_met" in sources:
+        print(f"met_data (buoy): {rebuild_kingcounty(conn, 'met', args.start, args.end)} rows")
+    if "openmeteo" in sources:
+        print(f"met_data (Open-Meteo): {rebuild_openmeteo(conn, args.start, args.end)} rows")
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("list", help="summarize archived months per source")
+    p.set_defaults(func=cmd_list)
+
+    p = sub.add_parser("rebuild", help="upsert lake_data / met_data from the archive")
+    p.add_argument("--source", action="append",
+                   choices=["kingcounty", "kingcounty_profile", "kingcounty_met", "openmeteo"],
+                   help="limit to these sources (repeatable; default: all)")
+    p.set_defaults(func=cmd_rebuild)
+
+    for p in sub.choices.values():
+        p.add_argument("--start", metavar="YYYY-MM", help="first month (inclusive)")
+        p.add_argument("--end", metavar="YYYY-MM", help="last month (inclusive)")
+
+    args = parser.parse_args()
+    if not os.path.isdir(ARCHIVE_DIR):
+        sys.exit(f"No archive at {ARCHIVE_DIR}")
+    args.func(args)
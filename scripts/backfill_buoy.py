@@ -1,217 +1,204 @@
 """Backfill historical King County buoy data (profile + met).
 
 Fetches data month by month for the specified year range from the
-King County DataScrape endpoint, then upserts into lake_data and met_data.
+King County DataScrape endpoint on a small worker pool (rate-limited
+globally), then upserts into lake_data and met_data from a single writer.
+
+Progress is checkpointed per (type, month) in backfill_progress, so a rerun
+picks up where a failed run stopped, and several processes can share a
+range (each claims its own months).
 """
 
 import os
-import time
-import requests
-import psycopg2
-import psycopg2.extras
-from bs4 import BeautifulSoup
+import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from dotenv import load_dotenv
+from datascrape import fetch_page, parse_table, is_imported, mark_imported, is_closed
+from db_utils import connect_with_retry
+from import_data import upsert_profile, upsert_met
+from buoy_records import iter_profile_records, iter_met_records
+from http_utils import TokenBucket, FetchClient
+from archive import archive_table
+from backfill_progress import register_units, iter_claims, finish_unit, fail_unit, progress_summary
 
 load_dotenv()
 DB_URL = os.getenv("SUPABASE_DB_URL")
 
-BASE_URL = "https://green2.kingcounty.gov/lake-buoy/DataScrape.aspx"
-
 # Years to backfill
 START_YEAR = 2021
 END_YEAR = 2026
 
+# Month pages fetched concurrently, and the global request cap shared by all
+# workers so we stay polite to the King County server
+MAX_WORKERS = 4
+REQUESTS_PER_SECOND = 2.0
 
-def safe_float(value):
-    if not value or not value.strip():
-        return None
-    try:
-        return float(value)
-    except ValueError:
-        return None
-
-
-def fetch_month(year, month, data_type="profile"):
-    """Fetch data for a single month. Returns (headers, rows)."""
-    params = {
-        "type": data_type,
-        "buoy": "sammamish",
-        "year": str(year),
-        "month": str(month),
-    }
-    resp = requests.get(BASE_URL, params=params, timeout=30)
-    resp.raise_for_status()
-
-    soup = BeautifulSoup(resp.text, "html.parser")
-    table = soup.find("table")
-    if not table:
-        return [], []
-
-    headers = [th.get_text(strip=True) for th in table.find_all("th")]
-    rows = []
-    for tr in table.find_all("tr")[1:]:
-        cells = [td.get_text(strip=True) for td in tr.find_all("td")]
-        if cells and len(cells) == len(headers):
-            rows.append(cells)
-    return headers, rows
-
-
-def parse_profile_rows(headers, rows):
-    """Parse profile rows into tuples for lake_data upsert."""
-    col_idx = {}
-    for i, h in enumerate(headers):
-        hl = h.strip().lower()
-        if "date" in hl:
-            col_idx["date"] = i
-        elif "depth" in hl:
-            col_idx["depth"] = i
-        elif "temperature" in hl:
-            col_idx["temp"] = i
-        elif "turbidity" in hl:
-            col_idx["turbidity"] = i
-        elif "chlorophyll" in hl:
-            col_idx["chlorophyll"] = i
-        elif "phycocyanin" in hl:
-            col_idx["phycocyanin"] = i
-
-    batch = []
-    for row in rows:
-        try:
-            dt = datetime.strptime(row[col_idx.get("date", 0)], "%m/%d/%Y %I:%M:%S %p")
-        except (ValueError, IndexError):
-            continue
-
-        temp_c = safe_float(row[col_idx.get("temp", 2)])
-        if temp_c is None:
-            continue
-
-        batch.append((
-            dt,
-            safe_float(row[col_idx.get("depth", 1)]),
-            temp_c,
-            safe_float(row[col_idx.get("turbidity", -1)]) if "turbidity" in col_idx else None,
-            safe_float(row[col_idx.get("chlorophyll", -1)]) if "chlorophyll" in col_idx else None,
-            safe_float(row[col_idx.get("phycocyanin", -1)]) if "phycocyanin" in col_idx else None,
-        ))
-    return batch
-
-
-def parse_met_rows(headers, rows):
-    """Parse met rows into tuples for met_data upsert."""
-    col_idx = {}
-    for i, h in enumerate(headers):
-        hl = h.strip().lower()
-        if "date" in hl:
-            col_idx["date"] = i
-        elif "humidity" in hl:
-            col_idx["humidity"] = i
-        elif "solar" in hl or "radiation" in hl:
-            col_idx["solar"] = i
-        elif "pressure" in hl or "barometric" in hl:
-            col_idx["pressure"] = i
-        elif "wind speed" in hl or "wind_speed" in hl:
-            col_idx["wind_speed"] = i
-        elif "wind dir" in hl or "wind_dir" in hl:
-            col_idx["wind_dir"] = i
-        elif "air temp" in hl or "air_temp" in hl:
-            col_idx["air_temp"] = i
-
-    batch = []
-    for row in rows:
-        try:
-            dt = datetime.strptime(row[col_idx.get("date", 0)], "%m/%d/%Y %I:%M:%S %p")
-        except (ValueError, IndexError):
-            continue
-
-        batch.append((
-            dt,
-            safe_float(row[col_idx.get("humidity", -1)]) if "humidity" in col_idx else None,
-            safe_float(row[col_idx.get("solar", -1)]) if "solar" in col_idx else None,
-            safe_float(row[col_idx.get("pressure", -1)]) if "pressure" in col_idx else None,
-            safe_float(row[col_idx.get("wind_speed", -1)]) if "wind_speed" in col_idx else None,
-            safe_float(row[col_idx.get("wind_dir", -1)]) if "wind_dir" in col_idx else None,
-            safe_float(row[col_idx.get("air_temp", -1)]) if "air_temp" in col_idx else None,
-        ))
-    return batch
+# backfill_progress.source for King County buoy units
+SOURCE = "kingcounty"
 
+UPSERTS = {"profile": upsert_profile, "met": upsert_met}
+PARSERS = {"profile": iter_profile_records, "met": iter_met_records}
 
-if __name__ == "__main__":
-    conn = psycopg2.connect(DB_URL)
-    cursor = conn.cursor()
-    print("Connected to database")
 
-    total_profile = 0
-    total_met = 0
-
-    for year in range(START_YEAR, END_YEAR + 1):
+def month_units(start_year, end_year):
+    """Yield (data_type, year, month) for every month to backfill, oldest first."""
+    now = datetime.now()
+    for year in range(start_year, end_year + 1):
         for month in range(1, 13):
             # Skip future months
-            if year == datetime.now().year and month > datetime.now().month:
-                break
-
-            # Profile data
-            print(f"Fetching profile {year}-{month:02d}...", end=" ", flush=True)
-            try:
-                headers, rows = fetch_month(year, month, "profile")
-                if rows:
-                    batch = parse_profile_rows(headers, rows)
-                    if batch:
-                        psycopg2.extras.execute_values(
-                            cursor,
-                            """
-                            INSERT INTO lake_data (date, depth_m, temperature_c, turbidity_ntu, chlorophyll_ugl, phycocyanin_ugl)
-                            VALUES %s
-                            ON CONFLICT (date, depth_m)
-                            DO UPDATE SET temperature_c = EXCLUDED.temperature_c,
-                                          turbidity_ntu = COALESCE(EXCLUDED.turbidity_ntu, lake_data.turbidity_ntu),
-                                          chlorophyll_ugl = COALESCE(EXCLUDED.chlorophyll_ugl, lake_data.chlorophyll_ugl),
-                                          phycocyanin_ugl = COALESCE(EXCLUDED.phycocyanin_ugl, lake_data.phycocyanin_ugl);
-                            """,
-                            batch,
-                            page_size=500
-                        )
-                        total_profile += len(batch)
-                    print(f"{len(batch)} rows")
-                else:
-                    print("no data")
-            except Exception as e:
-                print(f"ERROR: {e}")
-
-            # Met data
-            print(f"Fetching met {year}-{month:02d}...", end=" ", flush=True)
-            try:
-                headers, rows = fetch_month(year, month, "met")
-                if rows:
-                    batch = parse_met_rows(headers, rows)
+            if (year, month) > (now.year, now.month):
+                return
+            for data_type in ("profile", "met"):
+                yield data_type, year, month
+
+
+def period_of(year, month):
+    """backfill_progress.period for a month."""
+    return f"{year}-{month:02d}"
+
+
+def claimed_months(conn, units, force=False):
+    """Register units in backfill_progress and yield the ones this process claims.
+
+    Months that are not closed yet are always redone, since King County is
+    still adding rows to them.
+    """
+    keys = [(data_type, period_of(year, month)) for data_type, year, month in units]
+    reopen = [(data_type, period_of(year, month)) for data_type, year, month in units
+              if not is_closed(year, month)]
+    register_units(conn, SOURCE, keys, reopen=reopen, force=force)
+    for data_type, period in iter_claims(conn, SOURCE, keys):
+        year, month = (int(x) for x in period.split("-"))
+        yield data_type, year, month
+
+
+def fetch_and_parse(client, force, data_type, year, month):
+    """Worker: fetch one month page and parse it into upsert tuples.
+
+    Returns (batch, content_hash); batch is None when the page is identical
+    to the one last imported, so neither parse nor upsert is needed.
+    """
+    text, content_hash = fetch_page(year, month, data_type, client=client)
+    if not force and is_imported(year, month, data_type, content_hash):
+        return None, content_hash
+    headers, rows = parse_table(text)
+    archive_table(f"kingcounty_{data_type}", year, month, headers, rows)
+    if not rows:
+        return [], content_hash
+    return list(PARSERS[data_type](headers, rows)), content_hash
+
+
+def run_backfill(conn, units, workers=MAX_WORKERS, rate=REQUESTS_PER_SECOND, force=False):
+    """Fetch and parse months on a worker pool; upsert on the calling thread.
+
+    Fetching and HTML parsing happen in parallel, but all database writes are
+    funneled through this thread so a single connection is used throughout.
+    At most 2 * workers months are in flight so parsed batches cannot pile up
+    faster than they are written.
+
+    Each unit's backfill_progress row is finished in the same transaction as
+    its rows. units is consumed on this thread between unit transactions, so
+    it may claim from the database on conn (see claimed_months).
+
+    Returns {(data_type, year, month): (status, detail)} where status is
+    "ok" (detail = row count), "unchanged" (page matches the last import)
+    or "failed" (detail = error message).
+    """
+    cursor = conn.cursor()
+    # Retry-After from King County pauses every worker through the shared bucket
+    client = FetchClient(TokenBucket(rate), timeout=30)
+    pending = iter(units)
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = {}
+
+        def submit_next():
+            unit = next(pending, None)
+            if unit is not None:
+                in_flight[pool.submit(fetch_and_parse, client, force, *unit)] = unit
+
+        for _ in range(workers * 2):
+            submit_next()
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                unit = in_flight.pop(future)
+                data_type, year, month = unit
+                period = period_of(year, month)
+                label = f"{data_type} {period}"
+                try:
+                    batch, content_hash = future.result()
+                    if batch is None:
+                        finish_unit(cursor, SOURCE, data_type, period, None, content_hash)
+                        conn.commit()
+                        results[unit] = ("unchanged", 0)
+                        print(f"{label}: unchanged since last import")
+                        submit_next()
+                        continue
                     if batch:
-                        psycopg2.extras.execute_values(
-                            cursor,
-                            """
-                            INSERT INTO met_data (date, relative_humidity, solar_radiation_w, pressure_mb,
-                                                  wind_speed_ms, wind_direction_deg, air_temperature_c)
-                            VALUES %s
-                            ON CONFLICT (date)
-                            DO UPDATE SET relative_humidity = COALESCE(EXCLUDED.relative_humidity, met_data.relative_humidity),
-                                          solar_radiation_w = COALESCE(EXCLUDED.solar_radiation_w, met_data.solar_radiation_w),
-                                          pressure_mb = COALESCE(EXCLUDED.pressure_mb, met_data.pressure_mb),
-                                          wind_speed_ms = COALESCE(EXCLUDED.wind_speed_ms, met_data.wind_speed_ms),
-                                          wind_direction_deg = COALESCE(EXCLUDED.wind_direction_deg, met_data.wind_direction_deg),
-                                          air_temperature_c = COALESCE(EXCLUDED.air_temperature_c, met_data.air_temperature_c);
-                            """,
-                            batch,
-                            page_size=500
-                        )
-                        total_met += len(batch)
-                    print(f"{len(batch)} rows")
-                else:
-                    print("no data")
-            except Exception as e:
-                print(f"ERROR: {e}")
-
-            conn.commit()
-            time.sleep(0.5)  # Be polite to the King County server
+                        UPSERTS[data_type](cursor, batch)
+                    finish_unit(cursor, SOURCE, data_type, period, len(batch), content_hash)
+                    conn.commit()
+                    mark_imported(year, month, data_type, content_hash)
+                    results[unit] = ("ok", len(batch))
+                    print(f"{label}: {len(batch)} rows" if batch else f"{label}: no data")
+                except Exception as e:
+                    conn.rollback()
+                    results[unit] = ("failed", f"{type(e).__name__}: {e}")
+                    fail_unit(conn, SOURCE, data_type, period, results[unit][1])
+                    print(f"{label}: ERROR {e}")
+                submit_next()
 
     cursor.close()
+    return results
+
+
+def print_report(results):
+    """Summarize per-month outcomes. Returns the list of failed units."""
+    failed = sorted(u for u, (status, _) in results.items() if status == "failed")
+    unchanged = sum(1 for status, _ in results.values() if status == "unchanged")
+    totals = {"profile": 0, "met": 0}
+    for (data_type, _, _), (status, detail) in results.items():
+        if status == "ok":
+            totals[data_type] += detail
+
+    print(f"\nBackfill complete: {totals['profile']} profile rows, {totals['met']} met rows")
+    print(f"{len(results) - len(failed)}/{len(results)} months succeeded "
+          f"({unchanged} unchanged since last import)")
+    for unit in failed:
+        data_type, year, month = unit
+        print(f"  FAILED {data_type} {year}-{month:02d}: {results[unit][1]}")
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--start-year", type=int, default=START_YEAR)
+    parser.add_argument("--end-year", type=int, default=END_YEAR)
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS,
+                        help="concurrent month fetches (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=REQUESTS_PER_SECOND,
+                        help="global cap on King County requests per second (default: %(default)s)")
+    parser.add_argument("--force", action="store_true",
+                        help="redo months already marked done, even if their page matches the last import")
+    args = parser.parse_args()
+
+    conn = connect_with_retry(DB_URL)
+    print("Connected to database")
+
+    units = list(month_units(args.start_year, args.end_year))
+    results = run_backfill(conn, claimed_months(conn, units, args.force),
+                           workers=args.workers, rate=args.rate, force=args.force)
+    failed = print_report(results)
+
+    summary = progress_summary(conn, SOURCE, [(t, period_of(y, m)) for t, y, m in units])
+    print(f"Range progress: {summary.get('done', 0)}/{len(units)} months done"
+          + "".join(f", {summary[s]} {s}" for s in ("failed", "running", "pending") if summary.get(s)))
     conn.close()
-    print(f"\nBackfill complete: {total_profile} profile rows, {total_met} met rows")
+
+    if failed:
+        sys.exit(1)
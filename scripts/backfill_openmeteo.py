@@ -4,17 +4,38 @@ Fetches hourly historical weather (temperature, wind, solar, precipitation,
 cloud cover) and air quality (AQI, PM2.5, UV index) data, then upserts
 into met_data to fill gaps where King County buoy data is missing.
 
+For each window the weather and AQI requests run concurrently, and their
+hourly lists are converted as NumPy columns and joined on timestamp, so
+every met_data row is written by a single upsert.
+
 Open-Meteo archive has data back to 1959 for weather.
 Air quality/UV data starts around August 2022.
+
+Work is checkpointed per calendar month in backfill_progress, so a rerun
+skips months already done and retries the ones that failed. Consecutive
+claimed months are fetched together in one window whose size (in months)
+follows observed latency and payload size (http_utils.AdaptiveChunker).
+Requests share a token bucket; 429/5xx responses and timeouts are retried
+with jittered backoff, and Retry-After pauses all requests.
 """
 
 import os
+import sys
+import json
 import time
-import requests
-import psycopg2
-import psycopg2.extras
+import hashlib
+import calendar
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from db_utils import connect_with_retry, copy_upsert
+from datascrape import is_closed
+from http_utils import TokenBucket, FetchClient, AdaptiveChunker
+from archive import archive_hourly
+from daily_summary import days_of, refresh_met
+from backfill_progress import register_units, iter_claims, finish_unit, fail_unit, progress_summary
 
 load_dotenv()
 DB_URL = os.getenv("SUPABASE_DB_URL")
@@ -32,30 +53,63 @@ END_DATE = "2026-12-31"
 # AQI data starts around Aug 28, 2022
 AQI_START_DATE = "2022-08-28"
 
-# Chunk sizes (days) — smaller chunks to avoid timeouts
-WEATHER_CHUNK_DAYS = 90
-AQI_CHUNK_DAYS = 60
-
-MAX_RETRIES = 3
+# backfill_progress.source for Open-Meteo units (one "hourly" unit per month)
+SOURCE = "openmeteo"
+DATA_TYPE = "hourly"
+
+MAX_RETRIES = 5
+REQUEST_TIMEOUT = 60
+
+# Shared by the weather and AQI requests (Open-Meteo allows 600/min)
+REQUESTS_PER_SECOND = 2.0
+
+# Months per request window: starts small, doubles while responses come back
+# well under the latency/size targets, halves when one goes over (or fails)
+INITIAL_CHUNK_MONTHS = 2
+MAX_CHUNK_MONTHS = 12
+TARGET_SECONDS = 15.0
+TARGET_BYTES = 8 * 1024 * 1024
+
+WEATHER_COLUMNS = ("date", "relative_humidity", "solar_radiation_w", "pressure_mb",
+                   "wind_speed_ms", "wind_direction_deg", "air_temperature_c",
+                   "precipitation_mm", "us_aqi")
+
+# Use COALESCE to not overwrite existing King County buoy data; the WHERE
+# makes a rerun over rows that gain nothing a no-op
+WEATHER_ON_CONFLICT = """
+    DO UPDATE SET
+        relative_humidity = COALESCE(met_data.relative_humidity, EXCLUDED.relative_humidity),
+        solar_radiation_w = COALESCE(met_data.solar_radiation_w, EXCLUDED.solar_radiation_w),
+        pressure_mb = COALESCE(met_data.pressure_mb, EXCLUDED.pressure_mb),
+        wind_speed_ms = COALESCE(met_data.wind_speed_ms, EXCLUDED.wind_speed_ms),
+        wind_direction_deg = COALESCE(met_data.wind_direction_deg, EXCLUDED.wind_direction_deg),
+        air_temperature_c = COALESCE(met_data.air_temperature_c, EXCLUDED.air_temperature_c),
+        precipitation_mm = COALESCE(met_data.precipitation_mm, EXCLUDED.precipitation_mm),
+        us_aqi = COALESCE(met_data.us_aqi, EXCLUDED.us_aqi)
+    WHERE (met_data.relative_humidity, met_data.solar_radiation_w, met_data.pressure_mb,
+           met_data.wind_speed_ms, met_data.wind_direction_deg, met_data.air_temperature_c,
+           met_data.precipitation_mm, met_data.us_aqi)
+          IS DISTINCT FROM
+          (COALESCE(met_data.relative_humidity, EXCLUDED.relative_humidity),
+           COALESCE(met_data.solar_radiation_w, EXCLUDED.solar_radiation_w),
+           COALESCE(met_data.pressure_mb, EXCLUDED.pressure_mb),
+           COALESCE(met_data.wind_speed_ms, EXCLUDED.wind_speed_ms),
+           COALESCE(met_data.wind_direction_deg, EXCLUDED.wind_direction_deg),
+           COALESCE(met_data.air_temperature_c, EXCLUDED.air_temperature_c),
+           COALESCE(met_data.precipitation_mm, EXCLUDED.precipitation_mm),
+           COALESCE(met_data.us_aqi, EXCLUDED.us_aqi))
+"""
 
 
-def fetch_with_retry(url, params, retries=MAX_RETRIES):
-    """Fetch URL with retry logic for timeouts."""
-    for attempt in range(retries):
-        try:
-            resp = requests.get(url, params=params, timeout=120)
-            resp.raise_for_status()
-            return resp.json()
-        except (requests.Timeout, requests.ConnectionError) as e:
-            if attempt < retries - 1:
-                wait = (attempt + 1) * 5
-                print(f"timeout, retrying in {wait}s...", end=" ", flush=True)
-                time.sleep(wait)
-            else:
-                raise
+def fetch_json(client, url, params):
+    """GET url through client. Returns (json, seconds, payload bytes)."""
+    start = time.perf_counter()
+    resp = client.get(url, params=params)
+    resp.raise_for_status()
+    return resp.json(), time.perf_counter() - start, len(resp.content)
 
 
-def fetch_weather_chunk(start, end):
+def fetch_weather_chunk(client, start, end):
     """Fetch historical weather for a date range."""
     params = {
         "latitude": LAT,
@@ -74,10 +128,10 @@ def fetch_weather_chunk(start, end):
         ]),
         "timezone": "America/Los_Angeles",
     }
-    return fetch_with_retry(ARCHIVE_URL, params)
+    return fetch_json(client, ARCHIVE_URL, params)
 
 
-def fetch_aqi_chunk(start, end):
+def fetch_aqi_chunk(client, start, end):
     """Fetch historical air quality for a date range."""
     params = {
         "latitude": LAT,
@@ -87,147 +141,222 @@ def fetch_aqi_chunk(start, end):
         "hourly": "us_aqi,pm2_5,uv_index",
         "timezone": "America/Los_Angeles",
     }
-    return fetch_with_retry(AQI_URL, params)
+    return fetch_json(client, AQI_URL, params)
+
+
+def hourly_column(hourly, key, n):
+    """A float64 column straight from a JSON list; null -> NaN, missing key -> all NaN."""
+    values = hourly.get(key)
+    if values is None:
+        return np.full(n, np.nan)
+    return np.array(values, dtype=float)
+
+
+def merge_rows(weather, aqi=None):
+    """Join weather and AQI "hourly" blocks on timestamp into WEATHER_COLUMNS tuples.
+
+    Rows follow the weather timestamps; AQI hours without a weather hour are
+    dropped (the archive covers every hour of the window). NaN becomes None.
+    """
+    times = np.array(weather["time"], dtype="datetime64[m]")
+    n = len(times)
+    if n == 0:
+        return []
+
+    # wind_speed_10m default unit is km/h, convert to m/s
+    columns = [
+        hourly_column(weather, "relative_humidity_2m", n),
+        hourly_column(weather, "shortwave_radiation", n),
+        np.full(n, np.nan),  # pressure_mb (not fetched)
+        hourly_column(weather, "wind_speed_10m", n) / 3.6,
+        hourly_column(weather, "wind_direction_10m", n),
+        hourly_column(weather, "temperature_2m", n),
+        hourly_column(weather, "precipitation", n),
+    ]
+
+    us_aqi = np.full(n, np.nan)
+    if aqi and aqi.get("time"):
+        aqi_times = np.array(aqi["time"], dtype="datetime64[m]")
+        aqi_values = hourly_column(aqi, "us_aqi", len(aqi_times))
+        pos = np.clip(np.searchsorted(times, aqi_times), 0, n - 1)
+        match = times[pos] == aqi_times
+        us_aqi[pos[match]] = aqi_values[match]
+    columns.append(us_aqi)
+
+    dates = times.astype("datetime64[s]").astype(object)
+    values = []
+    for col in columns:
+        obj = col.astype(object)
+        obj[np.isnan(col)] = None
+        values.append(obj)
+    return list(zip(dates, *values))
+
+
+def upsert_weather(cursor, batch):
+    """Upsert merged rows in WEATHER_COLUMNS order; refreshes daily_met for their days."""
+    copy_upsert(cursor, "met_data", WEATHER_COLUMNS, batch, ("date",), WEATHER_ON_CONFLICT)
+    refresh_met(cursor, days_of(batch))
+
+
+def months_window(periods, first_date, end_limit):
+    """(start, end) date strings covering consecutive YYYY-MM periods, clipped
+    to the backfill range. None if the range doesn't reach into them.
+    """
+    first_year, first_month = (int(x) for x in periods[0].split("-"))
+    last_year, last_month = (int(x) for x in periods[-1].split("-"))
+    start = max(datetime(first_year, first_month, 1), datetime.strptime(first_date, "%Y-%m-%d"))
+    last_day = calendar.monthrange(last_year, last_month)[1]
+    end = min(datetime(last_year, last_month, last_day), end_limit)
+    if start > end:
+        return None
+    return start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+
+
+def next_period(period):
+    year, month = (int(x) for x in period.split("-"))
+    return f"{year + month // 12}-{month % 12 + 1:02d}"
+
+
+def month_units(end_limit):
+    """Yield (DATA_TYPE, period) for every month to backfill, oldest first."""
+    month = datetime.strptime(START_DATE, "%Y-%m-%d").replace(day=1)
+    while month <= end_limit:
+        yield DATA_TYPE, month.strftime("%Y-%m")
+        month = (month + timedelta(days=32)).replace(day=1)
+
+
+def consecutive_groups(claims, chunker):
+    """Group claimed (data_type, period) units into runs of consecutive months.
+
+    A run is at most chunker.size long, read when the run starts, so every
+    window uses the size learned from the responses before it.
+    """
+    group = []
+    for _, period in claims:
+        if group and (len(group) >= chunker.size or period != next_period(group[-1])):
+            yield group
+            group = []
+        group.append(period)
+    if group:
+        yield group
+
+
+def split_months(hourly, periods):
+    """Split an "hourly" block into {period: block} by the YYYY-MM of each time."""
+    if not hourly:
+        return {}
+    months = np.array([t[:7] for t in hourly["time"]])
+    blocks = {}
+    for period in periods:
+        idx = np.flatnonzero(months == period)
+        if len(idx):
+            blocks[period] = {key: [values[i] for i in idx] for key, values in hourly.items()}
+    return blocks
+
+
+def backfill_months(cursor, pool, client, chunker, periods, end_limit):
+    """Fetch weather + AQI for consecutive months in one window and upsert them together.
+
+    Returns {period: (row count, AQI hours, content hash)}.
+    """
+    weather_window = months_window(periods, START_DATE, end_limit)
+    aqi_window = months_window(periods, AQI_START_DATE, end_limit)
+    print(f"Fetching {periods[0]}..{periods[-1]} ({weather_window[0]} to {weather_window[1]})...",
+          end=" ", flush=True)
+
+    weather_future = pool.submit(fetch_weather_chunk, client, *weather_window)
+    aqi_future = pool.submit(fetch_aqi_chunk, client, *aqi_window) if aqi_window else None
+    try:
+        weather, seconds, nbytes = weather_future.result()
+        aqi = None
+        if aqi_future:
+            aqi, aqi_seconds, aqi_bytes = aqi_future.result()
+            seconds, nbytes = max(seconds, aqi_seconds), max(nbytes, aqi_bytes)
+            aqi = aqi["hourly"]
+        weather = weather["hourly"]
+    except Exception:
+        chunker.failure()
+        raise
+    chunker.record(len(periods), seconds, nbytes)
+
+    weather_months = split_months(weather, periods)
+    aqi_months = split_months(aqi, periods)
+    results = {}
+    batch = []
+    for period in periods:
+        month_weather = weather_months.get(period)
+        month_aqi = aqi_months.get(period)
+        archive_hourly("openmeteo_weather", period, month_weather)
+        archive_hourly("openmeteo_aqi", period, month_aqi)
+        rows = merge_rows(month_weather, month_aqi) if month_weather else []
+        content_hash = hashlib.sha256(json.dumps([month_weather, month_aqi], sort_keys=True).encode()).hexdigest()
+        results[period] = (len(rows), sum(1 for row in rows if row[-1] is not None), content_hash)
+        batch.extend(rows)
+
+    if batch:
+        upsert_weather(cursor, batch)
+    print(f"{len(batch)} rows in {seconds:.1f}s ({nbytes / 1e6:.1f} MB); "
+          f"next window {chunker.size} months")
+    return results
 
 
 if __name__ == "__main__":
-    conn = psycopg2.connect(DB_URL)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--force", action="store_true",
+                        help="redo months already marked done in backfill_progress")
+    parser.add_argument("--rate", type=float, default=REQUESTS_PER_SECOND,
+                        help="cap on Open-Meteo requests per second (default: %(default)s)")
+    parser.add_argument("--max-chunk-months", type=int, default=MAX_CHUNK_MONTHS,
+                        help="largest request window in months (default: %(default)s)")
+    args = parser.parse_args()
+
+    conn = connect_with_retry(DB_URL)
     cursor = conn.cursor()
     print("Connected to database")
 
-    # --- Backfill weather data into met_data ---
-    start = datetime.strptime(START_DATE, "%Y-%m-%d")
-    end_limit = datetime.strptime(END_DATE, "%Y-%m-%d")
     # Don't go past yesterday
+    end_limit = datetime.strptime(END_DATE, "%Y-%m-%d")
     yesterday = datetime.now() - timedelta(days=1)
     if end_limit > yesterday:
         end_limit = yesterday
-
-    total_weather = 0
-
-    while start < end_limit:
-        chunk_end = min(start + timedelta(days=WEATHER_CHUNK_DAYS - 1), end_limit)
-        start_str = start.strftime("%Y-%m-%d")
-        end_str = chunk_end.strftime("%Y-%m-%d")
-
-        print(f"Fetching weather {start_str} to {end_str}...", end=" ", flush=True)
-        try:
-            data = fetch_weather_chunk(start_str, end_str)
-            hourly = data["hourly"]
-
-            batch = []
-            for i, time_str in enumerate(hourly["time"]):
-                dt = datetime.strptime(time_str, "%Y-%m-%dT%H:%M")
-                temp_c = hourly["temperature_2m"][i]
-                wind_kmh = hourly["wind_speed_10m"][i]
-                solar_w = hourly["shortwave_radiation"][i]
-                humidity = hourly["relative_humidity_2m"][i]
-                precip_mm = hourly["precipitation"][i]
-
-                # wind_speed_10m default unit is km/h, convert to m/s
-                wind_ms_val = float(wind_kmh) / 3.6 if wind_kmh is not None else None
-
-                batch.append((
-                    dt,
-                    float(humidity) if humidity is not None else None,
-                    float(solar_w) if solar_w is not None else None,
-                    None,  # pressure_mb (not fetched)
-                    wind_ms_val,
-                    float(hourly["wind_direction_10m"][i]) if hourly["wind_direction_10m"][i] is not None else None,
-                    float(temp_c) if temp_c is not None else None,
-                    float(precip_mm) if precip_mm is not None else None,
-                    None,  # us_aqi (comes from AQI backfill)
-                ))
-
-            if batch:
-                # Use COALESCE to not overwrite existing King County buoy data
-                psycopg2.extras.execute_values(
-                    cursor,
-                    """
-                    INSERT INTO met_data (date, relative_humidity, solar_radiation_w, pressure_mb,
-                                          wind_speed_ms, wind_direction_deg, air_temperature_c,
-                                          precipitation_mm, us_aqi)
-                    VALUES %s
-                    ON CONFLICT (date)
-                    DO UPDATE SET
-                        relative_humidity = COALESCE(met_data.relative_humidity, EXCLUDED.relative_humidity),
-                        solar_radiation_w = COALESCE(met_data.solar_radiation_w, EXCLUDED.solar_radiation_w),
-                        pressure_mb = COALESCE(met_data.pressure_mb, EXCLUDED.pressure_mb),
-                        wind_speed_ms = COALESCE(met_data.wind_speed_ms, EXCLUDED.wind_speed_ms),
-                        wind_direction_deg = COALESCE(met_data.wind_direction_deg, EXCLUDED.wind_direction_deg),
-                        air_temperature_c = COALESCE(met_data.air_temperature_c, EXCLUDED.air_temperature_c),
-                        precipitation_mm = COALESCE(met_data.precipitation_mm, EXCLUDED.precipitation_mm),
-                        us_aqi = COALESCE(met_data.us_aqi, EXCLUDED.us_aqi);
-                    """,
-                    batch,
-                    page_size=1000
-                )
-                conn.commit()
-                total_weather += len(batch)
-                print(f"{len(batch)} rows")
-            else:
-                print("no data")
-        except Exception as e:
-            print(f"ERROR: {e}")
-
-        start = chunk_end + timedelta(days=1)
-        time.sleep(2)  # Rate limit
-
-    print(f"Weather backfill: {total_weather} total rows")
-
-    # --- Backfill AQI data into met_data ---
-    aqi_start = datetime.strptime(AQI_START_DATE, "%Y-%m-%d")
-    total_aqi = 0
-
-    while aqi_start < end_limit:
-        chunk_end = min(aqi_start + timedelta(days=AQI_CHUNK_DAYS - 1), end_limit)
-        start_str = aqi_start.strftime("%Y-%m-%d")
-        end_str = chunk_end.strftime("%Y-%m-%d")
-
-        print(f"Fetching AQI {start_str} to {end_str}...", end=" ", flush=True)
-        try:
-            data = fetch_aqi_chunk(start_str, end_str)
-            hourly = data["hourly"]
-
-            batch = []
-            for i, time_str in enumerate(hourly["time"]):
-                dt = datetime.strptime(time_str, "%Y-%m-%dT%H:%M")
-                aqi = hourly["us_aqi"][i]
-
-                if aqi is None:
-                    continue
-
-                batch.append((
-                    dt,
-                    float(aqi),
-                ))
-
-            if batch:
-                psycopg2.extras.execute_values(
-                    cursor,
-                    """
-                    INSERT INTO met_data (date, us_aqi)
-                    VALUES %s
-                    ON CONFLICT (date)
-                    DO UPDATE SET
-                        us_aqi = COALESCE(met_data.us_aqi, EXCLUDED.us_aqi);
-                    """,
-                    batch,
-                    page_size=1000
-                )
+    end_limit = end_limit.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    # The archive lags real time by a few days, so recent months are redone
+    units = list(month_units(end_limit))
+    reopen = [(t, p) for t, p in units if not is_closed(*(int(x) for x in p.split("-")))]
+    register_units(conn, SOURCE, units, reopen=reopen, force=args.force)
+
+    # burst=2 lets the paired weather + AQI requests of a window go out together
+    client = FetchClient(TokenBucket(args.rate, burst=2), retries=MAX_RETRIES, timeout=REQUEST_TIMEOUT)
+    chunker = AdaptiveChunker(INITIAL_CHUNK_MONTHS, maximum=args.max_chunk_months,
+                              target_seconds=TARGET_SECONDS, max_bytes=TARGET_BYTES)
+    total_rows = total_aqi = 0
+    failed = []
+    claims = iter_claims(conn, SOURCE, units, limit=args.max_chunk_months)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for periods in consecutive_groups(claims, chunker):
+            try:
+                results = backfill_months(cursor, pool, client, chunker, periods, end_limit)
+                for period, (count, aqi_hours, content_hash) in results.items():
+                    finish_unit(cursor, SOURCE, DATA_TYPE, period, count, content_hash)
+                    total_rows += count
+                    total_aqi += aqi_hours
                 conn.commit()
-                total_aqi += len(batch)
-                print(f"{len(batch)} rows")
-            else:
-                print("no data")
-        except Exception as e:
-            print(f"ERROR: {e}")
-
-        aqi_start = chunk_end + timedelta(days=1)
-        time.sleep(2)
-
-    print(f"AQI backfill: {total_aqi} total rows")
+            except Exception as e:
+                print(f"ERROR: {e}")
+                conn.rollback()
+                for period in periods:
+                    fail_unit(conn, SOURCE, DATA_TYPE, period, f"{type(e).__name__}: {e}")
+                failed.extend(periods)
+
+    print(f"Open-Meteo backfill: {total_rows} total rows ({total_aqi} with AQI)")
+    summary = progress_summary(conn, SOURCE, units)
+    print(f"Range progress: {summary.get('done', 0)}/{len(units)} months done"
+          + "".join(f", {summary[s]} {s}" for s in ("failed", "running", "pending") if summary.get(s)))
 
     cursor.close()
     conn.close()
+    if failed:
+        print("Failed months: " + ", ".join(failed))
+        sys.exit(1)
     print("\nBackfill complete!")
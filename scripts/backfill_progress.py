@@ -0,0 +1,169 @@
+"""Checkpointing for the historical backfills (backfill_progress table).
+
+A backfill is split into units of (source, data_type, period), e.g.
+("kingcounty", "profile", "2023-07"). Each unit has one row in
+backfill_progress, so a rerun only works on units that are not done yet:
+
+  pending  registered, never attempted
+  running  claimed by a worker (worker = host:pid, started_at set)
+  done     data committed; row_count and content_hash recorded
+  failed   last attempt raised; error holds the message
+
+Workers claim units in small batches with FOR UPDATE SKIP LOCKED, so any
+number of backfill processes can run against the same range without doing
+a unit twice. finish_unit() is written in the same transaction as the unit's
+data, so a unit is never marked done without its rows (or vice versa).
+A "running" claim older than the stale timeout is assumed to belong to a
+dead process and can be claimed again.
+"""
+
+import os
+import socket
+
+# A claim this old is taken over by other workers (the fetch + upsert of a
+# single month takes seconds, so this only triggers for dead processes)
+STALE_AFTER_MINUTES = 30
+
+# Units claimed per round trip
+CLAIM_BATCH = 8
+
+
+def worker_id():
+    """Identify this process in backfill_progress.worker."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def db_now(conn):
+    """Current database time, used as the run's start for claim decisions."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT now();")
+    now = cursor.fetchone()[0]
+    cursor.close()
+    conn.commit()
+    return now
+
+
+def register_units(conn, source, units, reopen=(), force=False):
+    """Ensure a row exists for every (data_type, period) unit in units.
+
+    Units listed in reopen (e.g. the month still being written upstream)
+    are set back to pending even if done; force does that for all of them.
+    """
+    units = list(units)
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO backfill_progress (source, data_type, period, status)
+        SELECT %s, u.data_type, u.period, 'pending'
+        FROM unnest(%s::text[], %s::text[]) AS u(data_type, period)
+        ON CONFLICT (source, data_type, period) DO NOTHING;
+    """, (source, [u[0] for u in units], [u[1] for u in units]))
+
+    reset = units if force else list(reopen)
+    if reset:
+        cursor.execute("""
+            UPDATE backfill_progress SET status = 'pending'
+            WHERE source = %s AND status = 'done'
+              AND (data_type, period) IN (
+                  SELECT * FROM unnest(%s::text[], %s::text[]));
+        """, (source, [u[0] for u in reset], [u[1] for u in reset]))
+    conn.commit()
+    cursor.close()
+
+
+def claim_units(conn, source, units, worker, run_started,
+                limit=CLAIM_BATCH, stale_after=STALE_AFTER_MINUTES):
+    """Claim up to limit unfinished units from units; returns [(data_type, period)].
+
+    Claimable: pending units, units that failed before this run started
+    (units failing during this run are left for the next one), and running
+    units whose claim is older than stale_after minutes.
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE backfill_progress p
+        SET status = 'running', worker = %(worker)s, started_at = now(),
+            finished_at = NULL, attempts = p.attempts + 1
+        FROM (
+            SELECT source, data_type, period
+            FROM backfill_progress
+            WHERE source = %(source)s
+              AND (data_type, period) IN (
+                  SELECT * FROM unnest(%(types)s::text[], %(periods)s::text[]))
+              AND (status = 'pending'
+                   OR (status = 'failed' AND finished_at < %(run_started)s)
+                   OR (status = 'running'
+                       AND started_at < now() - make_interval(mins => %(stale)s)))
+            ORDER BY period, data_type
+            LIMIT %(limit)s
+            FOR UPDATE SKIP LOCKED
+        ) claim
+        WHERE p.source = claim.source AND p.data_type = claim.data_type
+          AND p.period = claim.period
+        RETURNING p.data_type, p.period;
+    """, {"worker": worker, "source": source, "run_started": run_started,
+          "types": [u[0] for u in units], "periods": [u[1] for u in units],
+          "stale": stale_after, "limit": limit})
+    claimed = sorted(cursor.fetchall(), key=lambda u: (u[1], u[0]))
+    conn.commit()
+    cursor.close()
+    return claimed
+
+
+def iter_claims(conn, source, units, worker=None, limit=CLAIM_BATCH,
+                stale_after=STALE_AFTER_MINUTES):
+    """Yield (data_type, period) units, claiming them a batch at a time.
+
+    Stops when no claimable unit is left. Each claim commits on conn, so
+    only advance the iterator between (not inside) unit transactions.
+    """
+    units = list(units)
+    worker = worker or worker_id()
+    run_started = db_now(conn)
+    while True:
+        claimed = claim_units(conn, source, units, worker, run_started, limit, stale_after)
+        if not claimed:
+            return
+        yield from claimed
+
+
+def finish_unit(cursor, source, data_type, period, row_count=None, content_hash=None):
+    """Mark a unit done. Call before committing the unit's data.
+
+    A None row_count/content_hash keeps the previously recorded value (used
+    when a page is known to be unchanged and nothing was written).
+    """
+    cursor.execute("""
+        UPDATE backfill_progress
+        SET status = 'done', finished_at = now(), error = NULL,
+            row_count = COALESCE(%s, row_count),
+            content_hash = COALESCE(%s, content_hash)
+        WHERE source = %s AND data_type = %s AND period = %s;
+    """, (row_count, content_hash, source, data_type, period))
+
+
+def fail_unit(conn, source, data_type, period, error):
+    """Record a failed attempt (after the unit's transaction was rolled back)."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE backfill_progress
+        SET status = 'failed', finished_at = now(), error = %s
+        WHERE source = %s AND data_type = %s AND period = %s;
+    """, (str(error)[:1000], source, data_type, period))
+    conn.commit()
+    cursor.close()
+
+
+def progress_summary(conn, source, units):
+    """Return {status: count} over units."""
+    units = list(units)
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT status, COUNT(*) FROM backfill_progress
+        WHERE source = %s
+          AND (data_type, period) IN (SELECT * FROM unnest(%s::text[], %s::text[]))
+        GROUP BY status;
+    """, (source, [u[0] for u in units], [u[1] for u in units]))
+    summary = dict(cursor.fetchall())
+    conn.commit()
+    cursor.close()
+    return summary
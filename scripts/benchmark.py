@@ -0,0 +1,460 @@
+"""Benchmarks for the ingest hot paths.
+
+    python scripts/benchmark.py record --out bench_pages 2024-07 2024-08
+    python scripts/benchmark.py parse bench_pages/*.html
+    python scripts/benchmark.py timestamps --depths 20
+    python scripts/benchmark.py load --years 5
+    python scripts/benchmark.py explain --synthetic 5 --out explain.txt
+    python scripts/benchmark.py storage --days 30
+    python scripts/benchmark.py types --years 5
+
+`record` saves DataScrape month pages to disk so `parse` can be rerun
+offline against the same recorded input. `load` needs SUPABASE_DB_URL; it
+works on a temporary copy of lake_data and rolls everything back.
+`explain` runs EXPLAIN ANALYZE on the report queries (the QUERY_* constants
+of generate_html, export_comfort_json and generate_forecast), against the
+real tables or, with --synthetic, against temporary copies filled with
+that many years of generated readings (and daily summaries rebuilt from
+them). Copies take the real tables'
+current columns and indexes, so running it before and after a migration
+compares the two schemas.
+`storage` replays the last --days of forecast fetches (as
+weather_forecast_as_of returns them) into temporary copies of the forecast
+tables, once with "full" and once with "delta" storage, and compares their
+size and write/read times; every replayed fetch must reconstruct exactly.
+`types` fills temporary lake_data / met_data copies with --years of
+generated readings and times the heavy daily and day-of-year aggregations
+over them with the measurement columns as NUMERIC and as DOUBLE PRECISION.
+"""
+
+import argparse
+import gc
+import os
+import time
+import tracemalloc
+
+BEST_OF = 5
+
+
+def measure(fn, *args, repeat=BEST_OF):
+    """Return (best wall time in seconds, peak traced memory in bytes, result)."""
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def cmd_record(args):
+    from datascrape import fetch_page
+
+    os.makedirs(args.out, exist_ok=True)
+    for period in args.months:
+        year, month = (int(x) for x in period.split("-"))
+        for data_type in args.types:
+            text, _ = fetch_page(year, month, data_type, timeout=60)
+            path = os.path.join(args.out, f"{data_type}-{year}-{month:02d}.html")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+            print(f"Saved {path} ({len(text) / 1e6:.1f} MB)")
+
+
+def _parse_bs4(text):
+    """The BeautifulSoup parse that datascrape.parse_table replaced."""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(text, "html.parser")
+    table = soup.find("table")
+    if not table:
+        return [], []
+    headers = [th.get_text(strip=True) for th in table.find_all("th")]
+    rows = []
+    for tr in table.find_all("tr")[1:]:
+        cells = [td.get_text(strip=True) for td in tr.find_all("td")]
+        if cells and len(cells) == len(headers):
+            rows.append(cells)
+    return headers, rows
+
+
+def _count_streamed(text):
+    """Consume the stream without keeping rows, as a streaming loader would."""
+    from datascrape import iter_table
+    return sum(1 for _ in iter_table(text))
+
+
+def cmd_parse(args):
+    from datascrape import parse_table
+
+    print(f"{'page':<28}{'rows':>8}{'bs4 s':>9}{'fast s':>9}{'speedup':>9}"
+          f"{'bs4 MB':>9}{'fast MB':>9}{'stream MB':>11}")
+    for path in args.pages:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+
+        old_t, old_peak, old = measure(_parse_bs4, text, repeat=args.repeat)
+        new_t, new_peak, new = measure(parse_table, text, repeat=args.repeat)
+        _, stream_peak, _ = measure(_count_streamed, text, repeat=1)
+        if new != old:
+            raise SystemExit(f"{path}: parse_table output differs from BeautifulSoup")
+
+        print(f"{os.path.basename(path):<28}{len(new[1]):>8}{old_t:>9.3f}{new_t:>9.3f}"
+              f"{old_t / new_t:>8.1f}x{old_peak / 1e6:>9.1f}{new_peak / 1e6:>9.1f}"
+              f"{stream_peak / 1e6:>11.1f}")
+
+
+def kc_timestamps(days, depths):
+    """A year (by default) of 15-minute King County timestamps, one per depth."""
+    from datetime import datetime, timedelta
+
+    start = datetime(2024, 1, 1)
+    stamps = []
+    for step in range(days * 96):
+        ts = start + timedelta(minutes=15 * step)
+        text = f"{ts.month}/{ts.day}/{ts.year} {ts.strftime('%I:%M:%S %p').lstrip('0')}"
+        stamps.extend([text] * depths)
+    return stamps
+
+
+def cmd_timestamps(args):
+    from datetime import datetime
+    import buoy_records
+
+    stamps = kc_timestamps(args.days, args.depths)
+
+    def strptime_all():
+        return [datetime.strptime(s, buoy_records.KC_TIMESTAMP_FORMAT) for s in stamps]
+
+    def decode_all():
+        buoy_records._date_cache.clear()
+        buoy_records._time_cache.clear()
+        return [buoy_records.parse_timestamp(s) for s in stamps]
+
+    old_t, _, old = measure(strptime_all, repeat=args.repeat)
+    new_t, _, new = measure(decode_all, repeat=args.repeat)
+    if new != old:
+        raise SystemExit("parse_timestamp output differs from strptime")
+    print(f"{len(stamps)} timestamps ({args.days} days x 96 casts x {args.depths} depths)")
+    print(f"strptime        {old_t:8.3f}s  {len(stamps) / old_t:>12,.0f}/s")
+    print(f"parse_timestamp {new_t:8.3f}s  {len(stamps) / new_t:>12,.0f}/s  ({old_t / new_t:.1f}x)")
+
+
+def synthetic_profile_rows(years, depths):
+    """15-minute profile casts at `depths` depths for `years` years, like a backfill."""
+    from datetime import datetime, timedelta
+
+    start = datetime(2021, 1, 1)
+    rows = []
+    for step in range(int(years * 365 * 96)):
+        ts = start + timedelta(minutes=15 * step)
+        for d in range(depths):
+            rows.append((ts, 0.5 + d, round(8 + (step % 96) / 10 - d * 0.3, 3), 1.2, 2.5, 0.4))
+    return rows
+
+
+def cmd_load(args):
+    import psycopg2.extras
+    from db_utils import connect_with_retry
+    import import_data
+
+    rows = synthetic_profile_rows(args.years, args.depths)
+    values_sql = (f"INSERT INTO lake_data ({', '.join(import_data.LAKE_COLUMNS)}) VALUES %s "
+                  f"ON CONFLICT (date, depth_m) {import_data.PROFILE_ON_CONFLICT}")
+
+    def execute_values(cursor):
+        psycopg2.extras.execute_values(cursor, values_sql, rows, page_size=500)
+
+    def copy_upsert(cursor):
+        import_data.upsert_profile(cursor, rows)
+
+    conn = connect_with_retry()
+    cursor = conn.cursor()
+    # A temp table shadows lake_data for this session, so the real table is untouched
+    cursor.execute("CREATE TEMP TABLE lake_data (LIKE public.lake_data INCLUDING ALL);")
+
+    print(f"{len(rows)} rows ({args.years} years x {args.depths} depths)")
+    print(f"{'path':<16}{'insert s':>10}{'rows/s':>12}{'re-upsert s':>13}{'rows/s':>12}")
+    for name, load in (("execute_values", execute_values), ("copy_upsert", copy_upsert)):
+        cursor.execute("TRUNCATE lake_data;")
+        timings = []
+        for _ in range(2):  # first pass inserts, second pass hits every conflict
+            start = time.perf_counter()
+            load(cursor)
+            timings.append(time.perf_counter() - start)
+        print(f"{name:<16}{timings[0]:>10.2f}{len(rows) / timings[0]:>12,.0f}"
+              f"{timings[1]:>13.2f}{len(rows) / timings[1]:>12,.0f}")
+
+    conn.rollback()
+    conn.close()
+
+
+EXPLAIN_MODULES = ("generate_html", "export_comfort_json", "generate_forecast")
+
+# Temporary copies for explain --synthetic: 15-minute readings up to now
+SYNTHETIC_SQL = """
+    CREATE TEMP TABLE lake_data (LIKE public.lake_data INCLUDING ALL);
+    CREATE TEMP TABLE met_data (LIKE public.met_data INCLUDING ALL);
+    CREATE TEMP TABLE comfort_score (LIKE public.comfort_score INCLUDING ALL);
+    CREATE TEMP TABLE daily_surface (LIKE public.daily_surface INCLUDING ALL);
+    CREATE TEMP TABLE daily_met (LIKE public.daily_met INCLUDING ALL);
+    -- LIKE copies no triggers
+    CREATE TRIGGER set_local_day BEFORE INSERT ON lake_data
+    FOR EACH ROW EXECUTE FUNCTION set_local_day();
+    CREATE TRIGGER set_local_day BEFORE INSERT ON met_data
+    FOR EACH ROW EXECUTE FUNCTION set_local_day();
+
+    INSERT INTO lake_data (date, depth_m, temperature_c, turbidity_ntu,
+                           chlorophyll_ugl, phycocyanin_ugl)
+    SELECT ts, depth, 12 + 6 * sin(extract(doy FROM ts) / 58.1) - depth * 0.3, 1.2, 2.5, 0.4
+    FROM generate_series(date_trunc('hour', LOCALTIMESTAMP) - %(years)s * interval '1 year',
+                         LOCALTIMESTAMP, interval '15 minutes') ts,
+         unnest(ARRAY[0.5, 1.0] || ARRAY(SELECT generate_series(2, %(depths)s - 1)::numeric)) depth;
+
+    INSERT INTO met_data (date, relative_humidity, solar_radiation_w, pressure_mb,
+                          wind_speed_ms, wind_direction_deg, air_temperature_c,
+                          precipitation_mm, us_aqi)
+    SELECT ts, 70, 300, 1013, 3, 180, 12 + 8 * sin(extract(doy FROM ts) / 58.1), 0.1, 30
+    FROM generate_series(date_trunc('hour', LOCALTIMESTAMP) - %(years)s * interval '1 year',
+                         LOCALTIMESTAMP, interval '15 minutes') ts;
+
+    INSERT INTO comfort_score (score_time, computed_at, overall_score, label)
+    SELECT ts, ts, 50, 'Fair'
+    FROM generate_series(date_trunc('hour', LOCALTIMESTAMP) - %(years)s * interval '1 year',
+                         LOCALTIMESTAMP + interval '8 days', interval '1 hour') ts;
+
+    ANALYZE lake_data;
+    ANALYZE met_data;
+    ANALYZE comfort_score;
+"""
+
+
+def report_queries():
+    """(name, sql) for every QUERY_* constant in EXPLAIN_MODULES, in file order."""
+    import importlib
+
+    queries = []
+    for module_name in EXPLAIN_MODULES:
+        module = importlib.import_module(module_name)
+        for name, value in vars(module).items():
+            if name.startswith("QUERY_") and isinstance(value, str):
+                queries.append((f"{module_name}.{name}", value))
+    return queries
+
+
+def cmd_explain(args):
+    from db_utils import connect_with_retry
+    from daily_summary import SUMMARIES, rebuild
+
+    conn = connect_with_retry()
+    cursor = conn.cursor()
+    if args.synthetic:
+        start = time.perf_counter()
+        cursor.execute(SYNTHETIC_SQL, {"years": args.synthetic, "depths": args.depths})
+        for table in SUMMARIES:
+            rebuild(cursor, table)
+            cursor.execute(f"ANALYZE {table};")
+        print(f"Synthetic copies: {args.synthetic} years, {args.depths} depths "
+              f"({time.perf_counter() - start:.1f}s)")
+
+    out = open(args.out, "w", encoding="utf-8") if args.out else None
+    print(f"{'query':<48}{'ms':>10}  top node")
+    for name, sql in report_queries():
+        cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql)
+        plan = [row[0] for row in cursor.fetchall()]
+        ms = next(float(line.split()[2]) for line in plan if line.startswith("Execution Time"))
+        print(f"{name:<48}{ms:>10.1f}  {plan[0].split('  (')[0].strip()}")
+        if out:
+            out.write(f"-- {name}\n{sql.strip()}\n\n" + "\n".join(plan) + "\n\n")
+    if out:
+        out.close()
+        print(f"Plans written to {args.out}")
+
+    conn.rollback()
+    conn.close()
+
+
+def cmd_storage(args):
+    from db_utils import connect_with_retry
+    from fetch_forecast import store_fetch
+
+    conn = connect_with_retry()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT fetched_at FROM forecast_fetch
+        WHERE fetched_at >= LOCALTIMESTAMP - make_interval(days => %s)
+        ORDER BY fetched_at;
+    """, (args.days,))
+    fetches = []
+    for (fetched_at,) in cursor.fetchall():
+        cursor.execute("SELECT * FROM weather_forecast_as_of(%s);", (fetched_at,))
+        fetches.append(cursor.fetchall())
+    hours = sum(len(rows) for rows in fetches)
+    print(f"{len(fetches)} fetches, {hours} forecast hours (last {args.days} days)")
+    if not fetches:
+        return
+
+    # Temp tables shadow the forecast tables for this session
+    for table in ("weather_forecast", "weather_forecast_latest", "forecast_fetch"):
+        cursor.execute(f"CREATE TEMP TABLE {table} (LIKE public.{table} INCLUDING ALL);")
+
+    print(f"{'storage':<9}{'rows':>10}{'table MB':>10}{'total MB':>10}{'write s':>9}{'as_of ms':>10}")
+    sizes = {}
+    for storage in ("full", "delta"):
+        cursor.execute("TRUNCATE weather_forecast, weather_forecast_latest, forecast_fetch;")
+        start = time.perf_counter()
+        rows = sum(store_fetch(cursor, batch, storage) for batch in fetches)
+        write = time.perf_counter() - start
+        cursor.execute("SELECT pg_table_size('weather_forecast'), pg_total_relation_size('weather_forecast');")
+        table_size, total_size = cursor.fetchone()
+        sizes[storage] = total_size
+
+        start = time.perf_counter()
+        for batch in fetches:
+            cursor.execute("SELECT * FROM weather_forecast_as_of(%s);", (batch[0][1],))
+            if cursor.fetchall() != batch:
+                raise SystemExit(f"{storage}: fetch {batch[0][1]} does not reconstruct")
+        read = (time.perf_counter() - start) / len(fetches) * 1000
+        print(f"{storage:<9}{rows:>10}{table_size / 1e6:>10.2f}{total_size / 1e6:>10.2f}"
+              f"{write:>9.2f}{read:>10.1f}")
+    print(f"delta is {1 - sizes['delta'] / sizes['full']:.0%} smaller (table + indexes)")
+
+    conn.rollback()
+    conn.close()
+
+
+# Measurement columns converted from NUMERIC (see migrate_db.py)
+MEASUREMENT_COLUMNS = {
+    "lake_data": ("temperature_c", "turbidity_ntu", "chlorophyll_ugl", "phycocyanin_ugl"),
+    "met_data": ("relative_humidity", "solar_radiation_w", "pressure_mb", "wind_speed_ms",
+                 "wind_direction_deg", "air_temperature_c", "precipitation_mm", "us_aqi"),
+}
+
+# Day-of-year norms straight from the raw rows, as the reports computed
+# them before daily_surface / daily_met existed
+RAW_DOY_SQL = {
+    "surface_doy": """
+        SELECT day_of_year, AVG(max_c), AVG(avg_c) FROM (
+            SELECT day_of_year, MAX(temperature_c) AS max_c, AVG(temperature_c) AS avg_c
+            FROM lake_data
+            WHERE depth_m < 1.5 AND temperature_c IS NOT NULL
+            GROUP BY local_day, day_of_year
+        ) d GROUP BY day_of_year;
+    """,
+    "met_doy": """
+        SELECT day_of_year, AVG(max_air), AVG(wind), AVG(solar), AVG(precip), AVG(aqi) FROM (
+            SELECT day_of_year, MAX(air_temperature_c) AS max_air, AVG(wind_speed_ms) AS wind,
+                   MAX(solar_radiation_w) AS solar, SUM(precipitation_mm) AS precip,
+                   AVG(us_aqi) AS aqi
+            FROM met_data
+            WHERE air_temperature_c IS NOT NULL
+            GROUP BY local_day, day_of_year
+        ) d GROUP BY day_of_year;
+    """,
+}
+
+
+def cmd_types(args):
+    from db_utils import connect_with_retry
+    from daily_summary import SURFACE_SELECT, MET_SELECT
+
+    queries = {
+        "daily_surface": SURFACE_SELECT.format(source="lake_data l", where="TRUE"),
+        "daily_met": MET_SELECT.format(source="met_data m", where="TRUE"),
+        **RAW_DOY_SQL,
+    }
+
+    def run(cursor, sql):
+        cursor.execute(sql)
+        return cursor.fetchall()
+
+    conn = connect_with_retry()
+    cursor = conn.cursor()
+    cursor.execute(SYNTHETIC_SQL, {"years": args.years, "depths": args.depths})
+    cursor.execute("SELECT (SELECT COUNT(*) FROM lake_data), (SELECT COUNT(*) FROM met_data);")
+    print("Synthetic copies: {} lake_data rows, {} met_data rows".format(*cursor.fetchone()))
+
+    print(f"{'type':<18}{'table':<11}{'MB':>8}" + "".join(f"{name:>15}" for name in queries))
+    results = {}
+    for column_type in ("numeric", "double precision"):
+        for table, columns in MEASUREMENT_COLUMNS.items():
+            cursor.execute(f"ALTER TABLE {table} "
+                           + ", ".join(f"ALTER COLUMN {c} TYPE {column_type}" for c in columns))
+            cursor.execute(f"ANALYZE {table};")
+        timings = {}
+        for name, sql in queries.items():
+            timings[name], _, results[column_type, name] = measure(run, cursor, sql, repeat=args.repeat)
+        for table in MEASUREMENT_COLUMNS:
+            cursor.execute("SELECT pg_total_relation_size(%s);", (table,))
+            print(f"{column_type:<18}{table:<11}{cursor.fetchone()[0] / 1e6:>8.1f}"
+                  + ("".join(f"{timings[name] * 1000:>12.0f} ms" for name in queries)
+                     if table == "lake_data" else ""))
+
+    # Same groups either way; the values differ only by float rounding
+    for name in queries:
+        numeric = sorted(results["numeric", name])
+        double = sorted(results["double precision", name])
+        if [row[0] for row in numeric] != [row[0] for row in double]:
+            raise SystemExit(f"{name}: numeric and double precision return different groups")
+        diff = max((abs(float(a) - b) for n, d in zip(numeric, double)
+                    for a, b in zip(n[1:], d[1:]) if a is not None), default=0)
+        print(f"{name}: largest difference {diff:.2g}")
+
+    conn.rollback()
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("storage", help="compare full and delta forecast storage")
+    p.add_argument("--days", type=int, default=30, help="replay fetches from the last N days")
+    p.set_defaults(func=cmd_storage)
+
+    p = sub.add_parser("record", help="save DataScrape month pages for offline benchmarks")
+    p.add_argument("months", nargs="+", metavar="YYYY-MM")
+    p.add_argument("--out", default="bench_pages")
+    p.add_argument("--types", nargs="+", default=["profile", "met"])
+    p.set_defaults(func=cmd_record)
+
+    p = sub.add_parser("parse", help="compare parse_table against BeautifulSoup")
+    p.add_argument("pages", nargs="+")
+    p.add_argument("--repeat", type=int, default=BEST_OF)
+    p.set_defaults(func=cmd_parse)
+
+    p = sub.add_parser("timestamps", help="compare parse_timestamp against strptime")
+    p.add_argument("--days", type=int, default=365)
+    p.add_argument("--depths", type=int, default=1,
+                   help="rows per timestamp (profile pages repeat it per depth)")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=cmd_timestamps)
+
+    p = sub.add_parser("load", help="compare copy_upsert against execute_values")
+    p.add_argument("--years", type=float, default=5)
+    p.add_argument("--depths", type=int, default=4)
+    p.set_defaults(func=cmd_load)
+
+    p = sub.add_parser("explain", help="EXPLAIN ANALYZE the report queries")
+    p.add_argument("--synthetic", type=float, default=0, metavar="YEARS",
+                   help="run against temporary copies with this many years of data")
+    p.add_argument("--depths", type=int, default=20,
+                   help="profile depths per cast in the synthetic lake_data")
+    p.add_argument("--out", help="also write the full plans to this file")
+    p.set_defaults(func=cmd_explain)
+
+    p = sub.add_parser("types", help="time the DOY aggregations with NUMERIC vs DOUBLE PRECISION")
+    p.add_argument("--years", type=float, default=5)
+    p.add_argument("--depths", type=int, default=20,
+                   help="profile depths per cast in the synthetic lake_data")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=cmd_types)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,193 @@
+"""Parse King County buoy table rows into profile and met records.
+
+Both the TSV import (import_data.py) and the DataScrape backfill
+(backfill_buoy.py) get the same shape of input: a header list plus rows of
+string cells. The generators here map headers to columns once and yield
+records whose field order matches the lake_data / met_data upsert columns,
+so they can be handed straight to the loaders.
+
+Every row carries a "M/D/YYYY H:MM:SS AM" timestamp. datetime.strptime
+re-parses the format through a regex on every call, so parse_timestamp()
+decodes this fixed format directly and caches the date and time-of-day
+parts, which repeat for every depth of a cast and every cast of a day.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+
+KC_TIMESTAMP_FORMAT = "%m/%d/%Y %I:%M:%S %p"
+
+ProfileRecord = namedtuple("ProfileRecord", [
+    "date", "depth_m", "temperature_c", "turbidity_ntu", "chlorophyll_ugl", "phycocyanin_ugl",
+])
+
+MetRecord = namedtuple("MetRecord", [
+    "date", "relative_humidity", "solar_radiation_w", "pressure_mb",
+    "wind_speed_ms", "wind_direction_deg", "air_temperature_c",
+])
+
+# Bounds the prefix caches; a multi-year backfill sees a few thousand dates
+_CACHE_LIMIT = 10000
+_date_cache = {}
+_time_cache = {}
+
+
+def safe_float(value):
+    """Convert a string to float, returning None for empty or invalid values."""
+    if not value or not value.strip():
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _decode_date(text):
+    month, day, year = text.split("/")
+    if not (len(year) == 4 and len(month) <= 2 and len(day) <= 2
+            and (month + day + year).isdigit()):
+        raise ValueError(text)
+    ymd = (int(year), int(month), int(day))
+    datetime(*ymd)  # validate the calendar date
+    return ymd
+
+
+def _decode_time(clock, meridiem):
+    hour, minute, second = clock.split(":")
+    if not (len(hour) <= 2 and len(minute) <= 2 and len(second) <= 2
+            and (hour + minute + second).isdigit()):
+        raise ValueError(clock)
+    hour = int(hour)
+    if not 1 <= hour <= 12:
+        raise ValueError(clock)
+    meridiem = meridiem.upper()
+    if meridiem == "PM":
+        hour = hour % 12 + 12
+    elif meridiem == "AM":
+        hour = hour % 12
+    else:
+        raise ValueError(meridiem)
+    return hour, int(minute), int(second)
+
+
+def parse_timestamp(text):
+    """Equivalent of datetime.strptime(text, KC_TIMESTAMP_FORMAT), but fast.
+
+    Anything outside the plain "M/D/YYYY H:MM:SS AM" shape is handed to
+    strptime itself, so results and errors stay identical.
+    """
+    try:
+        date_part, clock, meridiem = text.split(" ")
+        ymd = _date_cache.get(date_part)
+        if ymd is None:
+            ymd = _decode_date(date_part)
+            if len(_date_cache) >= _CACHE_LIMIT:
+                _date_cache.clear()
+            _date_cache[date_part] = ymd
+        key = (clock, meridiem)
+        hms = _time_cache.get(key)
+        if hms is None:
+            hms = _decode_time(clock, meridiem)
+            if len(_time_cache) >= _CACHE_LIMIT:
+                _time_cache.clear()
+            _time_cache[key] = hms
+        return datetime(*ymd, *hms)
+    except ValueError:
+        return datetime.strptime(text, KC_TIMESTAMP_FORMAT)
+
+
+def profile_columns(headers):
+    """Map profile header names to column indexes."""
+    col_idx = {}
+    for i, h in enumerate(headers or []):
+        hl = h.strip().lower()
+        if "date" in hl:
+            col_idx["date"] = i
+        elif "depth" in hl:
+            col_idx["depth"] = i
+        elif "temperature" in hl:
+            col_idx["temp"] = i
+        elif "turbidity" in hl:
+            col_idx["turbidity"] = i
+        elif "chlorophyll" in hl:
+            col_idx["chlorophyll"] = i
+        elif "phycocyanin" in hl:
+            col_idx["phycocyanin"] = i
+    return col_idx
+
+
+def met_columns(headers):
+    """Map met header names to column indexes."""
+    col_idx = {}
+    for i, h in enumerate(headers or []):
+        hl = h.strip().lower()
+        if "date" in hl:
+            col_idx["date"] = i
+        elif "humidity" in hl:
+            col_idx["humidity"] = i
+        elif "solar" in hl or "radiation" in hl:
+            col_idx["solar"] = i
+        elif "pressure" in hl or "barometric" in hl:
+            col_idx["pressure"] = i
+        elif "wind speed" in hl or "wind_speed" in hl:
+            col_idx["wind_speed"] = i
+        elif "wind dir" in hl or "wind_dir" in hl:
+            col_idx["wind_dir"] = i
+        elif "air temp" in hl or "air_temp" in hl:
+            col_idx["air_temp"] = i
+    return col_idx
+
+
+def _optional(row, col_idx, key):
+    i = col_idx.get(key)
+    return safe_float(row[i]) if i is not None else None
+
+
+def _row_timestamp(row, col_idx):
+    """Timestamp of a data row, or None for blank/repeated-header/bad rows."""
+    if not row or row[0].strip().lower() == "date":
+        return None
+    try:
+        return parse_timestamp(row[col_idx.get("date", 0)])
+    except (ValueError, IndexError):
+        return None
+
+
+def iter_profile_records(headers, rows):
+    """Yield a ProfileRecord per row that has a timestamp and a temperature."""
+    col_idx = profile_columns(headers)
+    depth_i = col_idx.get("depth", 1)
+    temp_i = col_idx.get("temp", 2)
+    for row in rows:
+        dt = _row_timestamp(row, col_idx)
+        if dt is None:
+            continue
+        temperature_c = safe_float(row[temp_i])
+        if temperature_c is None:
+            continue
+        yield ProfileRecord(
+            dt,
+            safe_float(row[depth_i]),
+            temperature_c,
+            _optional(row, col_idx, "turbidity"),
+            _optional(row, col_idx, "chlorophyll"),
+            _optional(row, col_idx, "phycocyanin"),
+        )
+
+
+def iter_met_records(headers, rows):
+    """Yield a MetRecord per row that has a timestamp."""
+    col_idx = met_columns(headers)
+    for row in rows:
+        dt = _row_timestamp(row, col_idx)
+        if dt is None:
+            continue
+        yield MetRecord(
+            dt,
+            _optional(row, col_idx, "humidity"),
+            _optional(row, col_idx, "solar"),
+            _optional(row, col_idx, "pressure"),
+            _optional(row, col_idx, "wind_speed"),
+            _optional(row, col_idx, "wind_dir"),
+            _optional(row, col_idx, "air_temp"),
+        )
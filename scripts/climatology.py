@@ -0,0 +1,141 @@
+"""Day-of-year climatology (climatology_doy), kept up to date incrementally.
+
+    python scripts/climatology.py              # fold in newly completed days
+    python scripts/climatology.py --rebuild    # recompute all 366 rows
+
+climatology_doy has one row per day of year with smoothed norms: the mean
+daily surface max water temp, daily max air temp, mean wind, daily max
+solar, daily precipitation total and mean AQI. Each is built the way
+generate_forecast used to build its norms: average each metric per day of
+year over every complete local day in daily_surface / daily_met, then
+average those per-DOY values over a +/-7 day window around each DOY
+(wrapping at the year end). Today is left out until it is over.
+
+A row only depends on the days within 7 DOYs of it, so a refresh
+recomputes just the rows around the days that changed: days completed
+since the last refresh (through_day) and any completed days an import
+rewrote. daily_summary calls refresh_climatology after each refresh, in
+the same transaction.
+"""
+
+import os
+import argparse
+from datetime import timedelta
+from dotenv import load_dotenv
+from db_utils import connect_with_retry
+
+load_dotenv()
+DB_URL = os.getenv("SUPABASE_DB_URL")
+
+WINDOW = 7  # days either side of a DOY that are averaged into its norms
+DAYS_OF_YEAR = 366
+
+REFRESH_SQL = """
+    WITH today AS (
+        SELECT (NOW() AT TIME ZONE 'America/Los_Angeles')::date AS day
+    ),
+    water AS (
+        SELECT day_of_year AS doy, AVG(max_temp_c) AS water_max_c, COUNT(*) AS days
+        FROM daily_surface
+        WHERE local_day < (SELECT day FROM today)
+          AND day_of_year = ANY(%(sources)s::smallint[])
+        GROUP BY day_of_year
+    ),
+    met AS (
+        SELECT day_of_year AS doy,
+               AVG(max_air_c) AS air_max_c,
+               AVG(avg_wind_ms) AS wind_ms,
+               AVG(max_solar_w) AS solar_w,
+               AVG(total_precip_mm) AS precip_mm,
+               AVG(avg_aqi) AS aqi,
+               COUNT(*) AS days
+        FROM daily_met
+        WHERE local_day < (SELECT day FROM today)
+          AND day_of_year = ANY(%(sources)s::smallint[])
+        GROUP BY day_of_year
+    )
+    INSERT INTO climatology_doy (doy, water_max_c, air_max_c, wind_ms, solar_w,
+                                 precip_mm, aqi, water_days, met_days, through_day,
+                                 updated_at)
+    SELECT t.doy, w.water_max_c, m.air_max_c, m.wind_ms, m.solar_w, m.precip_mm, m.aqi,
+           COALESCE(w.days, 0), COALESCE(m.days, 0), (SELECT day FROM today) - 1, NOW()
+    FROM unnest(%(targets)s::smallint[]) t (doy)
+    LEFT JOIN LATERAL (
+        SELECT AVG(water_max_c) AS water_max_c,
+               SUM(days) FILTER (WHERE doy = t.doy) AS days
+        FROM water
+        WHERE LEAST(ABS(doy - t.doy), 366 - ABS(doy - t.doy)) <= %(window)s
+    ) w ON TRUE
+    LEFT JOIN LATERAL (
+        SELECT AVG(air_max_c) AS air_max_c, AVG(wind_ms) AS wind_ms,
+               AVG(solar_w) AS solar_w, AVG(precip_mm) AS precip_mm, AVG(aqi) AS aqi,
+               SUM(days) FILTER (WHERE doy = t.doy) AS days
+        FROM met
+        WHERE LEAST(ABS(doy - t.doy), 366 - ABS(doy - t.doy)) <= %(window)s
+    ) m ON TRUE
+    ON CONFLICT (doy) DO UPDATE
+    SET water_max_c = EXCLUDED.water_max_c,
+        air_max_c = EXCLUDED.air_max_c,
+        wind_ms = EXCLUDED.wind_ms,
+        solar_w = EXCLUDED.solar_w,
+        precip_mm = EXCLUDED.precip_mm,
+        aqi = EXCLUDED.aqi,
+        water_days = EXCLUDED.water_days,
+        met_days = EXCLUDED.met_days,
+        through_day = EXCLUDED.through_day,
+        updated_at = EXCLUDED.updated_at;
+"""
+
+
+def around(doys, radius=WINDOW):
+    """DOYs within radius of any of doys, wrapping at the year end."""
+    return sorted({(doy - 1 + offset) % DAYS_OF_YEAR + 1
+                   for doy in doys for offset in range(-radius, radius + 1)})
+
+
+def _recompute(cursor, targets):
+    # A target's norms read the per-DOY values of its window
+    cursor.execute(REFRESH_SQL, {"targets": targets, "sources": around(targets),
+                                 "window": WINDOW})
+    return len(targets)
+
+
+def rebuild_climatology(cursor):
+    """Recompute every row (caller commits). Returns the row count."""
+    return _recompute(cursor, list(range(1, DAYS_OF_YEAR + 1)))
+
+
+def refresh_climatology(cursor, days=()):
+    """Fold newly completed days, and completed days in days, into the norms.
+
+    Builds the table from scratch if it is empty. Returns the number of
+    rows recomputed; the caller commits.
+    """
+    cursor.execute("""
+        SELECT MAX(through_day), (NOW() AT TIME ZONE 'America/Los_Angeles')::date - 1
+        FROM climatology_doy;
+    """)
+    through, yesterday = cursor.fetchone()
+    if through is None or (yesterday - through).days >= DAYS_OF_YEAR:
+        return rebuild_climatology(cursor)
+
+    changed = {day for day in days if day <= yesterday}
+    changed.update(through + timedelta(days=n) for n in range(1, (yesterday - through).days + 1))
+    if not changed:
+        return 0
+    return _recompute(cursor, around(day.timetuple().tm_yday for day in changed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rebuild", action="store_true",
+                        help="recompute every day of year, not just the changed ones")
+    args = parser.parse_args()
+
+    conn = connect_with_retry(DB_URL)
+    cursor = conn.cursor()
+    count = rebuild_climatology(cursor) if args.rebuild else refresh_climatology(cursor)
+    conn.commit()
+    cursor.close()
+    conn.close()
+    print(f"climatology_doy: {count} days of year recomputed")
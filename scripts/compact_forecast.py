@@ -0,0 +1,128 @@
+"""Thin old fetch generations out of weather_forecast.
+
+    python scripts/compact_forecast.py                    # keep 14 days, 6h buckets
+    python scripts/compact_forecast.py --keep-days 30 --bucket-hours 12
+    python scripts/compact_forecast.py --dry-run
+
+Every fetch covers ~192 hours, so each forecast hour is covered by dozens
+of fetches (forecast_fetch). Hours whose forecast_time is more than
+--keep-days in the past are thinned: the fetches covering an hour are
+grouped into lead-time buckets (forecast_time - fetched_at, --bucket-hours
+wide) and only the latest fetch in each bucket is kept. A stored row is
+deleted unless weather_forecast_as_of() of a kept fetch returns it, which
+works the same for "full" and "delta" storage (see fetch_forecast.py). What
+a forecast said 6, 12, ... 192 hours ahead stays available for verifying
+it against what happened, and the last fetch before the hour is always
+kept (it is the latest of the shortest lead). For a fetch that was not
+kept, weather_forecast_as_of() returns the values of an earlier kept one.
+weather_forecast_latest and forecast_fetch are not touched.
+
+fetched_at is written with the runner's clock, which is UTC on GitHub
+Actions, while forecast_time is Pacific local time; leads are computed
+after converting fetched_at to Pacific time. Old hours are deleted a few
+days at a time, each batch in its own transaction.
+"""
+
+import os
+import argparse
+from datetime import timedelta
+from dotenv import load_dotenv
+from db_utils import connect_with_retry
+
+load_dotenv()
+DB_URL = os.getenv("SUPABASE_DB_URL")
+
+KEEP_DAYS = 14
+BUCKET_HOURS = 6
+BATCH_DAYS = 7
+
+# Stored rows with forecast_time in [start, end) that no kept fetch reads:
+# a fetch reads the newest row stored for the hour at or before it
+SUPERSEDED_SQL = """
+    WITH kept AS (
+        SELECT forecast_time, fetched_at
+        FROM (
+            SELECT h.forecast_time, f.fetched_at,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY h.forecast_time,
+                                    FLOOR(EXTRACT(EPOCH FROM h.forecast_time
+                                          - (f.fetched_at AT TIME ZONE 'UTC' AT TIME ZONE 'America/Los_Angeles'))
+                                          / 3600 / %(bucket_hours)s)
+                       ORDER BY f.fetched_at DESC) AS rank
+            FROM (SELECT DISTINCT forecast_time FROM weather_forecast
+                  WHERE forecast_time >= %(start)s AND forecast_time < %(end)s) h
+            JOIN forecast_fetch f
+              ON h.forecast_time BETWEEN f.first_hour AND f.last_hour
+        ) fetches
+        WHERE rank = 1
+    ),
+    stored AS (
+        SELECT forecast_time, fetched_at,
+               LEAD(fetched_at) OVER (PARTITION BY forecast_time ORDER BY fetched_at) AS next_fetched_at
+        FROM weather_forecast
+        WHERE forecast_time >= %(start)s AND forecast_time < %(end)s
+    )
+    SELECT s.forecast_time, s.fetched_at
+    FROM stored s
+    WHERE NOT EXISTS (
+        SELECT 1 FROM kept k
+        WHERE k.forecast_time = s.forecast_time
+          AND k.fetched_at >= s.fetched_at
+          AND (s.next_fetched_at IS NULL OR k.fetched_at < s.next_fetched_at)
+    )
+"""
+
+
+def compaction_range(cursor, keep_days):
+    """(oldest forecast_time, cutoff); cutoff is the start of the kept days."""
+    cursor.execute("""
+        SELECT MIN(forecast_time),
+               DATE_TRUNC('day', NOW() AT TIME ZONE 'America/Los_Angeles') - make_interval(days => %s)
+        FROM weather_forecast;
+    """, (keep_days,))
+    return cursor.fetchone()
+
+
+def compact(conn, keep_days=KEEP_DAYS, bucket_hours=BUCKET_HOURS, dry_run=False):
+    """Delete superseded generations older than keep_days. Returns rows deleted."""
+    cursor = conn.cursor()
+    oldest, cutoff = compaction_range(cursor, keep_days)
+    total = 0
+    start = oldest
+    while start is not None and start < cutoff:
+        end = min(start + timedelta(days=BATCH_DAYS), cutoff)
+        params = {"start": start, "end": end, "bucket_hours": bucket_hours}
+        if dry_run:
+            cursor.execute(f"SELECT COUNT(*) FROM ({SUPERSEDED_SQL}) s;", params)
+            count = cursor.fetchone()[0]
+        else:
+            cursor.execute(f"""
+                DELETE FROM weather_forecast w
+                USING ({SUPERSEDED_SQL}) s
+                WHERE w.forecast_time = s.forecast_time AND w.fetched_at = s.fetched_at;
+            """, params)
+            count = cursor.rowcount
+            conn.commit()
+        total += count
+        print(f"  {start:%Y-%m-%d} .. {end:%Y-%m-%d}: {count} rows")
+        start = end
+    cursor.close()
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--keep-days", type=int, default=KEEP_DAYS,
+                        help="leave hours from the last N days alone (default: %(default)s)")
+    parser.add_argument("--bucket-hours", type=int, default=BUCKET_HOURS,
+                        help="lead-time bucket width; one fetch kept per bucket (default: %(default)s)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="count the rows that would be deleted")
+    args = parser.parse_args()
+
+    conn = connect_with_retry(DB_URL)
+    print(f"Compacting forecast hours older than {args.keep_days} days "
+          f"({args.bucket_hours}h lead buckets){' [dry run]' if args.dry_run else ''}")
+    total = compact(conn, args.keep_days, args.bucket_hours, args.dry_run)
+    conn.close()
+    print(f"{total} rows {'would be ' if args.dry_run else ''}deleted.")
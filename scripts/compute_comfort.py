@@ -18,11 +18,9 @@ Hard overrides:
 
 import os
 import json
-import psycopg2
-import psycopg2.extras
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from db_utils import connect_with_retry
+from db_utils import connect_with_retry, copy_upsert, to_float
 
 load_dotenv()
 DB_URL = os.getenv("SUPABASE_DB_URL")
@@ -146,6 +144,29 @@ WEIGHTS = {
 # Remaining 5% is a baseline bonus to make 100 achievable on perfect days
 BASELINE_BONUS = 0.05
 
+COMFORT_COLUMNS = (
+    "score_time", "computed_at", "overall_score", "label",
+    "water_temp_score", "air_temp_score", "wind_score", "sun_score",
+    "rain_score", "clarity_score", "algae_score", "aqi_score",
+    "override_reason", "input_snapshot", "run_id",
+)
+
+# An existing hour is only rewritten (with the new computed_at and run_id)
+# if its score or inputs changed
+CHANGE_COLUMNS = COMFORT_COLUMNS[2:-1]
+COMFORT_ON_CONFLICT = (
+    "DO UPDATE SET "
+    + ", ".join(f"{c} = EXCLUDED.{c}" for c in COMFORT_COLUMNS[1:])
+    + f" WHERE ({', '.join('comfort_score.' + c for c in CHANGE_COLUMNS)})"
+    + f" IS DISTINCT FROM ({', '.join('EXCLUDED.' + c for c in CHANGE_COLUMNS)})"
+)
+
+# The latest run, as a FROM item for the readers (generate_html,
+# export_comfort_json, generate_forecast). A run only rewrites hours that
+# changed, so its forecast is all comfort_score rows between its first_hour
+# and last_hour; rows outside that are left over from older runs.
+LATEST_RUN = "(SELECT * FROM comfort_run ORDER BY run_id DESC LIMIT 1) run"
+
 
 def compute_score(water_temp_f, feels_like_f, wind_mph, solar_w, precip_pct,
                   turbidity_ntu, phycocyanin_ugl, aqi_val, wind_dir_deg=None):
@@ -206,26 +227,26 @@ def get_latest_buoy_data(cursor):
     """)
     row = cursor.fetchone()
     if row:
-        temp_c, turbidity, chlorophyll, phycocyanin = row
-        temp_f = round(float(temp_c) * 9 / 5 + 32, 1) if temp_c else None
+        temp_c, turbidity, chlorophyll, phycocyanin = map(to_float, row)
+        temp_f = round(temp_c * 9 / 5 + 32, 1) if temp_c else None
         return {
             "water_temp_f": temp_f,
-            "turbidity_ntu": float(turbidity) if turbidity else None,
-            "phycocyanin_ugl": float(phycocyanin) if phycocyanin else None,
+            "turbidity_ntu": turbidity or None,
+            "phycocyanin_ugl": phycocyanin or None,
         }
     return {"water_temp_f": None, "turbidity_ntu": None, "phycocyanin_ugl": None}
 
 
 def get_forecast_hours(cursor):
-    """Get the latest forecast for each hour from yesterday through next 8 days."""
+    """Get the latest forecast for each hour from yesterday through the 8th day ahead."""
     cursor.execute("""
-        SELECT DISTINCT ON (forecast_time)
+        SELECT
             forecast_time, feels_like_f, wind_speed_mph, solar_radiation_w,
             precip_probability, us_aqi, uv_index, temperature_f, wind_direction_deg
-        FROM weather_forecast
+        FROM weather_forecast_latest
         WHERE forecast_time >= DATE_TRUNC('day', NOW()) - INTERVAL '1 day'
-          AND forecast_time < NOW() + INTERVAL '8 days'
-        ORDER BY forecast_time, fetched_at DESC;
+          AND forecast_time < DATE_TRUNC('day', NOW()) + INTERVAL '9 days'
+        ORDER BY forecast_time;
     """)
     return cursor.fetchall()
 
@@ -251,8 +272,8 @@ def project_water_temps(buoy_temp_f, forecast_rows):
     water_f = buoy_temp_f
     projected = []
     for row in forecast_rows:
-        air_f = float(row[7]) if row[7] else buoy_temp_f  # temperature_f
-        solar_w = float(row[3]) if row[3] else 0
+        air_f = to_float(row[7]) or buoy_temp_f  # temperature_f
+        solar_w = to_float(row[3]) or 0
 
         # Equilibrium: air temp slightly damped (water doesn't fully track air)
         equilibrium = air_f * 0.7 + water_f * 0.3
@@ -266,10 +287,16 @@ def project_water_temps(buoy_temp_f, forecast_rows):
     return projected
 
 
-if __name__ == "__main__":
-    conn = connect_with_retry(DB_URL)
+def main(conn=None):
+    """Score the forecast hours as a new comfort_run and upsert the changed ones.
+
+    Uses conn if given (and leaves it open), otherwise opens its own.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = connect_with_retry(DB_URL)
+        print("Connected to database")
     cursor = conn.cursor()
-    print("Connected to database")
 
     buoy = get_latest_buoy_data(cursor)
     print(f"Latest buoy: water={buoy['water_temp_f']}F, "
@@ -283,18 +310,31 @@ if __name__ == "__main__":
     water_temps = project_water_temps(buoy["water_temp_f"], forecast_rows)
     print(f"Projected water temps: {water_temps[0]}F -> {water_temps[-1]}F" if water_temps and water_temps[0] else "No water temp projection")
 
+    if not forecast_rows:
+        print("No forecast hours to score.")
+        cursor.close()
+        if own_conn:
+            conn.close()
+        return
+
     now = datetime.now()
+    cursor.execute("""
+        INSERT INTO comfort_run (computed_at, first_hour, last_hour, hours, changed)
+        VALUES (%s, %s, %s, %s, 0) RETURNING run_id;
+    """, (now, forecast_rows[0][0], forecast_rows[-1][0], len(forecast_rows)))
+    run_id = cursor.fetchone()[0]
     batch = []
     for i, row in enumerate(forecast_rows):
-        forecast_time, feels_like_f, wind_mph, solar_w, precip_pct, aqi_val, uv_index, air_temp_f, wind_dir_deg = row
+        forecast_time, *values = row
+        feels_like_f, wind_mph, solar_w, precip_pct, aqi_val, uv_index, air_temp_f, wind_dir_deg = map(to_float, values)
 
-        feels_like_f = float(feels_like_f) if feels_like_f else None
-        wind_mph = float(wind_mph) if wind_mph else None
-        solar_w = float(solar_w) if solar_w else None
-        precip_pct = float(precip_pct) if precip_pct else None
-        aqi_val = float(aqi_val) if aqi_val else None
-        uv_index = float(uv_index) if uv_index else None
-        wind_dir_deg = float(wind_dir_deg) if wind_dir_deg is not None else None
+        # Zero readings count as missing, as they always have
+        feels_like_f = feels_like_f or None
+        wind_mph = wind_mph or None
+        solar_w = solar_w or None
+        precip_pct = precip_pct or None
+        aqi_val = aqi_val or None
+        uv_index = uv_index or None
 
         projected_water_f = water_temps[i]
 
@@ -322,39 +362,19 @@ if __name__ == "__main__":
             round(scores["wind"], 1), round(scores["sun"], 1),
             round(scores["rain"], 1), round(scores["clarity"], 1),
             round(scores["algae"], 1), round(scores["aqi"], 1),
-            override, json.dumps(snapshot),
+            override, json.dumps(snapshot), run_id,
         ))
 
-    if batch:
-        psycopg2.extras.execute_values(
-            cursor,
-            """
-            INSERT INTO comfort_score (
-                score_time, computed_at, overall_score, label,
-                water_temp_score, air_temp_score, wind_score, sun_score,
-                rain_score, clarity_score, algae_score, aqi_score,
-                override_reason, input_snapshot
-            ) VALUES %s
-            ON CONFLICT (score_time)
-            DO UPDATE SET computed_at = EXCLUDED.computed_at,
-                          overall_score = EXCLUDED.overall_score,
-                          label = EXCLUDED.label,
-                          water_temp_score = EXCLUDED.water_temp_score,
-                          air_temp_score = EXCLUDED.air_temp_score,
-                          wind_score = EXCLUDED.wind_score,
-                          sun_score = EXCLUDED.sun_score,
-                          rain_score = EXCLUDED.rain_score,
-                          clarity_score = EXCLUDED.clarity_score,
-                          algae_score = EXCLUDED.algae_score,
-                          aqi_score = EXCLUDED.aqi_score,
-                          override_reason = EXCLUDED.override_reason,
-                          input_snapshot = EXCLUDED.input_snapshot;
-            """,
-            batch,
-            page_size=200
-        )
+    changed = copy_upsert(cursor, "comfort_score", COMFORT_COLUMNS, batch,
+                          ("score_time",), COMFORT_ON_CONFLICT)
+    cursor.execute("UPDATE comfort_run SET changed = %s WHERE run_id = %s;", (changed, run_id))
 
     conn.commit()
     cursor.close()
-    conn.close()
-    print(f"Computed and saved {len(batch)} comfort scores.")
+    if own_conn:
+        conn.close()
+    print(f"Computed {len(batch)} comfort scores, saved {changed} that changed (run {run_id}).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Daily summary tables kept in step with lake_data / met_data.
+
+    python scripts/daily_summary.py                       # recompute every day
+    python scripts/daily_summary.py --start 2024-06-01 --end 2024-07-01
+
+daily_surface holds one row per local day of surface readings (depth_m <
+1.5, temperature_c not null); daily_met one row per local day of met_data
+rows that have an air temperature. The report queries (generate_html,
+generate_forecast, export_comfort_json) read these instead of regrouping
+five years of 15-minute rows on every run.
+
+Every path that writes raw readings (import_data.upsert_profile /
+upsert_met, backfill_openmeteo.upsert_weather) calls refresh_surface or
+refresh_met with the days in its batch, in the same transaction, so a
+summary row is never out of date with committed readings. A refresh
+recomputes each touched day from the raw rows (the date indexes make
+that a range scan per day), replacing the old row or deleting it if the
+day no longer has readings. The CLI recomputes a whole range, e.g. after
+editing raw rows by hand. Both also refresh the day-of-year climatology
+for the days they touched (see climatology.py).
+
+Values are the same aggregates the reports used to compute inline. AVG
+temperature over many days is sum_temp_c / readings, so it matches an AVG
+over the raw rows (up to float rounding).
+"""
+
+import os
+import argparse
+from datetime import date
+from dotenv import load_dotenv
+from db_utils import connect_with_retry
+from climatology import refresh_climatology
+
+load_dotenv()
+DB_URL = os.getenv("SUPABASE_DB_URL")
+
+SURFACE_SELECT = """
+    SELECT l.local_day, MAX(l.temperature_c), SUM(l.temperature_c), COUNT(*)
+    FROM {source}
+    WHERE {where} AND l.depth_m < 1.5 AND l.temperature_c IS NOT NULL
+    GROUP BY l.local_day
+"""
+
+MET_SELECT = """
+    SELECT m.local_day,
+           MAX(m.air_temperature_c), AVG(m.wind_speed_ms), MAX(m.solar_radiation_w),
+           SUM(m.precipitation_mm), AVG(m.us_aqi), COUNT(*)
+    FROM {source}
+    WHERE {where} AND m.air_temperature_c IS NOT NULL
+    GROUP BY m.local_day
+"""
+
+# summary table -> (columns, raw table, its alias in the select, select)
+SUMMARIES = {
+    "daily_surface": ("local_day, max_temp_c, sum_temp_c, readings",
+                      "lake_data", "l", SURFACE_SELECT),
+    "daily_met": ("local_day, max_air_c, avg_wind_ms, max_solar_w, total_precip_mm, avg_aqi, readings",
+                  "met_data", "m", MET_SELECT),
+}
+
+
+def days_of(batch):
+    """Distinct local days of rows whose first field is the reading time."""
+    return sorted({row[0].date() for row in batch})
+
+
+def _refresh(cursor, table, days):
+    if not days:
+        return
+    columns, raw, alias, select = SUMMARIES[table]
+    # A range join per day, so the date indexes on the raw table are used
+    source = (f"unnest(%(days)s::date[]) d JOIN {raw} {alias} "
+              f"ON {alias}.date >= d AND {alias}.date < d + 1")
+    cursor.execute(f"""
+        DELETE FROM {table} WHERE local_day = ANY(%(days)s::date[]);
+        INSERT INTO {table} ({columns}) {select.format(source=source, where="TRUE")};
+    """, {"days": list(days)})
+    refresh_climatology(cursor, days)
+
+
+def refresh_surface(cursor, days):
+    """Recompute daily_surface for the given local days (caller commits)."""
+    _refresh(cursor, "daily_surface", days)
+
+
+def refresh_met(cursor, days):
+    """Recompute daily_met for the given local days (caller commits)."""
+    _refresh(cursor, "daily_met", days)
+
+
+def rebuild(cursor, table, start=None, end=None):
+    """Recompute table for [start, end) (all days when None). Returns row count."""
+    columns, raw, alias, select = SUMMARIES[table]
+    start, end = start or date.min, end or date.max
+    where = f"{alias}.date >= %(start)s AND {alias}.date < %(end)s"
+    cursor.execute(f"""
+        DELETE FROM {table} WHERE local_day >= %(start)s AND local_day < %(end)s;
+        INSERT INTO {table} ({columns}) {select.format(source=f"{raw} {alias}", where=where)};
+    """, {"start": start, "end": end})
+    count = cursor.rowcount
+    cursor.execute(f"SELECT local_day FROM {table} WHERE local_day >= %(start)s AND local_day < %(end)s;",
+                   {"start": start, "end": end})
+    refresh_climatology(cursor, [row[0] for row in cursor.fetchall()])
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--start", help="first day (default: all)")
+    parser.add_argument("--end", help="end day, exclusive (default: all)")
+    args = parser.parse_args()
+    start = date.fromisoformat(args.start) if args.start else None
+    end = date.fromisoformat(args.end) if args.end else None
+
+    conn = connect_with_retry(DB_URL)
+    cursor = conn.cursor()
+    for table in SUMMARIES:
+        count = rebuild(cursor, table, start, end)
+        conn.commit()
+        print(f"{table}: {count} days")
+    cursor.close()
+    conn.close()
@@ -0,0 +1,270 @@
+"""Streaming table extractor for King County DataScrape.aspx pages.
+
+A month of profile data is one <table> with a row for every depth of every
+15-minute cast. Building a full BeautifulSoup tree for that and walking it
+with find_all() dominated ingest time, so this module walks the page with
+html.parser's event stream instead and never materializes a DOM.
+
+Output matches the previous BeautifulSoup code for the pages DataScrape
+serves: headers are the <th> texts of the first table, rows are the <td>
+texts of each later <tr>, cell text is stripped like get_text(strip=True),
+and rows whose cell count differs from the header count are dropped.
+
+Raw pages are also cached on disk, keyed by (type, buoy, year, month), with
+a SHA-256 of their content. Closed months never change upstream, so they
+are served from the cache; the current month is revalidated on every fetch.
+Callers record the hash they imported with mark_imported() and can skip
+parse + upsert entirely when is_imported() says the page is unchanged.
+"""
+
+import os
+import json
+import hashlib
+import calendar
+from datetime import datetime, timedelta
+from html.parser import HTMLParser
+
+import requests
+
+BASE_URL = "https://green2.kingcounty.gov/lake-buoy/DataScrape.aspx"
+BUOY = "sammamish"
+
+CACHE_DIR = os.getenv("DATASCRAPE_CACHE_DIR", ".cache/datascrape")
+
+# King County occasionally back-fills the last few days of a month after it
+# ends, so a month only counts as closed (immutable) this long after its end
+CLOSED_AFTER_DAYS = 7
+
+FEED_CHUNK = 64 * 1024
+
+
+class _TableParser(HTMLParser):
+    """Collects header and row cell lists from the first <table> on a page.
+
+    Completed items are appended to self.ready; the caller drains it between
+    feed() calls so rows can be consumed while the page is still being parsed.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.ready = []
+        self.headers = []
+        self.found_table = False
+        self._depth = 0           # <table> nesting depth inside the first table
+        self._finished = False    # first table closed; ignore the rest of the page
+        self._headers_sent = False
+        self._tr_count = 0
+        self._cells = None        # <td> texts of the current row
+        self._cell = None         # stripped text pieces of the current cell
+        self._cell_is_header = False
+        self._data = []           # raw text since the last tag event
+
+    # Text between two tags can arrive in several handle_data() calls when the
+    # page is fed in chunks. get_text(strip=True) strips whole text nodes, so
+    # buffer until the next tag before stripping.
+    def _flush_data(self):
+        if self._data:
+            text = "".join(self._data).strip()
+            self._data = []
+            if text and self._cell is not None:
+                self._cell.append(text)
+
+    def _end_cell(self):
+        if self._cell is None:
+            return
+        text = "".join(self._cell)
+        if self._cell_is_header:
+            self.headers.append(text)
+        elif self._cells is not None:
+            self._cells.append(text)
+        self._cell = None
+
+    def _end_row(self):
+        self._end_cell()
+        if self._cells is None:
+            return
+        cells, self._cells = self._cells, None
+        if self._tr_count == 1:
+            self._send_headers()
+        elif cells and len(cells) == len(self.headers):
+            self.ready.append(cells)
+
+    def _send_headers(self):
+        if not self._headers_sent:
+            self._headers_sent = True
+            self.ready.append(self.headers)
+
+    def handle_starttag(self, tag, attrs):
+        self._flush_data()
+        if self._finished:
+            return
+        if tag == "table":
+            self.found_table = True
+            self._depth += 1
+        elif self._depth == 0:
+            return
+        elif tag == "tr":
+            self._end_row()
+            self._tr_count += 1
+            self._cells = []
+        elif tag in ("td", "th"):
+            self._end_cell()
+            self._cell = []
+            self._cell_is_header = tag == "th"
+
+    def handle_endtag(self, tag):
+        self._flush_data()
+        if self._finished or self._depth == 0:
+            return
+        if tag in ("td", "th"):
+            self._end_cell()
+        elif tag == "tr":
+            self._end_row()
+        elif tag == "table":
+            self._depth -= 1
+            if self._depth == 0:
+                self._end_row()
+                self._send_headers()
+                self._finished = True
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._data.append(data)
+
+    def close(self):
+        super().close()
+        self._flush_data()
+        if self.found_table and not self._finished:
+            self._end_row()
+            self._send_headers()
+            self._finished = True
+
+
+def iter_table(source):
+    """Stream the first table of a DataScrape page.
+
+    source is the page as a str or an iterable of str chunks (for example
+    resp.iter_content(decode_unicode=True)). Yields the header cell list
+    first, then one cell list per data row. Yields nothing if the page has
+    no table.
+    """
+    if isinstance(source, str):
+        text = source
+        chunks = (text[i:i + FEED_CHUNK] for i in range(0, len(text), FEED_CHUNK))
+    else:
+        chunks = source
+
+    parser = _TableParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+        if parser.ready:
+            yield from parser.ready
+            parser.ready.clear()
+    parser.close()
+    yield from parser.ready
+    parser.ready.clear()
+
+
+def parse_table(source):
+    """Parse a DataScrape page into (headers, rows); ([], []) if no table."""
+    items = iter_table(source)
+    headers = next(items, [])
+    return headers, list(items)
+
+
+# --- On-disk page cache ---
+
+def _cache_base(data_type, year, month, buoy):
+    return os.path.join(CACHE_DIR, buoy, data_type, f"{int(year)}-{int(month):02d}")
+
+
+def _load_meta(base):
+    try:
+        with open(base + ".json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_atomic(path, text):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def _save_meta(base, meta):
+    _write_atomic(base + ".json", json.dumps(meta, indent=2))
+
+
+def is_closed(year, month, now=None):
+    """True once a month is old enough that its page can no longer change."""
+    now = now or datetime.now()
+    last_day = calendar.monthrange(int(year), int(month))[1]
+    month_end = datetime(int(year), int(month), last_day) + timedelta(days=1)
+    return now >= month_end + timedelta(days=CLOSED_AFTER_DAYS)
+
+
+def fetch_page(year, month, data_type="profile", buoy=BUOY, client=None, timeout=30,
+               revalidate=False):
+    """Fetch one DataScrape month page through the cache.
+
+    Returns (text, content_hash). Closed months are read from the cache when
+    present, unless revalidate is set; anything else goes to the network
+    (conditionally, if the server gave us validators last time). client, if
+    given, is an http_utils.FetchClient whose rate limit and retries apply
+    to the request.
+    """
+    base = _cache_base(data_type, year, month, buoy)
+    meta = _load_meta(base)
+    cached = meta.get("sha256") and os.path.exists(base + ".html")
+
+    if cached and is_closed(year, month) and not revalidate:
+        with open(base + ".html", encoding="utf-8") as f:
+            return f.read(), meta["sha256"]
+
+    headers = {}
+    if cached and meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if cached and meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    params = {"type": data_type, "buoy": buoy, "year": str(year), "month": str(month)}
+    if client is not None:
+        resp = client.get(BASE_URL, params=params, headers=headers, timeout=timeout)
+    else:
+        resp = requests.get(BASE_URL, params=params, headers=headers, timeout=timeout)
+
+    if resp.status_code == 304 and cached:
+        with open(base + ".html", encoding="utf-8") as f:
+            text = f.read()
+    else:
+        resp.raise_for_status()
+        text = resp.text
+        content_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        if content_hash != meta.get("sha256"):
+            os.makedirs(os.path.dirname(base), exist_ok=True)
+            _write_atomic(base + ".html", text)
+            meta["sha256"] = content_hash
+        meta["etag"] = resp.headers.get("ETag")
+        meta["last_modified"] = resp.headers.get("Last-Modified")
+
+    meta["fetched_at"] = datetime.now().isoformat(timespec="seconds")
+    _save_meta(base, meta)
+    return text, meta["sha256"]
+
+
+def is_imported(year, month, data_type, content_hash, buoy=BUOY):
+    """True if this exact page content was already imported."""
+    meta = _load_meta(_cache_base(data_type, year, month, buoy))
+    return meta.get("imported_sha256") == content_hash
+
+
+def mark_imported(year, month, data_type, content_hash, buoy=BUOY):
+    """Record that the page with content_hash has been committed to the DB."""
+    base = _cache_base(data_type, year, month, buoy)
+    meta = _load_meta(base)
+    meta["imported_sha256"] = content_hash
+    meta["imported_at"] = datetime.now().isoformat(timespec="seconds")
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    _save_meta(base, meta)
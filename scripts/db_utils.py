@@ -1,56 +1,288 @@
-"""Shared database connection utilities with retry logic."""
+"""Shared database utilities: connections with retry logic and bulk loading."""
 
+import io
 import os
+import re
+import random
+import socket
+import threading
 import time
 import psycopg2
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from datetime import datetime
 from dotenv import load_dotenv
+import query_log
 
 load_dotenv()
 DB_URL = os.getenv("SUPABASE_DB_URL")
 
+# Per-address libpq connect timeout (seconds)
+CONNECT_TIMEOUT = 10
 
-def connect_with_retry(url=None, retries=5, base_delay=15):
-    """Connect to PostgreSQL with exponential backoff retries.
+# Happy Eyeballs: start the next address if none has connected after this long
+ATTEMPT_DELAY = 0.25
+
+# Retry backoff: starts at BASE_DELAY, doubles up to MAX_DELAY (with jitter),
+# and gives up once RETRY_DEADLINE seconds have passed
+BASE_DELAY = 0.5
+MAX_DELAY = 15
+RETRY_DEADLINE = 180
+
+# Connection errors that retrying won't fix
+FATAL_CONNECT_ERRORS = (
+    "password authentication failed",
+    "no pg_hba.conf entry",
+    "does not exist",
+)
+
+
+def in_background(fn, *args, **kwargs):
+    """Run fn in a daemon thread and return a Future for its result.
+
+    Daemon threads don't hold up interpreter exit, so an abandoned attempt
+    (a slow losing address, an unused early connect) costs nothing.
+    """
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def resolve(conn):
+    """Return conn, waiting for it first if it is a Future."""
+    return conn.result() if isinstance(conn, Future) else conn
+
+
+def close_when_ready(conn):
+    """Close a connection, or a pending one as soon as it arrives."""
+    if isinstance(conn, Future):
+        conn.add_done_callback(lambda f: f.exception() is None and f.result().close())
+    else:
+        conn.close()
+
+
+def connect_params(url=None):
+    """libpq keyword parameters for a postgres:// or SQLAlchemy-style URL."""
+    url = re.sub(r"^postgres(ql)?\+\w+://", "postgresql://", url or DB_URL)
+    return psycopg2.extensions.parse_dsn(url)
+
+
+def _addresses(host, port):
+    """Resolved addresses for host, alternating address families.
+
+    getaddrinfo's order (usually IPv6 first) decides which family leads, as
+    in RFC 8305. Returns [] when there is nothing to race: a unix socket,
+    an IP literal, or a multi-host list that libpq handles itself.
+    """
+    if not host or host.startswith("/") or "," in host:
+        return []
+    try:
+        socket.inet_pton(socket.AF_INET6 if ":" in host else socket.AF_INET, host)
+        return []
+    except OSError:
+        pass
+    infos = socket.getaddrinfo(host, port or 5432, type=socket.SOCK_STREAM)
+    by_family = {}
+    for family, _, _, _, sockaddr in infos:
+        addrs = by_family.setdefault(family, [])
+        if sockaddr[0] not in addrs:
+            addrs.append(sockaddr[0])
+    ordered = []
+    queues = list(by_family.values())
+    while any(queues):
+        for queue in queues:
+            if queue:
+                ordered.append(queue.pop(0))
+    return ordered
+
+
+def race_connect(params, timeout=CONNECT_TIMEOUT):
+    """Open one connection, racing the host's addresses Happy Eyeballs style.
+
+    The first address is tried at once and each further one ATTEMPT_DELAY
+    later (or as soon as the previous attempt fails); the first to connect
+    wins and the others are closed when they finish. This replaces forcing
+    IPv4: a runner without IPv6 routing loses the IPv6 attempt immediately
+    or after ATTEMPT_DELAY, not after a full connect timeout. host is still
+    passed, so TLS verification and pgBouncer routing see the hostname.
+    """
+    params = dict(params, connect_timeout=timeout)
+    addresses = [] if params.get("hostaddr") else _addresses(params.get("host"), params.get("port"))
+    if len(addresses) < 2:
+        if addresses:
+            params["hostaddr"] = addresses[0]
+        return psycopg2.connect(**params)
+
+    pending, errors, winner = set(), [], None
+    try:
+        while winner is None and (addresses or pending):
+            if addresses:
+                pending.add(in_background(psycopg2.connect, **params, hostaddr=addresses.pop(0)))
+            done, pending = wait(pending, timeout=ATTEMPT_DELAY if addresses else None,
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    errors.append(future.exception())
+                elif winner is None:
+                    winner = future.result()
+                else:
+                    future.result().close()
+    finally:
+        for future in pending:
+            close_when_ready(future)
+    if winner is None:
+        raise errors[-1]
+    return winner
+
+
+def connect_with_retry(url=None, deadline=RETRY_DEADLINE, base_delay=BASE_DELAY,
+                       max_delay=MAX_DELAY):
+    """Connect to PostgreSQL, retrying with short jittered exponential backoff.
 
     Supabase free tier pgBouncer can drop requests when the pool is saturated
-    (e.g., after auto-resume from pause or concurrent workflow overlap).
+    (e.g., after auto-resume from pause or concurrent workflow overlap), and
+    usually accepts again within seconds. So the first retries come quickly
+    and the delay doubles (with jitter, so overlapping workflows don't retry
+    in lockstep) up to max_delay, until deadline seconds have passed.
+    Errors no retry can fix (bad password, unknown database) raise at once.
+    With QUERY_LOG set, the connection's cursors record their queries (see
+    query_log.py).
     """
-    url = url or DB_URL
-    last_err = None
-    for attempt in range(1, retries + 1):
+    params = connect_params(url)
+    start = time.monotonic()
+    delay = base_delay
+    attempt = 1
+    while True:
         try:
-            conn = psycopg2.connect(url, connect_timeout=30)
+            conn = race_connect(params)
+            if query_log.enabled():
+                conn.cursor_factory = query_log.LoggedCursor
             if attempt > 1:
-                print(f"Connected on attempt {attempt}")
+                print(f"Connected on attempt {attempt} ({time.monotonic() - start:.1f}s)")
             return conn
-        except psycopg2.OperationalError as e:
-            last_err = e
-            if attempt < retries:
-                delay = base_delay * attempt
-                print(f"DB connection attempt {attempt} failed: {e}")
-                print(f"Retrying in {delay}s...")
-                time.sleep(delay)
-    raise last_err
-
-
-def sqlalchemy_engine_with_retry(url=None, retries=5, base_delay=15):
-    """Create a SQLAlchemy engine and verify connectivity with retries."""
-    from sqlalchemy import create_engine, text
+        except (psycopg2.OperationalError, OSError) as e:
+            if any(msg in str(e) for msg in FATAL_CONNECT_ERRORS):
+                raise
+            sleep = random.uniform(delay / 2, delay)
+            if time.monotonic() - start + sleep > deadline:
+                raise
+            print(f"DB connection attempt {attempt} failed: {str(e).strip()}")
+            print(f"Retrying in {sleep:.1f}s...")
+            time.sleep(sleep)
+            delay = min(max_delay, delay * 2)
+            attempt += 1
+
+
+def connect_in_background(url=None, **kwargs):
+    """Start connect_with_retry in a background thread; returns a Future.
+
+    Scripts that fetch over HTTP before writing call this first, so the
+    connection (and any retries) overlaps the fetch. Pass the Future to
+    resolve() when the connection is needed, or close_when_ready() if it
+    turns out not to be.
+    """
+    return in_background(connect_with_retry, url, **kwargs)
+
+
+def sqlalchemy_engine(url=None):
+    """SQLAlchemy engine whose pool opens connections with connect_with_retry.
+
+    Creating it does no I/O; the first checkout connects. The psycopg2
+    dialect is fixed because that is what connect_with_retry returns.
+    """
+    from sqlalchemy import create_engine
     url = url or DB_URL
-    last_err = None
-    for attempt in range(1, retries + 1):
-        try:
-            engine = create_engine(url, connect_args={"connect_timeout": 30})
-            with engine.connect() as test_conn:
-                test_conn.execute(text("SELECT 1"))
-            if attempt > 1:
-                print(f"Connected on attempt {attempt}")
-            return engine
-        except Exception as e:
-            last_err = e
-            if attempt < retries:
-                delay = base_delay * attempt
-                print(f"DB connection attempt {attempt} failed: {e}")
-                print(f"Retrying in {delay}s...")
-                time.sleep(delay)
-    raise last_err
+    return create_engine("postgresql+psycopg2://", creator=lambda: connect_with_retry(url))
+
+
+def sqlalchemy_engine_with_retry(url=None):
+    """Create a SQLAlchemy engine and verify connectivity (with retries)."""
+    from sqlalchemy import text
+    engine = sqlalchemy_engine(url)
+    with engine.connect() as test_conn:
+        test_conn.execute(text("SELECT 1"))
+    return engine
+
+
+def to_float(value):
+    """value as a float, or None.
+
+    Measurement columns are DOUBLE PRECISION once migrate_db has converted
+    them, but the conversion is online and its swap can be retried on a
+    later run; until then they come back as Decimal.
+    """
+    return None if value is None else float(value)
+
+
+# Rows are streamed to COPY in slices of this many rows
+COPY_CHUNK_ROWS = 50000
+
+
+def _copy_text(value):
+    """Format one value for COPY ... FROM STDIN (text format)."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def copy_to_stage(cursor, table, columns, rows):
+    """COPY rows into a temporary table shaped like table's columns.
+
+    The staging table (returned by name) also has a _seq column numbering
+    the rows in order. The caller drops it when done.
+    """
+    stage = f"_stage_{table}"
+    cols = ", ".join(columns)
+    cursor.execute(f"""
+        DROP TABLE IF EXISTS {stage};
+        CREATE TEMP TABLE {stage} AS SELECT {cols} FROM {table} WITH NO DATA;
+        ALTER TABLE {stage} ADD COLUMN _seq BIGSERIAL;
+    """)
+    for start in range(0, len(rows), COPY_CHUNK_ROWS):
+        buf = io.StringIO()
+        for row in rows[start:start + COPY_CHUNK_ROWS]:
+            buf.write("\t".join(_copy_text(v) for v in row))
+            buf.write("\n")
+        buf.seek(0)
+        cursor.copy_expert(f"COPY {stage} ({cols}) FROM STDIN", buf)
+    return stage
+
+
+def copy_upsert(cursor, table, columns, rows, conflict, action="DO NOTHING"):
+    """Bulk upsert rows into table through a COPY-loaded staging table.
+
+    Rows are streamed with COPY ... FROM STDIN into a temporary table shaped
+    like the target columns, then merged with a single set-based
+    INSERT ... SELECT ... ON CONFLICT (conflict) <action>. action is written
+    exactly as it would be after ON CONFLICT in a VALUES upsert (it can refer
+    to table and EXCLUDED). If a key appears more than once, the last row
+    wins, as it did when later execute_values pages overwrote earlier ones.
+
+    Returns the number of rows inserted or updated.
+    """
+    if not rows:
+        return 0
+    stage = copy_to_stage(cursor, table, columns, rows)
+    cols = ", ".join(columns)
+    keys = ", ".join(conflict)
+
+    cursor.execute(f"""
+        INSERT INTO {table} ({cols})
+        SELECT DISTINCT ON ({keys}) {cols} FROM {stage}
+        ORDER BY {keys}, _seq DESC
+        ON CONFLICT ({keys}) {action}
+    """)
+    affected = cursor.rowcount
+    cursor.execute(f"DROP TABLE {stage};")
+    return affected
@@ -1,46 +1,35 @@
 """Download Lake Sammamish profile and meteorological data from King County.
 
-Uses the DataScrape.aspx GET endpoint which returns HTML tables.
-Parses the tables and writes tab-delimited files compatible with import_data.py.
+Uses the DataScrape.aspx GET endpoint which returns HTML tables, parses the
+current month's tables into records and upserts them into Supabase in the
+same process (see import_data.import_records). Pages go through the
+datascrape cache; if a page is byte-identical to the one last imported it is
+neither parsed nor sent to the database.
+
+--tsv additionally writes SammamishProfile.txt / SammamishMet.txt in the
+format import_data.py reads, for debugging; --no-import only writes them.
 """
 
-import requests
-from bs4 import BeautifulSoup
+import os
+import json
+import argparse
 from datetime import datetime
+from dotenv import load_dotenv
+from datascrape import fetch_page, parse_table, is_imported, mark_imported
+from buoy_records import iter_profile_records, iter_met_records
+from archive import archive_table
 
-BASE_URL = "https://green2.kingcounty.gov/lake-buoy/DataScrape.aspx"
+load_dotenv()
+DB_URL = os.getenv("SUPABASE_DB_URL")
 
 now = datetime.now()
 current_year = str(now.year)
 current_month = str(now.month)
 
-
-def fetch_month(year, month, data_type="profile"):
-    """Fetch data for a single month. Returns (headers, rows)."""
-    params = {
-        "type": data_type,
-        "buoy": "sammamish",
-        "year": str(year),
-        "month": str(month),
-    }
-    resp = requests.get(BASE_URL, params=params)
-    resp.raise_for_status()
-
-    soup = BeautifulSoup(resp.text, "html.parser")
-    table = soup.find("table")
-    if not table:
-        print(f"  No data table found for {data_type} {year}-{int(month):02d}")
-        return [], []
-
-    headers = [th.get_text(strip=True) for th in table.find_all("th")]
-
-    rows = []
-    for tr in table.find_all("tr")[1:]:
-        cells = [td.get_text(strip=True) for td in tr.find_all("td")]
-        if cells and len(cells) == len(headers):
-            rows.append(cells)
-
-    return headers, rows
+SOURCES = (
+    ("profile", "SammamishProfile.txt", iter_profile_records),
+    ("met", "SammamishMet.txt", iter_met_records),
+)
 
 
 def write_tsv(filepath, headers, all_rows):
@@ -51,21 +40,97 @@ def write_tsv(filepath, headers, all_rows):
             f.write("\t".join(row) + "\n")
 
 
+def write_source(filepath, data_type, year, month, content_hash):
+    """Record which page produced filepath so import_data can mark it imported."""
+    with open(filepath + ".source.json", "w") as f:
+        json.dump({"data_type": data_type, "year": int(year), "month": int(month),
+                   "content_hash": content_hash}, f)
+
+
+def download(data_type, filepath, parse, force=False, tsv=False, load=True):
+    """Fetch the current month for data_type.
+
+    Returns (records, content_hash); records is None when the page is
+    unchanged since the last import (only checked when load is set, so
+    --no-import always writes the file). With tsv, the table is also
+    written to filepath.
+    """
+    print(f"Fetching {data_type} data for {current_year}-{int(current_month):02d}...")
+    text, content_hash = fetch_page(current_year, current_month, data_type)
+    if load and not force and is_imported(current_year, current_month, data_type, content_hash):
+        print("  Page unchanged since last import, skipping.")
+        return None, content_hash
+
+    headers, rows = parse_table(text)
+    archive_table(f"kingcounty_{data_type}", current_year, current_month, headers, rows)
+    if not rows:
+        print(f"  No {data_type} data available.")
+        return [], content_hash
+
+    if tsv:
+        write_tsv(filepath, headers, rows)
+        write_source(filepath, data_type, current_year, current_month, content_hash)
+        print(f"  Saved {filepath} ({len(rows)} rows)")
+    return list(parse(headers, rows)), content_hash
+
+
+def main(force=False, tsv=False, load=True, overlap_hours=None, full=False, conn=None):
+    """Fetch the current month and import it.
+
+    conn is a connection or a Future for one (left open either way). By
+    default a connection is opened in the background while the pages
+    download, and closed at the end.
+    """
+    # Deferred so --no-import runs don't need the database driver
+    if load:
+        from db_utils import connect_in_background, resolve, close_when_ready
+        from import_data import import_records, IMPORT_OVERLAP_HOURS
+
+    own_conn = load and conn is None
+    if own_conn:
+        conn = connect_in_background(DB_URL)
+    try:
+        records = {}
+        for data_type, filepath, parse in SOURCES:
+            batch, content_hash = download(data_type, filepath, parse, force, tsv or not load, load)
+            if batch is not None:
+                records[data_type] = (batch, content_hash)
+
+        if not load:
+            return
+        if not records:
+            print("Nothing new to import.")
+            return
+
+        conn = resolve(conn)
+        cursor = conn.cursor()
+        profile = records.get("profile", (None, None))[0]
+        met = records.get("met", (None, None))[0]
+        import_records(cursor, profile, met,
+                       IMPORT_OVERLAP_HOURS if overlap_hours is None else overlap_hours, full)
+        conn.commit()
+        cursor.close()
+    finally:
+        if own_conn:
+            close_when_ready(conn)
+
+    for data_type, (_, content_hash) in records.items():
+        mark_imported(current_year, current_month, data_type, content_hash)
+    print("Import complete.")
+
+
 if __name__ == "__main__":
-    # Download profile data
-    print(f"Fetching profile data for {current_year}-{int(current_month):02d}...")
-    headers, rows = fetch_month(current_year, current_month, "profile")
-    if rows:
-        write_tsv("SammamishProfile.txt", headers, rows)
-        print(f"  Saved SammamishProfile.txt ({len(rows)} rows)")
-    else:
-        print("  No profile data available.")
-
-    # Download meteorological data
-    print(f"Fetching met data for {current_year}-{int(current_month):02d}...")
-    headers, rows = fetch_month(current_year, current_month, "met")
-    if rows:
-        write_tsv("SammamishMet.txt", headers, rows)
-        print(f"  Saved SammamishMet.txt ({len(rows)} rows)")
-    else:
-        print("  No met data available.")
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--force", action="store_true",
+                        help="import (or write) pages even if they match the last import")
+    parser.add_argument("--tsv", action="store_true",
+                        help="also write SammamishProfile.txt / SammamishMet.txt")
+    parser.add_argument("--no-import", dest="load", action="store_false",
+                        help="only write the TSV files; don't touch the database")
+    parser.add_argument("--overlap-hours", type=int, default=None,
+                        help="re-send readings this far behind the stored watermark")
+    parser.add_argument("--full", action="store_true",
+                        help="ignore watermarks and upsert every parsed row")
+    args = parser.parse_args()
+    main(force=args.force, tsv=args.tsv, load=args.load,
+         overlap_hours=args.overlap_hours, full=args.full)
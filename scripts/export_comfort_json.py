@@ -11,96 +11,106 @@ import pandas as pd
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
 from db_utils import sqlalchemy_engine_with_retry
+from compute_comfort import LATEST_RUN
 
 load_dotenv()
 DB_URL = os.getenv("SUPABASE_DB_URL")
 
-engine = sqlalchemy_engine_with_retry(DB_URL)
-conn = engine.connect()
+
+def df_to_records(df):
+    """Convert DataFrame to list of dicts with ISO date strings."""
+    records = json.loads(df.to_json(orient="records", date_format="iso"))
+    return records
+
+
+# Every query reads the latest comfort_run's hours (LATEST_RUN). The queries
+# run in one REPEATABLE READ transaction, so they all see the same run.
 
 # Comfort forecast: yesterday through +8 days
-df_forecast = pd.read_sql("""
+QUERY_FORECAST = f"""
 SELECT score_time, overall_score, label,
        water_temp_score, air_temp_score, wind_score, sun_score,
        rain_score, clarity_score, algae_score, aqi_score,
        override_reason, input_snapshot
-FROM comfort_score
+FROM comfort_score JOIN {LATEST_RUN}
+  ON score_time BETWEEN run.first_hour AND run.last_hour
 WHERE score_time >= DATE_TRUNC('day', NOW()) - INTERVAL '1 day'
   AND score_time < DATE_TRUNC('day', NOW()) + INTERVAL '9 days'
 ORDER BY score_time;
-""", conn)
+"""
 
-# Current comfort: closest entry to now, from the most recent compute run only.
-# Restricting to MAX(computed_at) prevents stale rows from older fetch generations
-# from being selected over fresher rows for the same score_time.
-df_current = pd.read_sql("""
+# Current comfort: the entry of the latest run closest to now
+QUERY_CURRENT = f"""
 SELECT score_time, overall_score, label,
        water_temp_score, air_temp_score, wind_score, sun_score,
        rain_score, clarity_score, algae_score, aqi_score,
        override_reason, input_snapshot
-FROM comfort_score
-WHERE computed_at = (SELECT MAX(computed_at) FROM comfort_score)
+FROM comfort_score JOIN {LATEST_RUN}
+  ON score_time BETWEEN run.first_hour AND run.last_hour
 ORDER BY ABS(EXTRACT(EPOCH FROM (score_time - (NOW() AT TIME ZONE 'America/Los_Angeles'))))
 LIMIT 1;
-""", conn)
+"""
 
 # Data freshness metadata
-df_meta = pd.read_sql("""
+QUERY_META = f"""
 SELECT
     TO_CHAR((SELECT MAX(date) FROM lake_data WHERE depth_m < 1.5 AND temperature_c IS NOT NULL),
             'YYYY-MM-DD"T"HH24:MI:SS') AS latest_buoy,
-    TO_CHAR(NOW() AT TIME ZONE 'America/Los_Angeles', 'YYYY-MM-DD"T"HH24:MI:SS') AS generated_at;
-""", conn)
+    TO_CHAR(NOW() AT TIME ZONE 'America/Los_Angeles', 'YYYY-MM-DD"T"HH24:MI:SS') AS generated_at,
+    (SELECT run_id FROM {LATEST_RUN}) AS comfort_run_id,
+    (SELECT TO_CHAR(computed_at, 'YYYY-MM-DD"T"HH24:MI:SS') FROM {LATEST_RUN}) AS comfort_computed_at;
+"""
 
-# Historical weather averages (±7 DOY window)
-df_hist = pd.read_sql("""
+# Historical weather norms for today's day of year (climatology_doy)
+# (rounded as numeric, which rounds halves away from zero, then back to float)
+QUERY_HIST_WEATHER = """
 SELECT
-    ROUND(CAST(AVG(max_air_c) * 9.0/5.0 + 32 AS NUMERIC), 1) AS avg_feels_like_f,
-    ROUND(CAST(AVG(avg_wind_ms) * 2.237 AS NUMERIC), 1) AS avg_wind_mph,
-    ROUND(CAST(AVG(max_solar_w) AS NUMERIC), 0) AS avg_solar_w,
-    ROUND(CAST(AVG(total_precip_mm) * 15 AS NUMERIC), 0) AS avg_rain_pct,
-    ROUND(CAST(AVG(avg_aqi) AS NUMERIC), 0) AS avg_aqi
-FROM (
-    SELECT date::date AS day,
-           MAX(air_temperature_c) AS max_air_c,
-           AVG(wind_speed_ms) AS avg_wind_ms,
-           MAX(solar_radiation_w) AS max_solar_w,
-           SUM(precipitation_mm) AS total_precip_mm,
-           AVG(us_aqi) AS avg_aqi
-    FROM met_data
-    WHERE air_temperature_c IS NOT NULL
-      AND EXTRACT(YEAR FROM date) < EXTRACT(YEAR FROM NOW())
-      AND ABS(EXTRACT(DOY FROM date) - EXTRACT(DOY FROM NOW())) <= 7
-    GROUP BY date::date
-) daily;
-""", conn)
-
-conn.close()
+    ROUND((air_max_c * 9.0/5.0 + 32)::numeric, 1)::float8 AS avg_feels_like_f,
+    ROUND((wind_ms * 2.237)::numeric, 1)::float8 AS avg_wind_mph,
+    ROUND(solar_w::numeric)::float8 AS avg_solar_w,
+    ROUND((precip_mm * 15)::numeric)::float8 AS avg_rain_pct,
+    ROUND(aqi::numeric)::float8 AS avg_aqi
+FROM climatology_doy
+WHERE doy = EXTRACT(DOY FROM LOCALTIMESTAMP);
+"""
 
 
-def df_to_records(df):
-    """Convert DataFrame to list of dicts with ISO date strings."""
-    records = json.loads(df.to_json(orient="records", date_format="iso"))
-    return records
+def main(engine=None):
+    """Query the database and write docs/comfort-data.json.
+
+    engine is an existing SQLAlchemy engine to borrow a connection from
+    (run_pipeline.py shares one); by default a new one is created.
+    """
+    engine = engine or sqlalchemy_engine_with_retry(DB_URL)
+    conn = engine.connect().execution_options(isolation_level="REPEATABLE READ")
+
+    df_forecast = pd.read_sql(QUERY_FORECAST, conn)
+    df_current = pd.read_sql(QUERY_CURRENT, conn)
+    df_meta = pd.read_sql(QUERY_META, conn)
+    df_hist = pd.read_sql(QUERY_HIST_WEATHER, conn)
+    conn.close()
+
+    forecast_records = df_to_records(df_forecast)
+    current_records = df_to_records(df_current)
+    meta_records = df_to_records(df_meta)
+    hist_records = df_to_records(df_hist)
 
+    output = {
+        "generated_at": meta_records[0]["generated_at"] if meta_records else None,
+        "current": current_records[0] if current_records else None,
+        "forecast": forecast_records,
+        "meta": meta_records[0] if meta_records else {},
+        "hist_weather": hist_records[0] if hist_records else {},
+    }
 
-forecast_records = df_to_records(df_forecast)
-current_records = df_to_records(df_current)
-meta_records = df_to_records(df_meta)
-hist_records = df_to_records(df_hist)
+    output_path = "docs/comfort-data.json"
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-output = {
-    "generated_at": meta_records[0]["generated_at"] if meta_records else None,
-    "current": current_records[0] if current_records else None,
-    "forecast": forecast_records,
-    "meta": meta_records[0] if meta_records else {},
-    "hist_weather": hist_records[0] if hist_records else {},
-}
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(output, f, separators=(",", ":"))
 
-output_path = "docs/comfort-data.json"
-os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    print(f"Successfully wrote {output_path} ({len(forecast_records)} forecast entries)")
 
-with open(output_path, "w", encoding="utf-8") as f:
-    json.dump(output, f, separators=(",", ":"))
 
-print(f"Successfully wrote {output_path} ({len(forecast_records)} forecast entries)")
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,23 @@
-"""Fetch 7-day weather and air quality forecasts from Open-Meteo."""
+"""Fetch 7-day weather and air quality forecasts from Open-Meteo.
+
+Each fetch is recorded in forecast_fetch and its hours are appended to
+weather_forecast (thinned later by compact_forecast.py). With the default
+"delta" storage (FORECAST_STORAGE), only hours whose values differ from the
+previous stored fetch are written; "full" writes every hour of every fetch.
+Either way weather_forecast_as_of(fetched_at) returns a fetch in full (see
+migrate_db.py). The fetch also replaces the rows for the same hours in
+weather_forecast_latest, which is what the comfort model reads.
+"""
 
 import os
 import requests
-import psycopg2
-import psycopg2.extras
 from datetime import datetime
 from dotenv import load_dotenv
-from db_utils import connect_with_retry
+from db_utils import connect_in_background, resolve, close_when_ready, copy_to_stage, copy_upsert
 
 load_dotenv()
 DB_URL = os.getenv("SUPABASE_DB_URL")
+FORECAST_STORAGE = os.getenv("FORECAST_STORAGE", "delta")
 
 # Lake Sammamish coordinates
 LAT = 47.5912
@@ -18,6 +26,20 @@ LON = -122.0906
 WEATHER_URL = "https://api.open-meteo.com/v1/forecast"
 AQI_URL = "https://air-quality-api.open-meteo.com/v1/air-quality"
 
+FORECAST_COLUMNS = (
+    "forecast_time", "fetched_at",
+    "temperature_f", "feels_like_f", "wind_speed_mph", "wind_direction_deg",
+    "precip_probability", "cloud_cover", "uv_index", "solar_radiation_w",
+    "us_aqi", "pm25",
+)
+
+VALUE_COLUMNS = FORECAST_COLUMNS[2:]
+
+# A row in weather_forecast_latest is only replaced by a newer fetch
+LATEST_UPDATE = "DO UPDATE SET " + ", ".join(
+    f"{c} = EXCLUDED.{c}" for c in FORECAST_COLUMNS[1:]
+) + " WHERE EXCLUDED.fetched_at >= weather_forecast_latest.fetched_at"
+
 
 def fetch_weather():
     """Fetch hourly weather forecast for next 8 days."""
@@ -58,9 +80,52 @@ def fetch_aqi():
     return resp.json()
 
 
-def merge_and_upsert(weather_data, aqi_data):
-    """Merge weather and AQI data, upsert into weather_forecast table."""
-    conn = connect_with_retry(DB_URL)
+def store_fetch(cursor, batch, storage=FORECAST_STORAGE):
+    """Write one fetch (rows in FORECAST_COLUMNS order, all with the same fetched_at).
+
+    storage is "delta" or "full". Returns the number of hours written to
+    weather_forecast. The caller commits.
+    """
+    stage = copy_to_stage(cursor, "weather_forecast", FORECAST_COLUMNS, batch)
+    if storage == "full":
+        changed = "TRUE"
+    else:
+        changed = (f"prev.forecast_time IS NULL OR ROW({', '.join('s.' + c for c in VALUE_COLUMNS)}) "
+                   f"IS DISTINCT FROM ROW({', '.join('prev.' + c for c in VALUE_COLUMNS)})")
+    cursor.execute(f"""
+        INSERT INTO weather_forecast ({", ".join(FORECAST_COLUMNS)})
+        SELECT {", ".join("s." + c for c in FORECAST_COLUMNS)}
+        FROM {stage} s
+        LEFT JOIN LATERAL (
+            SELECT * FROM weather_forecast w
+            WHERE w.forecast_time = s.forecast_time AND w.fetched_at < s.fetched_at
+            ORDER BY w.fetched_at DESC
+            LIMIT 1
+        ) prev ON TRUE
+        WHERE {changed}
+        ON CONFLICT (forecast_time, fetched_at) DO NOTHING;
+    """)
+    stored = cursor.rowcount
+    cursor.execute(f"""
+        INSERT INTO forecast_fetch (fetched_at, first_hour, last_hour, hours, stored, storage)
+        SELECT fetched_at, MIN(forecast_time), MAX(forecast_time), COUNT(*), %s, %s
+        FROM {stage} GROUP BY fetched_at
+        ON CONFLICT (fetched_at) DO NOTHING;
+        DROP TABLE {stage};
+    """, (stored, storage))
+    copy_upsert(cursor, "weather_forecast_latest", FORECAST_COLUMNS, batch,
+                ("forecast_time",), LATEST_UPDATE)
+    return stored
+
+
+def merge_and_upsert(weather_data, aqi_data, conn=None):
+    """Merge weather and AQI data, upsert into weather_forecast and weather_forecast_latest.
+
+    conn is a connection or a Future for one (left open either way);
+    otherwise a connection is opened and closed here.
+    """
+    own_conn = conn is None
+    conn = resolve(connect_in_background(DB_URL) if own_conn else conn)
     cursor = conn.cursor()
 
     w_hourly = weather_data["hourly"]
@@ -95,36 +160,40 @@ def merge_and_upsert(weather_data, aqi_data):
             aqi.get("pm25"),
         ))
 
-    if batch:
-        psycopg2.extras.execute_values(
-            cursor,
-            """
-            INSERT INTO weather_forecast (
-                forecast_time, fetched_at,
-                temperature_f, feels_like_f, wind_speed_mph, wind_direction_deg,
-                precip_probability, cloud_cover, uv_index, solar_radiation_w,
-                us_aqi, pm25
-            ) VALUES %s
-            ON CONFLICT (forecast_time, fetched_at) DO NOTHING;
-            """,
-            batch,
-            page_size=200
-        )
+    stored = store_fetch(cursor, batch)
+    print(f"  Stored {stored} of {len(batch)} hours ({FORECAST_STORAGE} storage).")
 
     conn.commit()
     cursor.close()
-    conn.close()
+    if own_conn:
+        conn.close()
     return len(batch)
 
 
-if __name__ == "__main__":
-    print("Fetching weather forecast...")
-    weather = fetch_weather()
-    print(f"  Got {len(weather['hourly']['time'])} hourly weather records")
+def main(conn=None):
+    """Fetch both forecasts and upsert them.
 
-    print("Fetching air quality forecast...")
-    aqi = fetch_aqi()
-    print(f"  Got {len(aqi['hourly']['time'])} hourly AQI records")
+    conn is a connection or a Future for one; by default the connection is
+    opened in the background while the forecasts download.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = connect_in_background(DB_URL)
+    try:
+        print("Fetching weather forecast...")
+        weather = fetch_weather()
+        print(f"  Got {len(weather['hourly']['time'])} hourly weather records")
 
-    count = merge_and_upsert(weather, aqi)
-    print(f"  Upserted {count} forecast rows.")
+        print("Fetching air quality forecast...")
+        aqi = fetch_aqi()
+        print(f"  Got {len(aqi['hourly']['time'])} hourly AQI records")
+
+        count = merge_and_upsert(weather, aqi, conn)
+        print(f"  Upserted {count} forecast rows.")
+    finally:
+        if own_conn:
+            close_when_ready(conn)
+
+
+if __name__ == "__main__":
+    main()
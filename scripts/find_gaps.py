@@ -0,0 +1,222 @@
+"""Find missing intervals in lake_data / met_data and refetch only those.
+
+Each series is bucketed (hourly or daily) over the requested range.
+generate_series supplies every expected bucket, and an anti-join against the
+buckets that have rows gives the missing ones. Gaps-and-islands then
+collapses consecutive missing buckets into intervals. All of this happens
+in one query per series, in the database.
+
+    python scripts/find_gaps.py                      # coverage + gap report
+    python scripts/find_gaps.py --start 2024-01-01 --min-hours 6
+    python scripts/find_gaps.py --fetch              # refetch months with gaps
+
+With --fetch, King County months that have buoy gaps are requested again
+(conditionally, even for closed months whose page is cached) at the
+backfill's rate limit, and upserted if the page changed since its last
+import; backfill_progress records the refill. Months with met_data gaps
+that the buoy can't fill are refetched from the Open-Meteo archive.
+"""
+
+import os
+import argparse
+from collections import namedtuple
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from db_utils import connect_with_retry
+
+load_dotenv()
+DB_URL = os.getenv("SUPABASE_DB_URL")
+
+START_DATE = "2021-01-01"
+
+# Gaps shorter than this are ignored (a skipped cast, the spring-forward hour)
+MIN_GAP_HOURS = 3
+
+# name, table, row filter, bucket unit, refetch source
+Series = namedtuple("Series", "name table where bucket source")
+
+SERIES = (
+    # Profiles are cast a few times a day, so a missing day is the signal
+    Series("lake_data", "lake_data", "TRUE", "day", "kingcounty_profile"),
+    # Open-Meteo rows never carry pressure, so this is the buoy's own coverage
+    Series("met_data (buoy)", "met_data", "pressure_mb IS NOT NULL", "hour", "kingcounty_met"),
+    Series("met_data (any)", "met_data", "TRUE", "hour", "openmeteo"),
+)
+
+MISSING_CTE = """
+    WITH expected AS (
+        SELECT generate_series(date_trunc('{bucket}', %(start)s::timestamp),
+                               %(end)s::timestamp - interval '1 {bucket}',
+                               interval '1 {bucket}') AS bucket
+    ), present AS (
+        SELECT DISTINCT date_trunc('{bucket}', date) AS bucket
+        FROM {table}
+        WHERE date >= %(start)s AND date < %(end)s AND {where}
+    ), missing AS (
+        SELECT e.bucket
+        FROM expected e
+        LEFT JOIN present p ON p.bucket = e.bucket
+        WHERE p.bucket IS NULL
+    ), islands AS (
+        SELECT bucket,
+               bucket - (ROW_NUMBER() OVER (ORDER BY bucket)) * interval '1 {bucket}' AS island
+        FROM missing
+    ), gaps AS (
+        SELECT MIN(bucket) AS gap_start,
+               MAX(bucket) + interval '1 {bucket}' AS gap_end
+        FROM islands
+        GROUP BY island
+        HAVING MAX(bucket) + interval '1 {bucket}' - MIN(bucket)
+               >= make_interval(hours => %(min_hours)s)
+    )
+"""
+
+
+def find_gaps(cursor, series, start, end, min_hours=MIN_GAP_HOURS):
+    """Return (expected buckets, present buckets, [(gap_start, gap_end)])."""
+    params = {"start": start, "end": end, "min_hours": min_hours}
+    cte = MISSING_CTE.format(bucket=series.bucket, table=series.table, where=series.where)
+    cursor.execute(cte + """
+        SELECT (SELECT COUNT(*) FROM expected),
+               (SELECT COUNT(*) FROM present),
+               COALESCE((SELECT array_agg(ARRAY[gap_start, gap_end] ORDER BY gap_start)
+                         FROM gaps), '{}');
+    """, params)
+    expected, present, gaps = cursor.fetchone()
+    return expected, present, [tuple(g) for g in gaps]
+
+
+def gap_months(gaps):
+    """Sorted (year, month) pairs touched by any gap."""
+    months = set()
+    for gap_start, gap_end in gaps:
+        month = gap_start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        while month < gap_end:
+            months.add((month.year, month.month))
+            month = (month + timedelta(days=32)).replace(day=1)
+    return sorted(months)
+
+
+def print_report(series, expected, present, gaps):
+    pct = 100.0 * present / expected if expected else 100.0
+    missing = sum((end - start for start, end in gaps), timedelta())
+    print(f"\n{series.name}: {present}/{expected} {series.bucket}s covered ({pct:.1f}%), "
+          f"{len(gaps)} gaps totalling {missing.total_seconds() / 3600:.0f}h")
+    for gap_start, gap_end in gaps:
+        hours = (gap_end - gap_start).total_seconds() / 3600
+        print(f"  {gap_start:%Y-%m-%d %H:%M} -> {gap_end:%Y-%m-%d %H:%M}  ({hours:.0f}h)")
+
+
+def refetch_kingcounty(conn, data_type, months):
+    """Revalidate King County month pages and upsert the ones that changed."""
+    import backfill_buoy as kc
+    from datascrape import fetch_page, parse_table, is_imported, mark_imported
+    from http_utils import TokenBucket, FetchClient
+    from archive import archive_table
+    from backfill_progress import register_units, finish_unit, fail_unit
+
+    periods = [kc.period_of(year, month) for year, month in months]
+    register_units(conn, kc.SOURCE, [(data_type, period) for period in periods])
+    client = FetchClient(TokenBucket(kc.REQUESTS_PER_SECOND), timeout=30)
+    cursor = conn.cursor()
+    for (year, month), period in zip(months, periods):
+        label = f"{data_type} {period}"
+        try:
+            # A cached closed month would just be re-imported as it was
+            text, content_hash = fetch_page(year, month, data_type, client=client, revalidate=True)
+            if is_imported(year, month, data_type, content_hash):
+                finish_unit(cursor, kc.SOURCE, data_type, period, None, content_hash)
+                conn.commit()
+                print(f"  {label}: unchanged upstream, gaps remain")
+                continue
+            headers, rows = parse_table(text)
+            archive_table(f"kingcounty_{data_type}", year, month, headers, rows)
+            batch = list(kc.PARSERS[data_type](headers, rows)) if rows else []
+            if batch:
+                kc.UPSERTS[data_type](cursor, batch)
+            finish_unit(cursor, kc.SOURCE, data_type, period, len(batch), content_hash)
+            conn.commit()
+            mark_imported(year, month, data_type, content_hash)
+            print(f"  {label}: {len(batch)} rows")
+        except Exception as e:
+            conn.rollback()
+            fail_unit(conn, kc.SOURCE, data_type, period, f"{type(e).__name__}: {e}")
+            print(f"  {label}: ERROR {e}")
+    cursor.close()
+
+
+def refetch_openmeteo(conn, months):
+    """Refetch Open-Meteo archive windows for the given months."""
+    from concurrent.futures import ThreadPoolExecutor
+    import backfill_openmeteo as om
+    from http_utils import TokenBucket, FetchClient, AdaptiveChunker
+    from backfill_progress import register_units, finish_unit, fail_unit
+
+    end_limit = (datetime.now() - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    first = datetime.strptime(om.START_DATE, "%Y-%m-%d").replace(day=1)
+    claims = [(om.DATA_TYPE, f"{y}-{m:02d}") for y, m in months
+              if first <= datetime(y, m, 1) <= end_limit]
+    register_units(conn, om.SOURCE, claims)
+    client = FetchClient(TokenBucket(om.REQUESTS_PER_SECOND, burst=2),
+                         retries=om.MAX_RETRIES, timeout=om.REQUEST_TIMEOUT)
+    chunker = AdaptiveChunker(om.INITIAL_CHUNK_MONTHS, maximum=om.MAX_CHUNK_MONTHS,
+                              target_seconds=om.TARGET_SECONDS, max_bytes=om.TARGET_BYTES)
+    cursor = conn.cursor()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for periods in om.consecutive_groups(iter(claims), chunker):
+            try:
+                results = om.backfill_months(cursor, pool, client, chunker, periods, end_limit)
+                for period, (count, _, content_hash) in results.items():
+                    finish_unit(cursor, om.SOURCE, om.DATA_TYPE, period, count, content_hash)
+                conn.commit()
+            except Exception as e:
+                print(f"  ERROR: {e}")
+                conn.rollback()
+                for period in periods:
+                    fail_unit(conn, om.SOURCE, om.DATA_TYPE, period, f"{type(e).__name__}: {e}")
+    cursor.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--start", default=START_DATE, help="first day (default: %(default)s)")
+    parser.add_argument("--end", default=None, help="end day, exclusive (default: now)")
+    parser.add_argument("--min-hours", type=int, default=MIN_GAP_HOURS,
+                        help="ignore gaps shorter than this (default: %(default)s)")
+    parser.add_argument("--fetch", action="store_true",
+                        help="refetch the months that have gaps")
+    args = parser.parse_args()
+
+    start = datetime.strptime(args.start, "%Y-%m-%d")
+    end = (datetime.strptime(args.end, "%Y-%m-%d") if args.end
+           else datetime.now().replace(minute=0, second=0, microsecond=0))
+
+    conn = connect_with_retry(DB_URL)
+    cursor = conn.cursor()
+
+    gaps_by_source = {}
+    for series in SERIES:
+        expected, present, gaps = find_gaps(cursor, series, start, end, args.min_hours)
+        print_report(series, expected, present, gaps)
+        gaps_by_source[series.source] = gaps
+    conn.commit()
+    cursor.close()
+
+    if args.fetch:
+        # The buoy is refetched first; only what it can't fill goes to Open-Meteo
+        for data_type in ("profile", "met"):
+            months = gap_months(gaps_by_source[f"kingcounty_{data_type}"])
+            if months:
+                print(f"\nRefetching {len(months)} King County {data_type} months...")
+                refetch_kingcounty(conn, data_type, months)
+
+        cursor = conn.cursor()
+        _, _, gaps = find_gaps(cursor, SERIES[2], start, end, args.min_hours)
+        conn.commit()
+        cursor.close()
+        months = gap_months(gaps)
+        if months:
+            print(f"\nRefetching {len(months)} Open-Meteo months...")
+            refetch_openmeteo(conn, months)
+
+    conn.close()
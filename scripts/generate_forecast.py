@@ -4,7 +4,7 @@ Uses historical buoy data (water temp, turbidity, algae) and historical
 weather norms to project daily peak comfort scores forward 6 months.
 
 The approach:
-1. Query historical water temps by day-of-year, averaged across all years
+1. Look up smoothed historical water temps by day-of-year (climatology_doy)
 2. Query this year's water temp trend to compute a warm/cold bias
 3. Use historical weather norms (air temp, wind, sun, rain) by day-of-year
 4. Run the comfort scoring model for each future day using projected values
@@ -14,21 +14,13 @@ The approach:
 import os
 import json
 import math
-import socket
 import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 from sqlalchemy import create_engine, text
-from db_utils import sqlalchemy_engine_with_retry
-
-# Force IPv4 to avoid IPv6 connectivity issues on GitHub Actions
-_original_getaddrinfo = socket.getaddrinfo
-def _ipv4_getaddrinfo(*args, **kwargs):
-    responses = _original_getaddrinfo(*args, **kwargs)
-    ipv4 = [r for r in responses if r[0] == socket.AF_INET]
-    return ipv4 if ipv4 else responses
-socket.getaddrinfo = _ipv4_getaddrinfo
+from db_utils import sqlalchemy_engine_with_retry, to_float
+from compute_comfort import LATEST_RUN
 
 load_dotenv()
 DB_URL = os.getenv("SUPABASE_DB_URL")
@@ -109,23 +101,98 @@ def label_for_score(score):
 
 
 # --- Data queries ---
+# lake_data and met_data dates are Pacific local time; local_day and
+# day_of_year are stored columns over them, set by a trigger (see migrate_db.py).
+# Daily figures come from daily_surface / daily_met (see daily_summary.py),
+# smoothed day-of-year norms from climatology_doy (see climatology.py).
+# comfort_score.score_time is Pacific local time too, so it is compared with
+# NOW() AT TIME ZONE 'America/Los_Angeles' and grouped by score_time::date.
+
+QUERY_HIST_WATER = """
+SELECT doy, water_max_c FROM climatology_doy
+WHERE water_max_c IS NOT NULL
+ORDER BY doy;
+"""
+
+QUERY_YEAR_BIAS = """
+WITH current_period AS (
+    SELECT day_of_year AS doy,
+           AVG(temperature_c) AS avg_temp_c
+    FROM lake_data
+    WHERE depth_m < 1.5
+      AND temperature_c IS NOT NULL
+      AND date >= LOCALTIMESTAMP - INTERVAL '30 days'
+      AND date < LOCALTIMESTAMP
+    GROUP BY day_of_year
+),
+historical AS (
+    SELECT day_of_year AS doy,
+           SUM(sum_temp_c) / SUM(readings) AS avg_temp_c
+    FROM daily_surface
+    WHERE local_day < DATE_TRUNC('year', LOCALTIMESTAMP)
+      AND day_of_year IN (SELECT doy FROM current_period)
+    GROUP BY day_of_year
+)
+SELECT AVG(c.avg_temp_c - h.avg_temp_c) AS bias_c
+FROM current_period c
+JOIN historical h ON c.doy = h.doy;
+"""
+
+QUERY_WEATHER_NORMS = """
+SELECT doy, air_max_c, wind_ms, solar_w, precip_mm, aqi
+FROM climatology_doy
+ORDER BY doy;
+"""
+
+QUERY_LATEST_WATER = """
+SELECT temperature_c FROM lake_data
+WHERE depth_m < 1.5 AND temperature_c IS NOT NULL
+ORDER BY date DESC LIMIT 1;
+"""
+
+QUERY_YEAR_WATER = """
+SELECT local_day, max_temp_c
+FROM daily_surface
+WHERE local_day >= DATE_TRUNC('year', LOCALTIMESTAMP)
+ORDER BY local_day;
+"""
+
+QUERY_YEAR_WEATHER = """
+SELECT local_day AS day, max_air_c, avg_wind_ms, max_solar_w, total_precip_mm, avg_aqi
+FROM daily_met
+WHERE local_day >= DATE_TRUNC('year', LOCALTIMESTAMP)
+ORDER BY day;
+"""
+
+QUERY_COMFORT_ACTUALS = """
+SELECT score_time::date AS day,
+       MAX(overall_score) AS peak_score
+FROM comfort_score
+WHERE score_time >= DATE_TRUNC('year', NOW() AT TIME ZONE 'America/Los_Angeles')
+  AND score_time < NOW() AT TIME ZONE 'America/Los_Angeles'
+GROUP BY score_time::date
+ORDER BY day;
+"""
+
+# Pinned to the latest comfort_run's hours (see compute_comfort.LATEST_RUN)
+QUERY_SHORT_TERM_COMFORT = f"""
+SELECT score_time::date AS day,
+       MAX(overall_score) AS peak_score
+FROM comfort_score
+JOIN {LATEST_RUN}
+  ON score_time BETWEEN run.first_hour AND run.last_hour
+WHERE score_time >= DATE_TRUNC('day', NOW() AT TIME ZONE 'America/Los_Angeles')
+  AND score_time < DATE_TRUNC('day', NOW() AT TIME ZONE 'America/Los_Angeles') + INTERVAL '9 days'
+GROUP BY score_time::date
+ORDER BY day;
+"""
+
 
 def get_historical_water_temps(conn):
-    """Get max water temp by day-of-year across all historical years."""
-    result = conn.execute(text("""
-        SELECT doy, AVG(daily_max) AS avg_daily_max FROM (
-            SELECT EXTRACT(DOY FROM date) AS doy,
-                   EXTRACT(YEAR FROM date) AS yr,
-                   MAX(temperature_c) AS daily_max
-            FROM lake_data
-            WHERE depth_m < 1.5
-              AND temperature_c IS NOT NULL
-            GROUP BY EXTRACT(DOY FROM date), EXTRACT(YEAR FROM date)
-        ) sub
-        GROUP BY doy ORDER BY doy;
-    """))
+    """Get the smoothed daily max water temp norm by day-of-year."""
+    result = conn.execute(text(QUERY_HIST_WATER))
     rows = result.fetchall()
-    return {int(r[0]): float(r[1]) for r in rows}
+    return {int(r[0]): to_float(r[1]) for r in rows}
 
 
 def get_current_year_bias(conn):
@@ -138,103 +205,26 @@ def get_current_year_bias(conn):
     Returns the average difference (°F) between recent actuals and historical.
     Positive = warmer than normal, negative = colder.
     """
-    result = conn.execute(text("""
-        WITH current_period AS (
-            SELECT EXTRACT(DOY FROM date) AS doy,
-                   AVG(temperature_c) AS avg_temp_c
-            FROM lake_data
-            WHERE depth_m < 1.5
-              AND temperature_c IS NOT NULL
-              AND date >= NOW() - INTERVAL '30 days'
-              AND date < NOW()
-            GROUP BY EXTRACT(DOY FROM date)
-        ),
-        historical AS (
-            SELECT EXTRACT(DOY FROM date) AS doy,
-                   AVG(temperature_c) AS avg_temp_c
-            FROM lake_data
-            WHERE depth_m < 1.5
-              AND temperature_c IS NOT NULL
-              AND EXTRACT(YEAR FROM date) < EXTRACT(YEAR FROM NOW())
-            GROUP BY EXTRACT(DOY FROM date)
-        )
-        SELECT AVG(c.avg_temp_c - h.avg_temp_c) AS bias_c
-        FROM current_period c
-        JOIN historical h ON c.doy = h.doy;
-    """))
+    result = conn.execute(text(QUERY_YEAR_BIAS))
     row = result.fetchone()
     if row and row[0] is not None:
-        bias_c = float(row[0])
-        return bias_c * 9 / 5  # convert to Fahrenheit
+        return to_float(row[0]) * 9 / 5  # convert to Fahrenheit
     return 0.0
 
 
 def get_historical_weather_norms(conn):
-    """Get historical weather norms from met_data by day-of-year.
+    """Get historical weather norms by day-of-year from climatology_doy.
 
-    Uses daily MAX for air temp and solar (peak daytime values),
-    AVG for wind speed, SUM for precipitation, AVG for AQI.
-    Then averages across a +/-7 day window around each DOY to smooth noise.
+    Norms are daily MAX air temp and solar (peak daytime values), AVG wind
+    speed, SUM precipitation and AVG AQI, averaged per DOY and smoothed
+    over a +/-7 day window (see climatology.py).
     Returns dict of doy -> {air_temp_f, wind_mph, solar_w, precip_mm, aqi}
     """
-    # First get raw per-DOY averages
-    result = conn.execute(text("""
-        SELECT doy,
-               AVG(max_air_c) AS avg_max_air_c,
-               AVG(avg_wind_ms) AS avg_wind_ms,
-               AVG(max_solar_w) AS avg_max_solar_w,
-               AVG(total_precip_mm) AS avg_precip_mm,
-               AVG(avg_aqi) AS avg_aqi
-        FROM (
-            SELECT EXTRACT(DOY FROM date::date) AS doy,
-                   date::date AS day,
-                   MAX(air_temperature_c) AS max_air_c,
-                   AVG(wind_speed_ms) AS avg_wind_ms,
-                   MAX(solar_radiation_w) AS max_solar_w,
-                   SUM(precipitation_mm) AS total_precip_mm,
-                   AVG(us_aqi) AS avg_aqi
-            FROM met_data
-            WHERE air_temperature_c IS NOT NULL
-            GROUP BY EXTRACT(DOY FROM date::date), date::date
-        ) daily
-        GROUP BY doy ORDER BY doy;
-    """))
-    rows = result.fetchall()
-    raw = {}
-    for r in rows:
-        doy = int(r[0])
-        raw[doy] = {
-            "air_c": float(r[1]) if r[1] else None,
-            "wind_ms": float(r[2]) if r[2] else None,
-            "solar": float(r[3]) if r[3] else None,
-            "precip_mm": float(r[4]) if r[4] else None,
-            "aqi": float(r[5]) if r[5] else None,
-        }
-
-    # Smooth with a +/-7 day window around each DOY
-    WINDOW = 7
+    result = conn.execute(text(QUERY_WEATHER_NORMS))
     norms = {}
-    for doy in range(1, 366):
-        air_vals, wind_vals, solar_vals, precip_vals, aqi_vals = [], [], [], [], []
-        for offset in range(-WINDOW, WINDOW + 1):
-            neighbor = ((doy - 1 + offset) % 365) + 1
-            if neighbor in raw:
-                if raw[neighbor]["air_c"] is not None:
-                    air_vals.append(raw[neighbor]["air_c"])
-                if raw[neighbor]["wind_ms"] is not None:
-                    wind_vals.append(raw[neighbor]["wind_ms"])
-                if raw[neighbor]["solar"] is not None:
-                    solar_vals.append(raw[neighbor]["solar"])
-                if raw[neighbor]["precip_mm"] is not None:
-                    precip_vals.append(raw[neighbor]["precip_mm"])
-                if raw[neighbor]["aqi"] is not None:
-                    aqi_vals.append(raw[neighbor]["aqi"])
-        air_c = sum(air_vals) / len(air_vals) if air_vals else None
-        wind_ms = sum(wind_vals) / len(wind_vals) if wind_vals else None
-        solar = sum(solar_vals) / len(solar_vals) if solar_vals else None
-        precip_mm = sum(precip_vals) / len(precip_vals) if precip_vals else None
-        aqi = sum(aqi_vals) / len(aqi_vals) if aqi_vals else None
-        norms[doy] = {
+    for r in result.fetchall():
+        air_c, wind_ms, solar, precip_mm, aqi = map(to_float, r[1:])
+        norms[int(r[0])] = {
             "air_temp_f": round(air_c * 9/5 + 32, 1) if air_c else None,
             "wind_mph": round(wind_ms * 2.237, 1) if wind_ms else None,
             "solar_w": round(solar, 0) if solar else None,
@@ -286,48 +276,23 @@ if __name__ == "__main__":
     print(f"Historical weather norms: {len(weather_norms)} days-of-year")
 
     # Get latest actual water temp for starting point
-    row = conn.execute(text("""
-        SELECT temperature_c FROM lake_data
-        WHERE depth_m < 1.5 AND temperature_c IS NOT NULL
-        ORDER BY date DESC LIMIT 1;
-    """)).fetchone()
-    latest_water_f = round(float(row[0]) * 9/5 + 32, 1) if row else None
+    row = conn.execute(text(QUERY_LATEST_WATER)).fetchone()
+    latest_water_f = round(to_float(row[0]) * 9/5 + 32, 1) if row else None
     print(f"Latest water temp: {latest_water_f}°F")
 
     # Get current year daily actuals: water temp from lake_data, weather from met_data
     # Use MAX for water temp, air temp, solar (peak daytime values)
     current_year_water = {}
-    rows = conn.execute(text("""
-        SELECT date, MAX(temperature_c) AS max_temp_c
-        FROM lake_data
-        WHERE depth_m < 1.5
-          AND temperature_c IS NOT NULL
-          AND date >= DATE_TRUNC('year', NOW())
-        GROUP BY date ORDER BY date;
-    """)).fetchall()
+    rows = conn.execute(text(QUERY_YEAR_WATER)).fetchall()
     for r in rows:
-        current_year_water[r[0].strftime("%Y-%m-%d")] = round(float(r[1]) * 9/5 + 32, 1)
+        current_year_water[r[0].strftime("%Y-%m-%d")] = round(to_float(r[1]) * 9/5 + 32, 1)
     print(f"Current year water temp actuals: {len(current_year_water)} days")
 
     current_year_weather = {}
-    rows = conn.execute(text("""
-        SELECT date::date AS day,
-               MAX(air_temperature_c) AS max_air_c,
-               AVG(wind_speed_ms) AS avg_wind_ms,
-               MAX(solar_radiation_w) AS max_solar_w,
-               SUM(precipitation_mm) AS total_precip_mm,
-               AVG(us_aqi) AS avg_aqi
-        FROM met_data
-        WHERE date >= DATE_TRUNC('year', NOW())
-          AND air_temperature_c IS NOT NULL
-        GROUP BY date::date ORDER BY day;
-    """)).fetchall()
+    rows = conn.execute(text(QUERY_YEAR_WEATHER)).fetchall()
     for r in rows:
-        air_c = float(r[1]) if r[1] else None
-        wind_ms = float(r[2]) if r[2] else None
-        solar = float(r[3]) if r[3] else None
-        precip_mm = float(r[4]) if r[4] else None
-        aqi = float(r[5]) if r[5] else None
+        air_c, wind_ms, solar, precip_mm, aqi = map(to_float, r[1:])
+        precip_mm, aqi = precip_mm or None, aqi or None  # 0 counts as missing here
         current_year_weather[r[0].strftime("%Y-%m-%d")] = {
             "air_temp_f": round(air_c * 9/5 + 32, 1) if air_c else None,
             "wind_mph": round(wind_ms * 2.237, 1) if wind_ms else None,
@@ -340,37 +305,18 @@ if __name__ == "__main__":
     # Get actual comfort scores from the comfort_score table (YTD, up to now)
     # Use peak (MAX) score per day as the best daytime conditions.
     comfort_score_actuals = {}
-    rows = conn.execute(text("""
-        SELECT DATE(score_time AT TIME ZONE 'America/Los_Angeles') AS day,
-               MAX(overall_score) AS peak_score
-        FROM comfort_score
-        WHERE score_time AT TIME ZONE 'America/Los_Angeles'
-              >= DATE_TRUNC('year', NOW() AT TIME ZONE 'America/Los_Angeles')
-          AND score_time < NOW()
-        GROUP BY DATE(score_time AT TIME ZONE 'America/Los_Angeles')
-        ORDER BY day;
-    """)).fetchall()
+    rows = conn.execute(text(QUERY_COMFORT_ACTUALS)).fetchall()
     for r in rows:
-        comfort_score_actuals[r[0].strftime("%Y-%m-%d")] = round(float(r[1]), 1)
+        comfort_score_actuals[r[0].strftime("%Y-%m-%d")] = round(to_float(r[1]), 1)
     print(f"Comfort score actuals: {len(comfort_score_actuals)} days")
 
     # Get short-term forecast from comfort_score table (today + next 8 days).
     # These are based on real weather forecast data, so they should override
     # the seasonal historical-norm projections for the near term.
     short_term_comfort = {}
-    rows = conn.execute(text("""
-        SELECT DATE(score_time AT TIME ZONE 'America/Los_Angeles') AS day,
-               MAX(overall_score) AS peak_score
-        FROM comfort_score
-        WHERE score_time AT TIME ZONE 'America/Los_Angeles'
-              >= DATE_TRUNC('day', NOW() AT TIME ZONE 'America/Los_Angeles')
-          AND score_time AT TIME ZONE 'America/Los_Angeles'
-              < DATE_TRUNC('day', NOW() AT TIME ZONE 'America/Los_Angeles') + INTERVAL '9 days'
-        GROUP BY DATE(score_time AT TIME ZONE 'America/Los_Angeles')
-        ORDER BY day;
-    """)).fetchall()
+    rows = conn.execute(text(QUERY_SHORT_TERM_COMFORT)).fetchall()
     for r in rows:
-        short_term_comfort[r[0].strftime("%Y-%m-%d")] = round(float(r[1]), 1)
+        short_term_comfort[r[0].strftime("%Y-%m-%d")] = round(to_float(r[1]), 1)
     print(f"Short-term comfort forecast: {len(short_term_comfort)} days")
 
     conn.close()
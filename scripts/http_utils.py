@@ -0,0 +1,164 @@
+"""Shared HTTP helpers for polite access to upstream data sources."""
+
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+
+# Statuses worth retrying: throttling and transient upstream/proxy failures
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """Thread-safe global rate limit with a small burst allowance.
+
+    Tokens refill at `rate` per second up to `burst`; wait() takes one,
+    sleeping until it is available. pause() blocks every caller for a while,
+    which is how a server's Retry-After is applied to all worker threads at
+    once rather than only to the one that got the 429.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def wait(self):
+        """Block until the caller may send its next request."""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._paused_until)
+            self._tokens = min(self.burst, self._tokens + (start - self._updated) * self.rate)
+            self._updated = start
+            self._tokens -= 1
+            # A negative balance is the time this caller has to wait for its token
+            ready = start + max(0.0, -self._tokens) / self.rate
+        if ready > now:
+            time.sleep(ready - now)
+
+    def pause(self, seconds):
+        """Hold back all callers for at least `seconds` from now."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def retry_after_seconds(resp):
+    """Seconds asked for by a Retry-After header (delta or HTTP date), else None."""
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class FetchClient:
+    """GET with a shared rate limit and retries for throttling and transient failures.
+
+    429 and 5xx responses, timeouts and connection errors are retried with
+    jittered exponential backoff (base_delay * 2**attempt, capped). A
+    Retry-After header replaces the backoff: it pauses the shared limiter,
+    so every thread using this client backs off together, or without a
+    limiter the caller sleeps that long.
+
+    get() returns the final response for any status that is not retried (or
+    once retries are used up on a retryable status); callers still call
+    raise_for_status(). Exceptions are re-raised after the last attempt.
+    """
+
+    def __init__(self, limiter=None, retries=5, timeout=60, base_delay=2.0,
+                 max_delay=120.0, session=None):
+        self.limiter = limiter
+        self.retries = retries
+        self.timeout = timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.session = session or requests.Session()
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            if self.limiter is not None:
+                self.limiter.wait()
+            try:
+                resp = self.session.get(url, params=params, headers=headers,
+                                        timeout=timeout or self.timeout)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                if last:
+                    raise
+                delay = self._backoff(attempt)
+                print(f"{type(e).__name__}, retrying in {delay:.0f}s...", end=" ", flush=True)
+                time.sleep(delay)
+                continue
+
+            if resp.status_code not in RETRY_STATUSES or last:
+                return resp
+            wait = retry_after_seconds(resp)
+            if wait is not None:
+                print(f"HTTP {resp.status_code}, server asked for {wait:.0f}s...", end=" ", flush=True)
+                if self.limiter is not None:
+                    self.limiter.pause(wait)
+                else:
+                    time.sleep(wait)
+            else:
+                wait = self._backoff(attempt)
+                print(f"HTTP {resp.status_code}, retrying in {wait:.0f}s...", end=" ", flush=True)
+                time.sleep(wait)
+
+
+class AdaptiveChunker:
+    """Pick how many units (e.g. months) to request at once from observed responses.
+
+    After each request, record() compares its latency and payload size with
+    the targets: a chunk that came back well under both doubles the size, one
+    that went over either halves it, anything in between keeps it. failure()
+    halves it too. The size stays within [minimum, maximum].
+    """
+
+    def __init__(self, initial, minimum=1, maximum=12, target_seconds=15.0,
+                 max_bytes=8 * 1024 * 1024):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self._size = max(minimum, min(maximum, initial))
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self._size
+
+    def _resize(self, size):
+        self._size = max(self.minimum, min(self.maximum, size))
+
+    def record(self, units, seconds, nbytes):
+        """Adjust after a successful request covering `units` units."""
+        with self._lock:
+            if seconds > self.target_seconds or nbytes > self.max_bytes:
+                self._resize(units // 2)
+            elif seconds < self.target_seconds / 2 and nbytes < self.max_bytes / 2:
+                self._resize(max(self._size, units * 2))
+
+    def failure(self):
+        """Shrink after a request that failed outright (timeouts, retries exhausted)."""
+        with self._lock:
+            self._resize(self._size // 2)
@@ -1,162 +1,178 @@
+"""Import SammamishProfile.txt / SammamishMet.txt into Supabase.
+
+download_data.py imports in-process by default; this script is for the TSV
+files it writes with --tsv (e.g. after inspecting or editing them).
+"""
+
 import csv
-import psycopg2
-import psycopg2.extras
+import json
+import argparse
 import os
-from datetime import datetime
+from datetime import timedelta
 from dotenv import load_dotenv
-from db_utils import connect_with_retry
+from db_utils import connect_with_retry, copy_upsert
+from datascrape import mark_imported
+from buoy_records import iter_profile_records, iter_met_records
+from daily_summary import days_of, refresh_surface, refresh_met
 
 # Load environment variables
 load_dotenv()
 DB_URL = os.getenv("SUPABASE_DB_URL")
 
-
-def safe_float(value):
-    """Convert a string to float, returning None for empty or invalid values."""
-    if not value or not value.strip():
-        return None
-    try:
-        return float(value)
-    except ValueError:
-        return None
-
-
-def main():
-    conn = connect_with_retry(DB_URL)
-    cursor = conn.cursor()
-    print("Connected to the database")
-
-    # --- Import profile data ---
+# Rows at or before (watermark - overlap) are assumed already stored and are
+# not sent. The overlap re-sends the most recent readings so late corrections
+# from King County still land.
+IMPORT_OVERLAP_HOURS = int(os.getenv("IMPORT_OVERLAP_HOURS", "24"))
+
+LAKE_COLUMNS = ("date", "depth_m", "temperature_c", "turbidity_ntu", "chlorophyll_ugl", "phycocyanin_ugl")
+MET_COLUMNS = ("date", "relative_humidity", "solar_radiation_w", "pressure_mb",
+               "wind_speed_ms", "wind_direction_deg", "air_temperature_c")
+
+# The WHERE ... IS DISTINCT FROM clauses turn a conflict on an unchanged row
+# into a no-op, so re-sent readings don't rewrite tuples (or bloat the table).
+PROFILE_ON_CONFLICT = """
+    DO UPDATE SET temperature_c = EXCLUDED.temperature_c,
+                  turbidity_ntu = COALESCE(EXCLUDED.turbidity_ntu, lake_data.turbidity_ntu),
+                  chlorophyll_ugl = COALESCE(EXCLUDED.chlorophyll_ugl, lake_data.chlorophyll_ugl),
+                  phycocyanin_ugl = COALESCE(EXCLUDED.phycocyanin_ugl, lake_data.phycocyanin_ugl)
+    WHERE (lake_data.temperature_c, lake_data.turbidity_ntu,
+           lake_data.chlorophyll_ugl, lake_data.phycocyanin_ugl)
+          IS DISTINCT FROM
+          (EXCLUDED.temperature_c,
+           COALESCE(EXCLUDED.turbidity_ntu, lake_data.turbidity_ntu),
+           COALESCE(EXCLUDED.chlorophyll_ugl, lake_data.chlorophyll_ugl),
+           COALESCE(EXCLUDED.phycocyanin_ugl, lake_data.phycocyanin_ugl))
+"""
+
+MET_ON_CONFLICT = """
+    DO UPDATE SET relative_humidity = COALESCE(EXCLUDED.relative_humidity, met_data.relative_humidity),
+                  solar_radiation_w = COALESCE(EXCLUDED.solar_radiation_w, met_data.solar_radiation_w),
+                  pressure_mb = COALESCE(EXCLUDED.pressure_mb, met_data.pressure_mb),
+                  wind_speed_ms = COALESCE(EXCLUDED.wind_speed_ms, met_data.wind_speed_ms),
+                  wind_direction_deg = COALESCE(EXCLUDED.wind_direction_deg, met_data.wind_direction_deg),
+                  air_temperature_c = COALESCE(EXCLUDED.air_temperature_c, met_data.air_temperature_c)
+    WHERE (met_data.relative_humidity, met_data.solar_radiation_w, met_data.pressure_mb,
+           met_data.wind_speed_ms, met_data.wind_direction_deg, met_data.air_temperature_c)
+          IS DISTINCT FROM
+          (COALESCE(EXCLUDED.relative_humidity, met_data.relative_humidity),
+           COALESCE(EXCLUDED.solar_radiation_w, met_data.solar_radiation_w),
+           COALESCE(EXCLUDED.pressure_mb, met_data.pressure_mb),
+           COALESCE(EXCLUDED.wind_speed_ms, met_data.wind_speed_ms),
+           COALESCE(EXCLUDED.wind_direction_deg, met_data.wind_direction_deg),
+           COALESCE(EXCLUDED.air_temperature_c, met_data.air_temperature_c))
+"""
+
+
+def upsert_profile(cursor, batch):
+    """Upsert (date, depth_m, temperature_c, turbidity, chlorophyll, phycocyanin) rows.
+
+    daily_surface is refreshed for the days in the batch.
+    """
+    count = copy_upsert(cursor, "lake_data", LAKE_COLUMNS, batch, ("date", "depth_m"), PROFILE_ON_CONFLICT)
+    refresh_surface(cursor, days_of(batch))
+    return count
+
+
+def upsert_met(cursor, batch):
+    """Upsert buoy met rows in MET_COLUMNS order; refreshes daily_met for their days."""
+    count = copy_upsert(cursor, "met_data", MET_COLUMNS, batch, ("date",), MET_ON_CONFLICT)
+    refresh_met(cursor, days_of(batch))
+    return count
+
+
+def get_watermark(cursor, table, where="TRUE"):
+    """Latest stored reading time in table (None if empty)."""
+    cursor.execute(f"SELECT MAX(date) FROM {table} WHERE {where};")
+    return cursor.fetchone()[0]
+
+
+def newer_than(batch, watermark, overlap_hours):
+    """Drop rows (date first) at or before watermark - overlap."""
+    if watermark is None:
+        return batch
+    cutoff = watermark - timedelta(hours=overlap_hours)
+    return [row for row in batch if row[0] > cutoff]
+
+
+def mark_source_imported(filepath):
+    """Mark the DataScrape page behind filepath (per download_data) as imported."""
+    source = filepath + ".source.json"
+    if os.path.exists(source):
+        with open(source) as f:
+            mark_imported(**json.load(f))
+
+
+def import_records(cursor, profile, met, overlap_hours=IMPORT_OVERLAP_HOURS, full=False):
+    """Upsert parsed buoy records, skipping rows already below the watermarks.
+
+    profile / met are lists of ProfileRecord / MetRecord, or None when there
+    is nothing to import for that table. The caller commits.
+    """
+    if full:
+        lake_watermark = met_watermark = None
+    else:
+        lake_watermark = get_watermark(cursor, "lake_data") if profile else None
+        # Open-Meteo backfill rows never carry pressure, so this is the buoy's
+        # own high-water mark rather than the archive's
+        met_watermark = get_watermark(cursor, "met_data", "pressure_mb IS NOT NULL") if met else None
+        print(f"Watermarks: lake_data={lake_watermark}, met_data={met_watermark} "
+              f"(overlap {overlap_hours}h)")
+
+    if profile is not None:
+        batch = newer_than(profile, lake_watermark, overlap_hours)
+        if batch:
+            upsert_profile(cursor, batch)
+        print(f"Profile import: {len(batch)} rows upserted "
+              f"({len(profile) - len(batch)} already stored, skipped).")
+
+    if met is not None:
+        batch = newer_than(met, met_watermark, overlap_hours)
+        if batch:
+            upsert_met(cursor, batch)
+        print(f"Met import: {len(batch)} rows upserted "
+              f"({len(met) - len(batch)} already stored, skipped).")
+
+
+def read_tsv(filepath):
+    """Read a download_data TSV file. Returns (headers, rows)."""
+    with open(filepath, "r") as file:
+        csv_reader = csv.reader(file, delimiter="\t")
+        headers = next(csv_reader, None)
+        return headers, list(csv_reader)
+
+
+def main(overlap_hours=IMPORT_OVERLAP_HOURS, full=False):
+    profile = met = None
     if os.path.exists("SammamishProfile.txt"):
-        with open("SammamishProfile.txt", "r") as file:
-            csv_reader = csv.reader(file, delimiter="\t")
-            headers = next(csv_reader, None)
-
-            col_idx = {}
-            if headers:
-                for i, h in enumerate(headers):
-                    hl = h.strip().lower()
-                    if "date" in hl:
-                        col_idx["date"] = i
-                    elif "depth" in hl:
-                        col_idx["depth"] = i
-                    elif "temperature" in hl:
-                        col_idx["temp"] = i
-                    elif "turbidity" in hl:
-                        col_idx["turbidity"] = i
-                    elif "chlorophyll" in hl:
-                        col_idx["chlorophyll"] = i
-                    elif "phycocyanin" in hl:
-                        col_idx["phycocyanin"] = i
-
-            batch = []
-            for row in csv_reader:
-                if not row or row[0].strip().lower() == "date":
-                    continue
-                try:
-                    date_time_obj = datetime.strptime(row[col_idx.get("date", 0)], "%m/%d/%Y %I:%M:%S %p")
-                except (ValueError, IndexError):
-                    continue
-
-                depth_m = safe_float(row[col_idx.get("depth", 1)])
-                temperature_c = safe_float(row[col_idx.get("temp", 2)])
-                turbidity_ntu = safe_float(row[col_idx.get("turbidity", 7)]) if "turbidity" in col_idx else None
-                chlorophyll_ugl = safe_float(row[col_idx.get("chlorophyll", 6)]) if "chlorophyll" in col_idx else None
-                phycocyanin_ugl = safe_float(row[col_idx.get("phycocyanin", 8)]) if "phycocyanin" in col_idx else None
-
-                if temperature_c is not None:
-                    batch.append((date_time_obj, depth_m, temperature_c, turbidity_ntu, chlorophyll_ugl, phycocyanin_ugl))
-
-            if batch:
-                psycopg2.extras.execute_values(
-                    cursor,
-                    """
-                    INSERT INTO lake_data (date, depth_m, temperature_c, turbidity_ntu, chlorophyll_ugl, phycocyanin_ugl)
-                    VALUES %s
-                    ON CONFLICT (date, depth_m)
-                    DO UPDATE SET temperature_c = EXCLUDED.temperature_c,
-                                  turbidity_ntu = COALESCE(EXCLUDED.turbidity_ntu, lake_data.turbidity_ntu),
-                                  chlorophyll_ugl = COALESCE(EXCLUDED.chlorophyll_ugl, lake_data.chlorophyll_ugl),
-                                  phycocyanin_ugl = COALESCE(EXCLUDED.phycocyanin_ugl, lake_data.phycocyanin_ugl);
-                    """,
-                    batch,
-                    page_size=500
-                )
-            print(f"Profile import: {len(batch)} rows upserted.")
+        profile = list(iter_profile_records(*read_tsv("SammamishProfile.txt")))
     else:
         print("SammamishProfile.txt not found, skipping profile import.")
-
-    # --- Import meteorological data ---
     if os.path.exists("SammamishMet.txt"):
-        with open("SammamishMet.txt", "r") as file:
-            csv_reader = csv.reader(file, delimiter="\t")
-            headers = next(csv_reader, None)
-
-            col_idx = {}
-            if headers:
-                for i, h in enumerate(headers):
-                    hl = h.strip().lower()
-                    if "date" in hl:
-                        col_idx["date"] = i
-                    elif "humidity" in hl:
-                        col_idx["humidity"] = i
-                    elif "solar" in hl or "radiation" in hl:
-                        col_idx["solar"] = i
-                    elif "pressure" in hl or "barometric" in hl:
-                        col_idx["pressure"] = i
-                    elif "wind speed" in hl or "wind_speed" in hl:
-                        col_idx["wind_speed"] = i
-                    elif "wind dir" in hl or "wind_dir" in hl:
-                        col_idx["wind_dir"] = i
-                    elif "air temp" in hl or "air_temp" in hl:
-                        col_idx["air_temp"] = i
-
-            batch = []
-            for row in csv_reader:
-                if not row or row[0].strip().lower() == "date":
-                    continue
-                try:
-                    date_time_obj = datetime.strptime(row[col_idx.get("date", 0)], "%m/%d/%Y %I:%M:%S %p")
-                except (ValueError, IndexError):
-                    continue
-
-                batch.append((
-                    date_time_obj,
-                    safe_float(row[col_idx.get("humidity", 1)]) if "humidity" in col_idx else None,
-                    safe_float(row[col_idx.get("solar", 2)]) if "solar" in col_idx else None,
-                    safe_float(row[col_idx.get("pressure", 3)]) if "pressure" in col_idx else None,
-                    safe_float(row[col_idx.get("wind_speed", 4)]) if "wind_speed" in col_idx else None,
-                    safe_float(row[col_idx.get("wind_dir", 5)]) if "wind_dir" in col_idx else None,
-                    safe_float(row[col_idx.get("air_temp", 6)]) if "air_temp" in col_idx else None,
-                ))
-
-            if batch:
-                psycopg2.extras.execute_values(
-                    cursor,
-                    """
-                    INSERT INTO met_data (date, relative_humidity, solar_radiation_w, pressure_mb,
-                                          wind_speed_ms, wind_direction_deg, air_temperature_c)
-                    VALUES %s
-                    ON CONFLICT (date)
-                    DO UPDATE SET relative_humidity = COALESCE(EXCLUDED.relative_humidity, met_data.relative_humidity),
-                                  solar_radiation_w = COALESCE(EXCLUDED.solar_radiation_w, met_data.solar_radiation_w),
-                                  pressure_mb = COALESCE(EXCLUDED.pressure_mb, met_data.pressure_mb),
-                                  wind_speed_ms = COALESCE(EXCLUDED.wind_speed_ms, met_data.wind_speed_ms),
-                                  wind_direction_deg = COALESCE(EXCLUDED.wind_direction_deg, met_data.wind_direction_deg),
-                                  air_temperature_c = COALESCE(EXCLUDED.air_temperature_c, met_data.air_temperature_c);
-                    """,
-                    batch,
-                    page_size=500
-                )
-            print(f"Met import: {len(batch)} rows upserted.")
+        met = list(iter_met_records(*read_tsv("SammamishMet.txt")))
     else:
         print("SammamishMet.txt not found, skipping met import.")
 
+    conn = connect_with_retry(DB_URL)
+    cursor = conn.cursor()
+    print("Connected to the database")
+
+    import_records(cursor, profile, met, overlap_hours, full)
+
     conn.commit()
     cursor.close()
     conn.close()
+
+    for filepath in ("SammamishProfile.txt", "SammamishMet.txt"):
+        if os.path.exists(filepath):
+            mark_source_imported(filepath)
     print("Import complete.")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--overlap-hours", type=int, default=IMPORT_OVERLAP_HOURS,
+                        help="re-send readings this far behind the stored watermark (default: %(default)s)")
+    parser.add_argument("--full", action="store_true",
+                        help="ignore watermarks and upsert every row in the files")
+    args = parser.parse_args()
+    main(overlap_hours=args.overlap_hours, full=args.full)
@@ -1,13 +1,134 @@
-"""Database migration: add tables and columns for swimming comfort score."""
+"""Database migrations, applied once each and tracked in schema_migrations.
+
+    python scripts/migrate_db.py            # apply pending migrations
+    python scripts/migrate_db.py --status   # list migrations and their state
+    python scripts/migrate_db.py --max-seconds 120   # stop after ~2 minutes
+
+MIGRATIONS is append-only: a migration's version is its position in the
+list, and the sha256 of its SQL is stored when it is applied. Editing or
+reordering an applied migration is refused (its checksum no longer
+matches); add a new one instead. A step is one of:
+
+  plain SQL      run in its own transaction together with its
+                 schema_migrations row
+  concurrently() one CREATE INDEX CONCURRENTLY, run outside a transaction
+                 so writers are not blocked. An invalid index left by an
+                 interrupted build is dropped and rebuilt.
+  batched()      a data change over a date range of a big table, run a
+                 chunk at a time (each chunk its own transaction) so the
+                 import is never blocked for long. Progress is stored, so an
+                 interrupted run resumes where it stopped; a chunk must be
+                 safe to run twice.
+
+Migrations written before schema_migrations existed are idempotent (IF NOT
+EXISTS, ON CONFLICT), so on a database that already has them they are
+simply recorded. A session advisory lock keeps two runs (e.g. the backfill
+and the pipeline workflows) from applying migrations at the same time; a
+run waits up to LOCK_TIMEOUT for it and then fails. The lock needs a
+session pooler (port 5432) or a direct connection: behind a transaction
+pooler it would stay on the pooled backend after the run disconnects.
+"""
 
 import os
-import psycopg2
+import sys
+import time
+import hashlib
+import argparse
+import itertools
+import textwrap
+from collections import namedtuple
+from datetime import timedelta
 from dotenv import load_dotenv
 from db_utils import connect_with_retry
 
 load_dotenv()
 DB_URL = os.getenv("SUPABASE_DB_URL")
 
+# Arbitrary key for the advisory lock, shared by every migrate_db run
+MIGRATION_LOCK = 4_202_207
+
+# How long to wait for another run's lock before giving up. A lock leaked
+# on a pooled backend (the transaction pooler on :6543 keeps it after the
+# client disconnects) then fails the run instead of hanging it.
+LOCK_TIMEOUT = 10 * 60
+LOCK_POLL_SECONDS = 5
+
+# kind: "sql", "concurrent" or "batched". index is the index a concurrent
+# step builds; table, column and chunk the range a batched step walks.
+Step = namedtuple("Step", "kind sql index table column chunk")
+
+
+def concurrently(index, sql):
+    """A CREATE INDEX CONCURRENTLY step building index."""
+    return Step("concurrent", sql, index, None, None, None)
+
+
+def batched(table, sql, column="date", chunk=timedelta(days=30)):
+    """A data step run over table in chunk-wide ranges of column.
+
+    sql uses %(start)s and %(end)s for each half-open range. Ranges start at
+    midnight, so with whole-day chunks a day never spans two of them.
+    """
+    return Step("batched", sql, None, table, column, chunk)
+
+
+def to_double_precision(table, columns, column="date", indexes=()):
+    """Steps that turn NUMERIC columns of a big table into DOUBLE PRECISION.
+
+    ALTER COLUMN TYPE would rewrite the table under an exclusive lock, so
+    each column gets a shadow "<column>_f8" column instead, kept in sync by
+    a trigger and backfilled in batches. indexes are (name, CREATE INDEX
+    CONCURRENTLY statement) pairs building "<name>_f8" over the shadow
+    columns for the indexes that use the old ones. Then, in one short
+    transaction, the old columns are dropped and the shadows renamed.
+    Readers and writers see the same column names throughout.
+
+    DROP COLUMN only hides the old values: they keep their space until a
+    row is next updated. Reclaiming it at once takes another full rewrite,
+    so it is left as a manual follow-up at a quiet time (VACUUM FULL, or
+    pg_repack to avoid the exclusive lock).
+    """
+    sync = f"{table}_f8_sync"
+    shadows = [f"{c}_f8" for c in columns]
+    return [
+        f"""
+        ALTER TABLE {table}
+        {", ".join(f"ADD COLUMN IF NOT EXISTS {s} DOUBLE PRECISION" for s in shadows)};
+
+        CREATE OR REPLACE FUNCTION {sync}() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            {" ".join(f"NEW.{s} := NEW.{c};" for c, s in zip(columns, shadows))}
+            RETURN NEW;
+        END $$;
+
+        DROP TRIGGER IF EXISTS {sync} ON {table};
+        CREATE TRIGGER {sync} BEFORE INSERT OR UPDATE ON {table}
+        FOR EACH ROW EXECUTE FUNCTION {sync}();
+        """,
+        batched(table, f"""
+        UPDATE {table} SET {", ".join(f"{s} = {c}" for c, s in zip(columns, shadows))}
+        WHERE {column} >= %(start)s AND {column} < %(end)s;
+        """, column),
+        *(concurrently(f"{name}_f8", sql) for name, sql in indexes),
+        f"""
+        SET LOCAL lock_timeout = '10s';
+        DROP TRIGGER {sync} ON {table};
+        DROP FUNCTION {sync}();
+        ALTER TABLE {table} {", ".join(f"DROP COLUMN {c}" for c in columns)};
+        {" ".join(f"ALTER TABLE {table} RENAME COLUMN {s} TO {c};" for c, s in zip(columns, shadows))}
+        {" ".join(f"ALTER INDEX {name}_f8 RENAME TO {name};" for name, _ in indexes)}
+        """,
+    ]
+
+
+def as_step(item):
+    return item if isinstance(item, Step) else Step("sql", item, None, None, None, None)
+
+
+def checksum(step):
+    return hashlib.sha256(f"{step.kind}:{textwrap.dedent(step.sql).strip()}".encode()).hexdigest()
+
+
 MIGRATIONS = [
     # Add water quality columns to existing lake_data table
     """
@@ -80,18 +201,600 @@ MIGRATIONS = [
     ADD COLUMN IF NOT EXISTS precipitation_mm NUMERIC,
     ADD COLUMN IF NOT EXISTS us_aqi NUMERIC;
     """,
+
+    # Per-unit checkpoints for the resumable backfills (see backfill_progress.py)
+    """
+    CREATE TABLE IF NOT EXISTS backfill_progress (
+        source       TEXT NOT NULL,
+        data_type    TEXT NOT NULL,
+        period       TEXT NOT NULL,
+        status       TEXT NOT NULL DEFAULT 'pending'
+                     CHECK (status IN ('pending', 'running', 'done', 'failed')),
+        row_count    INTEGER,
+        content_hash TEXT,
+        worker       TEXT,
+        attempts     INTEGER NOT NULL DEFAULT 0,
+        started_at   TIMESTAMPTZ,
+        finished_at  TIMESTAMPTZ,
+        error        TEXT,
+        PRIMARY KEY (source, data_type, period)
+    );
+    """,
+
+    # Input fingerprints of the last successful run of each pipeline stage
+    # (see stage_fingerprint.py)
+    """
+    CREATE TABLE IF NOT EXISTS pipeline_fingerprint (
+        stage       TEXT NOT NULL PRIMARY KEY,
+        fingerprint TEXT NOT NULL,
+        inputs      JSONB NOT NULL,
+        outputs     JSONB NOT NULL DEFAULT '{}',
+        updated_at  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    """,
+
+    # Local day and day-of-year as stored columns, so the daily and DOY
+    # groupings/windows in generate_html, generate_forecast and
+    # export_comfort_json can be indexed (dates are Pacific local time).
+    # A GENERATED ... STORED column would rewrite the table under an
+    # exclusive lock, so these are plain columns set by a trigger on new
+    # rows and filled in batches for existing ones.
+    """
+    CREATE OR REPLACE FUNCTION set_local_day() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        NEW.local_day := NEW.date::date;
+        NEW.day_of_year := EXTRACT(DOY FROM NEW.date)::smallint;
+        RETURN NEW;
+    END $$;
+
+    SET LOCAL lock_timeout = '10s';
+    ALTER TABLE lake_data
+    ADD COLUMN IF NOT EXISTS local_day DATE,
+    ADD COLUMN IF NOT EXISTS day_of_year SMALLINT;
+
+    DROP TRIGGER IF EXISTS set_local_day ON lake_data;
+    CREATE TRIGGER set_local_day BEFORE INSERT OR UPDATE OF date ON lake_data
+    FOR EACH ROW EXECUTE FUNCTION set_local_day();
+    """,
+
+    batched("lake_data", """
+    UPDATE lake_data
+    SET local_day = date::date, day_of_year = EXTRACT(DOY FROM date)::smallint
+    WHERE date >= %(start)s AND date < %(end)s AND local_day IS NULL;
+    """),
+
+    """
+    SET LOCAL lock_timeout = '10s';
+    ALTER TABLE met_data
+    ADD COLUMN IF NOT EXISTS local_day DATE,
+    ADD COLUMN IF NOT EXISTS day_of_year SMALLINT;
+
+    DROP TRIGGER IF EXISTS set_local_day ON met_data;
+    CREATE TRIGGER set_local_day BEFORE INSERT OR UPDATE OF date ON met_data
+    FOR EACH ROW EXECUTE FUNCTION set_local_day();
+    """,
+
+    batched("met_data", """
+    UPDATE met_data
+    SET local_day = date::date, day_of_year = EXTRACT(DOY FROM date)::smallint
+    WHERE date >= %(start)s AND date < %(end)s AND local_day IS NULL;
+    """),
+
+    # Surface readings (depth_m < 1.5) are a small slice of lake_data and
+    # almost every read is about them: by date (latest reading, date windows)
+    # and by day of year (historical norms). temperature_c is included so
+    # these are index-only scans.
+    concurrently("idx_lake_data_surface", """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_lake_data_surface
+    ON lake_data (date) INCLUDE (temperature_c)
+    WHERE depth_m < 1.5;
+    """),
+
+    concurrently("idx_lake_data_surface_doy", """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_lake_data_surface_doy
+    ON lake_data (day_of_year, date) INCLUDE (temperature_c)
+    WHERE depth_m < 1.5;
+    """),
+
+    concurrently("idx_met_data_doy", """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_met_data_doy
+    ON met_data (day_of_year, date)
+    WHERE air_temperature_c IS NOT NULL;
+    """),
+
+    # weather_forecast is append-only in fetched_at order, so a BRIN index
+    # covers fetched_at ranges for a few pages. lake_data and met_data don't
+    # get one: their primary keys already lead with date.
+    concurrently("brin_weather_forecast_fetched_at", """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS brin_weather_forecast_fetched_at
+    ON weather_forecast USING brin (fetched_at);
+    """),
+
+    # Per-day summaries of the raw readings, maintained by the import paths
+    # (see daily_summary.py). Filled from the raw tables a month at a time.
+    """
+    CREATE TABLE IF NOT EXISTS daily_surface (
+        local_day    DATE NOT NULL PRIMARY KEY,
+        day_of_year  SMALLINT GENERATED ALWAYS AS (EXTRACT(DOY FROM local_day)::smallint) STORED,
+        max_temp_c   NUMERIC,
+        sum_temp_c   NUMERIC,
+        readings     INTEGER NOT NULL
+    );
+    """,
+
+    batched("lake_data", """
+    INSERT INTO daily_surface (local_day, max_temp_c, sum_temp_c, readings)
+    SELECT local_day, MAX(temperature_c), SUM(temperature_c), COUNT(*)
+    FROM lake_data
+    WHERE date >= %(start)s AND date < %(end)s
+      AND depth_m < 1.5 AND temperature_c IS NOT NULL
+    GROUP BY local_day
+    ON CONFLICT (local_day) DO NOTHING;
+    """),
+
+    """
+    CREATE TABLE IF NOT EXISTS daily_met (
+        local_day       DATE NOT NULL PRIMARY KEY,
+        day_of_year     SMALLINT GENERATED ALWAYS AS (EXTRACT(DOY FROM local_day)::smallint) STORED,
+        max_air_c       NUMERIC,
+        avg_wind_ms     NUMERIC,
+        max_solar_w     NUMERIC,
+        total_precip_mm NUMERIC,
+        avg_aqi         NUMERIC,
+        readings        INTEGER NOT NULL
+    );
+    """,
+
+    batched("met_data", """
+    INSERT INTO daily_met (local_day, max_air_c, avg_wind_ms, max_solar_w,
+                           total_precip_mm, avg_aqi, readings)
+    SELECT local_day, MAX(air_temperature_c), AVG(wind_speed_ms), MAX(solar_radiation_w),
+           SUM(precipitation_mm), AVG(us_aqi), COUNT(*)
+    FROM met_data
+    WHERE date >= %(start)s AND date < %(end)s
+      AND air_temperature_c IS NOT NULL
+    GROUP BY local_day
+    ON CONFLICT (local_day) DO NOTHING;
+    """),
+
+    # Smoothed norms per day of year, refreshed from daily_surface /
+    # daily_met as days complete (see climatology.py)
+    """
+    CREATE TABLE IF NOT EXISTS climatology_doy (
+        doy          SMALLINT NOT NULL PRIMARY KEY CHECK (doy BETWEEN 1 AND 366),
+        water_max_c  NUMERIC,
+        air_max_c    NUMERIC,
+        wind_ms      NUMERIC,
+        solar_w      NUMERIC,
+        precip_mm    NUMERIC,
+        aqi          NUMERIC,
+        water_days   INTEGER NOT NULL,
+        met_days     INTEGER NOT NULL,
+        through_day  DATE NOT NULL,
+        updated_at   TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    """,
+
+    # The most recent forecast for each hour, kept up to date by
+    # fetch_forecast so readers don't have to pick it out of every fetch.
+    # Filled from weather_forecast the first time.
+    """
+    CREATE TABLE IF NOT EXISTS weather_forecast_latest (
+        forecast_time      TIMESTAMP NOT NULL PRIMARY KEY,
+        fetched_at         TIMESTAMP NOT NULL,
+        temperature_f      NUMERIC,
+        feels_like_f       NUMERIC,
+        wind_speed_mph     NUMERIC,
+        wind_direction_deg NUMERIC,
+        precip_probability NUMERIC,
+        cloud_cover        NUMERIC,
+        uv_index           NUMERIC,
+        solar_radiation_w  NUMERIC,
+        us_aqi             NUMERIC,
+        pm25               NUMERIC
+    );
+
+    INSERT INTO weather_forecast_latest
+    SELECT DISTINCT ON (forecast_time)
+        forecast_time, fetched_at, temperature_f, feels_like_f, wind_speed_mph,
+        wind_direction_deg, precip_probability, cloud_cover, uv_index,
+        solar_radiation_w, us_aqi, pm25
+    FROM weather_forecast
+    WHERE NOT EXISTS (SELECT 1 FROM weather_forecast_latest)
+    ORDER BY forecast_time, fetched_at DESC;
+    """,
+
+    # One row per forecast fetch: the hours it covered and how many of them
+    # were written to weather_forecast ("delta" storage only writes hours
+    # that changed; see fetch_forecast.py). Fetches stored before this table
+    # existed are recorded as "full".
+    """
+    CREATE TABLE IF NOT EXISTS forecast_fetch (
+        fetched_at  TIMESTAMP NOT NULL PRIMARY KEY,
+        first_hour  TIMESTAMP NOT NULL,
+        last_hour   TIMESTAMP NOT NULL,
+        hours       INTEGER NOT NULL,
+        stored      INTEGER NOT NULL,
+        storage     TEXT NOT NULL CHECK (storage IN ('full', 'delta'))
+    );
+
+    INSERT INTO forecast_fetch (fetched_at, first_hour, last_hour, hours, stored, storage)
+    SELECT fetched_at, MIN(forecast_time), MAX(forecast_time), COUNT(*), COUNT(*), 'full'
+    FROM weather_forecast
+    WHERE NOT EXISTS (SELECT 1 FROM forecast_fetch)
+    GROUP BY fetched_at;
+    """,
+
+    # The forecast as it stood after the last fetch at or before as_of: each
+    # hour the fetch covered, with the newest values stored for it up to
+    # then. fetched_at in the result is that fetch's.
+    """
+    CREATE OR REPLACE FUNCTION weather_forecast_as_of(as_of TIMESTAMP)
+    RETURNS SETOF weather_forecast
+    LANGUAGE sql STABLE AS $$
+        SELECT w.forecast_time, f.fetched_at, w.temperature_f, w.feels_like_f,
+               w.wind_speed_mph, w.wind_direction_deg, w.precip_probability,
+               w.cloud_cover, w.uv_index, w.solar_radiation_w, w.us_aqi, w.pm25
+        FROM (
+            SELECT fetched_at, first_hour, last_hour FROM forecast_fetch
+            WHERE fetched_at <= as_of
+            ORDER BY fetched_at DESC
+            LIMIT 1
+        ) f
+        CROSS JOIN generate_series(f.first_hour, f.last_hour, INTERVAL '1 hour') hour
+        CROSS JOIN LATERAL (
+            SELECT * FROM weather_forecast
+            WHERE forecast_time = hour AND fetched_at <= f.fetched_at
+            ORDER BY fetched_at DESC
+            LIMIT 1
+        ) w
+        ORDER BY w.forecast_time;
+    $$;
+    """,
+
+    # One row per compute_comfort run: the hours it scored and how many of
+    # them changed. comfort_score.run_id is the run that last wrote a row;
+    # rows the run left alone still belong to its forecast. Scores written
+    # before runs were recorded are attributed to one initial run.
+    """
+    CREATE TABLE IF NOT EXISTS comfort_run (
+        run_id      BIGSERIAL PRIMARY KEY,
+        computed_at TIMESTAMP NOT NULL,
+        first_hour  TIMESTAMP NOT NULL,
+        last_hour   TIMESTAMP NOT NULL,
+        hours       INTEGER NOT NULL,
+        changed     INTEGER NOT NULL
+    );
+
+    ALTER TABLE comfort_score
+    ADD COLUMN IF NOT EXISTS run_id BIGINT REFERENCES comfort_run (run_id);
+
+    INSERT INTO comfort_run (computed_at, first_hour, last_hour, hours, changed)
+    SELECT MAX(computed_at), MIN(score_time), MAX(score_time), COUNT(*), COUNT(*)
+    FROM comfort_score
+    WHERE computed_at = (SELECT MAX(computed_at) FROM comfort_score)
+      AND NOT EXISTS (SELECT 1 FROM comfort_run)
+    HAVING COUNT(*) > 0;
+
+    UPDATE comfort_score SET run_id = (SELECT MIN(run_id) FROM comfort_run)
+    WHERE run_id IS NULL;
+    """,
+
+    # Measurements as DOUBLE PRECISION instead of NUMERIC: fixed-width, much
+    # cheaper to aggregate, and read as Python floats rather than Decimals.
+    # depth_m stays NUMERIC, it is part of lake_data's primary key. The big
+    # tables are converted online (see to_double_precision); if the swap
+    # can't get its lock within lock_timeout the run fails and the next one
+    # retries it.
+    *to_double_precision("lake_data", (
+        "temperature_c", "turbidity_ntu", "chlorophyll_ugl", "phycocyanin_ugl",
+    ), indexes=(
+        ("idx_lake_data_surface", """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_lake_data_surface_f8
+        ON lake_data (date) INCLUDE (temperature_c_f8)
+        WHERE depth_m < 1.5;
+        """),
+        ("idx_lake_data_surface_doy", """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_lake_data_surface_doy_f8
+        ON lake_data (day_of_year, date) INCLUDE (temperature_c_f8)
+        WHERE depth_m < 1.5;
+        """),
+    )),
+
+    *to_double_precision("met_data", (
+        "relative_humidity", "solar_radiation_w", "pressure_mb", "wind_speed_ms",
+        "wind_direction_deg", "air_temperature_c", "precipitation_mm", "us_aqi",
+    ), indexes=(
+        ("idx_met_data_doy", """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_met_data_doy_f8
+        ON met_data (day_of_year, date)
+        WHERE air_temperature_c_f8 IS NOT NULL;
+        """),
+    )),
+
+    # Shadow columns are added in the original order, so the row type that
+    # weather_forecast_as_of() returns keeps its column order
+    *to_double_precision("weather_forecast", (
+        "temperature_f", "feels_like_f", "wind_speed_mph", "wind_direction_deg",
+        "precip_probability", "cloud_cover", "uv_index", "solar_radiation_w",
+        "us_aqi", "pm25",
+    ), column="forecast_time"),
+
+    # The derived tables are small enough to convert in place
+    """
+    ALTER TABLE weather_forecast_latest
+    ALTER COLUMN temperature_f TYPE DOUBLE PRECISION,
+    ALTER COLUMN feels_like_f TYPE DOUBLE PRECISION,
+    ALTER COLUMN wind_speed_mph TYPE DOUBLE PRECISION,
+    ALTER COLUMN wind_direction_deg TYPE DOUBLE PRECISION,
+    ALTER COLUMN precip_probability TYPE DOUBLE PRECISION,
+    ALTER COLUMN cloud_cover TYPE DOUBLE PRECISION,
+    ALTER COLUMN uv_index TYPE DOUBLE PRECISION,
+    ALTER COLUMN solar_radiation_w TYPE DOUBLE PRECISION,
+    ALTER COLUMN us_aqi TYPE DOUBLE PRECISION,
+    ALTER COLUMN pm25 TYPE DOUBLE PRECISION;
+
+    ALTER TABLE comfort_score
+    ALTER COLUMN overall_score TYPE DOUBLE PRECISION,
+    ALTER COLUMN water_temp_score TYPE DOUBLE PRECISION,
+    ALTER COLUMN air_temp_score TYPE DOUBLE PRECISION,
+    ALTER COLUMN wind_score TYPE DOUBLE PRECISION,
+    ALTER COLUMN sun_score TYPE DOUBLE PRECISION,
+    ALTER COLUMN rain_score TYPE DOUBLE PRECISION,
+    ALTER COLUMN clarity_score TYPE DOUBLE PRECISION,
+    ALTER COLUMN algae_score TYPE DOUBLE PRECISION,
+    ALTER COLUMN aqi_score TYPE DOUBLE PRECISION;
+
+    ALTER TABLE daily_surface
+    ALTER COLUMN max_temp_c TYPE DOUBLE PRECISION,
+    ALTER COLUMN sum_temp_c TYPE DOUBLE PRECISION;
+
+    ALTER TABLE daily_met
+    ALTER COLUMN max_air_c TYPE DOUBLE PRECISION,
+    ALTER COLUMN avg_wind_ms TYPE DOUBLE PRECISION,
+    ALTER COLUMN max_solar_w TYPE DOUBLE PRECISION,
+    ALTER COLUMN total_precip_mm TYPE DOUBLE PRECISION,
+    ALTER COLUMN avg_aqi TYPE DOUBLE PRECISION;
+
+    ALTER TABLE climatology_doy
+    ALTER COLUMN water_max_c TYPE DOUBLE PRECISION,
+    ALTER COLUMN air_max_c TYPE DOUBLE PRECISION,
+    ALTER COLUMN wind_ms TYPE DOUBLE PRECISION,
+    ALTER COLUMN solar_w TYPE DOUBLE PRECISION,
+    ALTER COLUMN precip_mm TYPE DOUBLE PRECISION,
+    ALTER COLUMN aqi TYPE DOUBLE PRECISION;
+    """,
+
+    # Pipeline runs and their stages, for single flight across overlapping
+    # runs (see pipeline_runs.py)
+    """
+    CREATE TABLE IF NOT EXISTS pipeline_run (
+        run_id       BIGSERIAL PRIMARY KEY,
+        triggered_at TIMESTAMPTZ NOT NULL,
+        stages       TEXT[] NOT NULL,
+        on_busy      TEXT NOT NULL CHECK (on_busy IN ('wait', 'coalesce', 'exit')),
+        waited_s     REAL,
+        started_at   TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        finished_at  TIMESTAMPTZ
+    );
+
+    CREATE TABLE IF NOT EXISTS pipeline_stage_run (
+        run_id        BIGINT NOT NULL REFERENCES pipeline_run (run_id),
+        stage         TEXT NOT NULL,
+        status        TEXT NOT NULL
+                      CHECK (status IN ('running', 'ok', 'unchanged', 'coalesced', 'failed', 'skipped')),
+        started_at    TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        finished_at   TIMESTAMPTZ,
+        source_run_id BIGINT REFERENCES pipeline_run (run_id),
+        error         TEXT,
+        PRIMARY KEY (run_id, stage)
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_pipeline_stage_run_stage
+    ON pipeline_stage_run (stage, started_at DESC);
+    """,
 ]
 
-if __name__ == "__main__":
-    conn = connect_with_retry(DB_URL)
+SCHEMA_MIGRATIONS_SQL = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version     INTEGER NOT NULL PRIMARY KEY,
+        kind        TEXT NOT NULL,
+        checksum    TEXT NOT NULL,
+        progress    TIMESTAMP,
+        started_at  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        applied_at  TIMESTAMPTZ
+    );
+"""
+
+
+def migration_state(cursor):
+    """{version: (checksum, progress, applied_at)} from schema_migrations."""
+    cursor.execute("SELECT version, checksum, progress, applied_at FROM schema_migrations;")
+    return {row[0]: row[1:] for row in cursor.fetchall()}
+
+
+def changed_migrations(state):
+    """Versions whose stored checksum doesn't match MIGRATIONS (or are unknown)."""
+    steps = [as_step(m) for m in MIGRATIONS]
+    return [version for version, (stored, _, _) in sorted(state.items())
+            if version > len(steps) or checksum(steps[version - 1]) != stored]
+
+
+def apply_sql(conn, version, step):
     cursor = conn.cursor()
-    print("Connected to database")
+    cursor.execute(step.sql)
+    cursor.execute("""
+        INSERT INTO schema_migrations (version, kind, checksum, applied_at)
+        VALUES (%s, %s, %s, NOW());
+    """, (version, step.kind, checksum(step)))
+    conn.commit()
+    cursor.close()
+
+
+def apply_concurrently(conn, version, step):
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        # An interrupted CONCURRENTLY build leaves an invalid index behind,
+        # which IF NOT EXISTS would then accept as done
+        cursor.execute("""
+            SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = %s AND c.relnamespace = 'public'::regnamespace
+              AND NOT i.indisvalid;
+        """, (step.index,))
+        if cursor.fetchone():
+            print(f"  Dropping invalid index {step.index} left by an earlier attempt")
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {step.index};")
+        cursor.execute(step.sql)
+        cursor.execute("""
+            INSERT INTO schema_migrations (version, kind, checksum, applied_at)
+            VALUES (%s, %s, %s, NOW());
+        """, (version, step.kind, checksum(step)))
+    finally:
+        cursor.close()
+        conn.autocommit = False
+
+
+def out_of_time(deadline):
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def apply_batched(conn, version, step, progress, deadline=None):
+    """Run the step's remaining chunks. Returns False if deadline stopped it."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO schema_migrations (version, kind, checksum)
+        VALUES (%s, %s, %s) ON CONFLICT (version) DO NOTHING;
+    """, (version, step.kind, checksum(step)))
+    cursor.execute(f"SELECT DATE_TRUNC('day', MIN({step.column})), MAX({step.column}) FROM {step.table};")
+    first, last = cursor.fetchone()
+    conn.commit()
+
+    start = progress or first
+    chunks = 0
+    while start is not None and start <= last:
+        if out_of_time(deadline):
+            cursor.close()
+            print(f"  {chunks} chunks of {step.table}, stopped at {start:%Y-%m-%d} (out of time)")
+            return False
+        end = start + step.chunk
+        cursor.execute(step.sql, {"start": start, "end": end})
+        cursor.execute("UPDATE schema_migrations SET progress = %s WHERE version = %s;",
+                       (end, version))
+        conn.commit()
+        chunks += 1
+        start = end
+    cursor.execute("UPDATE schema_migrations SET applied_at = NOW() WHERE version = %s;", (version,))
+    conn.commit()
+    cursor.close()
+    print(f"  {chunks} chunks of {step.table}")
+    return True
+
+
+def acquire_lock(conn, timeout=LOCK_TIMEOUT):
+    """Take the migration lock for this session, polling until timeout."""
+    start = time.monotonic()
+    cursor = conn.cursor()
+    for attempt in itertools.count():
+        cursor.execute("SELECT pg_try_advisory_lock(%s);", (MIGRATION_LOCK,))
+        locked = cursor.fetchone()[0]
+        conn.commit()
+        if locked:
+            break
+        waited = time.monotonic() - start
+        if waited > timeout:
+            cursor.close()
+            raise SystemExit(f"Migration lock still held after {waited:.0f}s; another run is "
+                             "applying migrations, or a lock leaked on a pooled connection "
+                             "(connect through the session pooler, port 5432).")
+        if attempt % (60 // LOCK_POLL_SECONDS) == 0:
+            print(f"Another run holds the migration lock, waiting ({waited:.0f}s so far)", flush=True)
+        time.sleep(LOCK_POLL_SECONDS)
+    cursor.close()
 
-    for i, sql in enumerate(MIGRATIONS, 1):
-        print(f"Running migration {i}/{len(MIGRATIONS)}...")
-        cursor.execute(sql)
 
+def migrate(conn, deadline=None):
+    """Apply pending migrations in order. Returns (number applied, all done).
+
+    With a deadline (time.monotonic()), no new step or batch starts after
+    it; the rest is left pending for the next run.
+    """
+    cursor = conn.cursor()
+    cursor.execute(SCHEMA_MIGRATIONS_SQL)
     conn.commit()
+    state = migration_state(cursor)
+    conn.rollback()  # concurrent steps need the connection outside a transaction
     cursor.close()
-    conn.close()
-    print("All migrations complete.")
+
+    changed = changed_migrations(state)
+    if changed:
+        raise SystemExit(f"Applied migrations changed since they ran: {changed}. "
+                         "Add a new migration instead of editing an applied one.")
+
+    applied = 0
+    for version, step in enumerate(map(as_step, MIGRATIONS), 1):
+        _, progress, applied_at = state.get(version, (None, None, None))
+        if applied_at is not None:
+            continue
+        if out_of_time(deadline):
+            print(f"Out of time, leaving migrations {version}-{len(MIGRATIONS)} for the next run")
+            return applied, False
+        print(f"Running migration {version}/{len(MIGRATIONS)} ({step.kind})...")
+        if step.kind == "concurrent":
+            apply_concurrently(conn, version, step)
+        elif step.kind == "batched":
+            if not apply_batched(conn, version, step, progress, deadline):
+                print(f"Out of time, leaving migrations {version}-{len(MIGRATIONS)} for the next run")
+                return applied, False
+        else:
+            apply_sql(conn, version, step)
+        applied += 1
+    return applied, True
+
+
+def print_status(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL;")
+    state = migration_state(cursor) if cursor.fetchone()[0] else {}
+    cursor.close()
+    changed = set(changed_migrations(state))
+    print(f"{'version':>7}  {'kind':<10}  status")
+    for version, step in enumerate(map(as_step, MIGRATIONS), 1):
+        _, progress, applied_at = state.get(version, (None, None, None))
+        if version in changed:
+            status = "CHANGED since applied"
+        elif applied_at is not None:
+            status = f"applied {applied_at:%Y-%m-%d %H:%M}"
+        elif progress is not None:
+            status = f"in progress (through {progress:%Y-%m-%d})"
+        else:
+            status = "pending"
+        print(f"{version:>7}  {step.kind:<10}  {status}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--status", action="store_true",
+                        help="list migrations and whether they are applied")
+    parser.add_argument("--max-seconds", type=float, default=None,
+                        help="start no step or batch after this many seconds (including "
+                             "the wait for the lock); the next run resumes")
+    args = parser.parse_args()
+
+    conn = connect_with_retry(DB_URL)
+    print("Connected to database")
+    if args.status:
+        print_status(conn)
+        conn.close()
+        sys.exit(0)
+
+    deadline = time.monotonic() + args.max_seconds if args.max_seconds is not None else None
+    try:
+        acquire_lock(conn, LOCK_TIMEOUT if args.max_seconds is None else min(LOCK_TIMEOUT, args.max_seconds))
+        applied, done = migrate(conn, deadline)
+    finally:
+        # Ends the session, which releases the advisory lock (given a
+        # session pooler or a direct connection)
+        conn.close()
+    print(f"All migrations complete ({applied} applied)." if done
+          else f"Migrations paused ({applied} applied, the rest pending).")
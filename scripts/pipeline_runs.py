@@ -0,0 +1,145 @@
+"""Single flight for overlapping pipeline runs (pipeline_run / pipeline_stage_run).
+
+The scheduled pipeline and the manual refresh workflows (dispatched by the
+trigger-refresh edge function) can start while another run is still
+going, and two runs at once can saturate the pgBouncer pool. So a run
+first takes a session advisory lock for each stage it selected, on a
+connection of its own: all of them or none, so two runs can't each hold
+half of what the other needs. Runs with no stages in common still run side
+by side. What a run does when a lock is held depends on on_busy:
+
+  wait      poll until the other run is done, then run every stage
+  coalesce  poll the same way, then skip the stages that another run
+            started after this run was triggered: their results are at
+            least as fresh as this run's would be, as long as no upstream
+            stage of this run wrote newer data (run_pipeline only asks
+            when every upstream stage was unchanged or coalesced too)
+  exit      give up at once
+
+Stages that write files (html, export, wind) are never coalesced, since
+their files live in the other run's checkout; their fingerprints usually
+make them cheap anyway. A coalesced stage counts as a success for its
+dependents.
+
+Every run is recorded in pipeline_run, and each of its stages in
+pipeline_stage_run with its status and, for a coalesced stage, the run
+whose results it reused. Locks are released when the lock connection
+closes, including when the process dies. (Session locks need a session
+pooler; the workflows connect through Supabase's on port 5432.)
+"""
+
+import time
+import itertools
+from collections import namedtuple
+import psycopg2
+
+# Arbitrary first key of the two-key advisory locks; the second is the
+# stage name hashed by Postgres. (migrate_db's single-key lock is a separate
+# key space.)
+PIPELINE_LOCK = 4_202_208
+
+POLL_SECONDS = 5
+WAIT_TIMEOUT = 30 * 60
+
+ON_BUSY = ("wait", "coalesce", "exit")
+
+# conn: the lock connection (autocommit); run_id is None when the tables
+# don't exist yet, and then nothing is recorded or coalesced
+Run = namedtuple("Run", "conn run_id triggered_at coalesce")
+
+
+def _try_lock_all(cursor, stages):
+    """Lock every stage, or none. Returns None, or the first stage that was busy."""
+    taken = []
+    for stage in stages:
+        cursor.execute("SELECT pg_try_advisory_lock(%s, hashtext(%s));", (PIPELINE_LOCK, stage))
+        if not cursor.fetchone()[0]:
+            for held in taken:
+                cursor.execute("SELECT pg_advisory_unlock(%s, hashtext(%s));", (PIPELINE_LOCK, held))
+            return stage
+        taken.append(stage)
+    return None
+
+
+def acquire(conn, stages, on_busy, timeout=WAIT_TIMEOUT):
+    """Take the stages' locks on conn (autocommit).
+
+    Returns the seconds spent waiting, or None if on_busy is "exit" and a
+    lock was held. Raises TimeoutError after waiting timeout seconds.
+    """
+    start = time.monotonic()
+    cursor = conn.cursor()
+    try:
+        for attempt in itertools.count():
+            busy = _try_lock_all(cursor, stages)
+            waited = time.monotonic() - start
+            if busy is None:
+                return waited
+            if on_busy == "exit":
+                return None
+            if waited > timeout:
+                raise TimeoutError(f"{busy} still locked by another run after {waited:.0f}s")
+            if attempt % (60 // POLL_SECONDS) == 0:
+                print(f"Another run holds the {busy} stage, waiting ({waited:.0f}s so far)", flush=True)
+            time.sleep(POLL_SECONDS)
+    finally:
+        cursor.close()
+
+
+def start_run(conn, triggered_at, stages, on_busy, waited):
+    """Record the run. Returns a Run (run_id None if the tables are missing)."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            INSERT INTO pipeline_run (triggered_at, stages, on_busy, waited_s)
+            VALUES (%s, %s, %s, %s) RETURNING run_id;
+        """, (triggered_at, list(stages), on_busy, waited))
+        run_id = cursor.fetchone()[0]
+    except psycopg2.errors.UndefinedTable:
+        print("No pipeline_run table (run migrate_db.py), not recording or coalescing")
+        run_id = None
+    finally:
+        cursor.close()
+    return Run(conn, run_id, triggered_at, on_busy == "coalesce")
+
+
+def coalesce_source(run, stage):
+    """The latest run that ran stage successfully after run was triggered, or None."""
+    cursor = run.conn.cursor()
+    cursor.execute("""
+        SELECT run_id FROM pipeline_stage_run
+        WHERE stage = %s AND status IN ('ok', 'unchanged') AND started_at >= %s
+        ORDER BY started_at DESC
+        LIMIT 1;
+    """, (stage, run.triggered_at))
+    row = cursor.fetchone()
+    cursor.close()
+    return row[0] if row else None
+
+
+def record_stage(run, stage, status, error=None, source_run_id=None):
+    """Insert or update the stage's row; "running" starts its clock."""
+    cursor = run.conn.cursor()
+    cursor.execute("""
+        INSERT INTO pipeline_stage_run (run_id, stage, status, finished_at, source_run_id, error)
+        VALUES (%(run_id)s, %(stage)s, %(status)s,
+                CASE WHEN %(status)s = 'running' THEN NULL ELSE NOW() END,
+                %(source)s, %(error)s)
+        ON CONFLICT (run_id, stage) DO UPDATE
+        SET status = EXCLUDED.status,
+            finished_at = EXCLUDED.finished_at,
+            source_run_id = EXCLUDED.source_run_id,
+            error = EXCLUDED.error;
+    """, {"run_id": run.run_id, "stage": stage, "status": status,
+          "source": source_run_id, "error": error})
+    cursor.close()
+
+
+def finish_run(run, results):
+    """Record stages that never started (skipped) and the run's end."""
+    cursor = run.conn.cursor()
+    for stage, (status, _, error) in results.items():
+        if status == "skipped":
+            record_stage(run, stage, status, error)
+    cursor.execute("UPDATE pipeline_run SET finished_at = NOW() WHERE run_id = %s;", (run.run_id,))
+    cursor.close()
@@ -0,0 +1,277 @@
+"""Per-query timing for every database connection, written as a report per run.
+
+    QUERY_LOG=.cache/query-log python scripts/run_pipeline.py
+    QUERY_LOG=.cache/query-log QUERY_LOG_EXPLAIN_MS=200 python scripts/generate_forecast.py
+    QUERY_LOG=.cache/query-log QUERY_LOG_EXPLAIN_MS=200 QUERY_LOG_ANALYZE=1 python scripts/generate_html.py
+
+With QUERY_LOG set to a directory, connect_with_retry gives each connection
+a LoggedCursor, so psycopg2 scripts and SQLAlchemy/pandas readers are both
+covered. Every execute (and COPY) is recorded with a label, its duration,
+the rows it returned or changed and the bytes fetched (the text length of
+the values, about what crossed the wire). The label is the name of the SQL
+constant the statement came from (e.g. generate_forecast.QUERY_YEAR_BIAS,
+any QUERY_* or *_SQL constant of a loaded script) or else the start of the
+statement. run_pipeline tags each query with the stage that ran it.
+
+With QUERY_LOG_EXPLAIN_MS also set, a query slower than that many ms has
+its plan captured once per label with plain EXPLAIN, which doesn't run it.
+QUERY_LOG_ANALYZE=1 makes that EXPLAIN (ANALYZE, BUFFERS) for a single
+read-only SELECT: actual row counts and timings, but the slow query runs a
+second time in the caller's transaction. A plan that can't be captured is
+noted in the report; it never fails the query's transaction.
+
+When the process exits the report (per-label totals, every query in
+order, then the plans) is written to QUERY_LOG/queries-<time>-<pid>.txt.
+"""
+
+import os
+import re
+import sys
+import time
+import atexit
+import threading
+from datetime import datetime
+import psycopg2.extensions
+from dotenv import load_dotenv
+
+load_dotenv()
+LOG_DIR = os.getenv("QUERY_LOG")
+EXPLAIN_MS = float(os.getenv("QUERY_LOG_EXPLAIN_MS") or "inf")
+ANALYZE = os.getenv("QUERY_LOG_ANALYZE") == "1"
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+LABEL_CHARS = 60
+WRITES = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE)\b")
+EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "MERGE")
+
+_entries = []
+_plans = {}  # label -> (sql, plan lines or error)
+_labels = {}  # normalized sql -> {script: label}
+_scanned = 0  # len(sys.modules) when the script constants were last scanned
+_lock = threading.Lock()
+_context = threading.local()
+_start = time.perf_counter()
+
+
+def enabled():
+    return bool(LOG_DIR)
+
+
+def set_stage(name):
+    """Tag the queries this thread runs from now on with name (None to clear)."""
+    _context.stage = name
+
+
+def _normalize(sql):
+    if isinstance(sql, bytes):
+        sql = sql.decode()
+    # SQLAlchemy text() doubles literal % for the pyformat paramstyle
+    return " ".join(str(sql).replace("%%", "%").split())
+
+
+def _script_constants():
+    """{normalized sql: {script: "script.NAME"}} for the SQL constants of loaded scripts."""
+    found = {}
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None)
+        if not path or os.path.dirname(os.path.abspath(path)) != SCRIPTS_DIR:
+            continue
+        script = os.path.splitext(os.path.basename(path))[0]
+        for name, value in list(vars(module).items()):
+            if (isinstance(value, str) and name.isupper()
+                    and (name.startswith("QUERY_") or name.endswith("_SQL"))):
+                found.setdefault(_normalize(value), {}).setdefault(script, f"{script}.{name}")
+    return found
+
+
+def _calling_scripts():
+    """Scripts on the current stack, innermost first (not this module or db_utils)."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        path = frame.f_code.co_filename
+        if os.path.dirname(os.path.abspath(path)) == SCRIPTS_DIR:
+            script = os.path.splitext(os.path.basename(path))[0]
+            if script not in ("query_log", "db_utils"):
+                yield script
+        frame = frame.f_back
+
+
+def label_for(sql):
+    """The constant sql came from, else its first LABEL_CHARS characters.
+
+    When scripts share a query text, the constant of the script that is
+    running it wins.
+    """
+    global _scanned
+    key = _normalize(sql)
+    names = _labels.get(key)
+    if names is None:
+        with _lock:
+            # Rescan only when scripts were imported since the last scan
+            if len(sys.modules) != _scanned:
+                _scanned = len(sys.modules)
+                _labels.update(_script_constants())
+            names = _labels.setdefault(key, {})
+    if not names:
+        return key[:LABEL_CHARS]
+    if len(names) > 1:
+        for script in _calling_scripts():
+            if script in names:
+                return names[script]
+    return next(iter(names.values()))
+
+
+def _value_bytes(row):
+    return sum(len(v) if isinstance(v, (str, bytes)) else len(str(v))
+               for v in row if v is not None)
+
+
+def _is_explainable(sql):
+    return _normalize(sql).split(" ", 1)[0].upper() in EXPLAINABLE
+
+
+def _is_single_statement(sql):
+    return ";" not in _normalize(sql).rstrip("; ")
+
+
+def _is_read_only(sql):
+    sql = _normalize(sql).upper()
+    return (sql.startswith("SELECT ") or sql.startswith("WITH ")) and not WRITES.search(sql)
+
+
+class LoggedCursor(psycopg2.extensions.cursor):
+    """A psycopg2 cursor that records each statement it runs (see module doc)."""
+
+    _entry = None
+
+    def _record(self, sql, seconds, rows):
+        entry = {"at": time.perf_counter() - _start - seconds, "stage": getattr(_context, "stage", None),
+                 "label": label_for(sql), "ms": seconds * 1000, "rows": max(rows, 0), "bytes": 0}
+        with _lock:
+            _entries.append(entry)
+        self._entry = entry
+        return entry
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            super().execute(query, vars)
+        finally:
+            entry = self._record(query, time.perf_counter() - start, self.rowcount)
+        if (entry["ms"] > EXPLAIN_MS and _is_explainable(query)
+                and self._claim_plan(entry["label"], query)):
+            self._explain(entry["label"], query, vars)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self._record(sql, time.perf_counter() - start, self.rowcount)
+
+    @staticmethod
+    def _claim_plan(label, query):
+        """Whether this thread should capture label's plan (the first to ask does)."""
+        with _lock:
+            if label in _plans:
+                return False
+            _plans[label] = (query, ["(being captured)"])
+            return True
+
+    def _explain(self, label, query, vars):
+        if not _is_single_statement(query):
+            with _lock:
+                _plans[label] = (query, ["(not captured: more than one statement)"])
+            return
+        explain = "EXPLAIN (ANALYZE, BUFFERS) " if ANALYZE and _is_read_only(query) else "EXPLAIN "
+        # A plain cursor, so this cursor's result is left for the caller. The
+        # statement ran, so a non-autocommit connection is in a transaction.
+        cursor = self.connection.cursor(cursor_factory=psycopg2.extensions.cursor)
+        savepoint = not self.connection.autocommit
+        try:
+            if savepoint:
+                cursor.execute("SAVEPOINT query_log_explain;")
+            cursor.execute(explain + (query.decode() if isinstance(query, bytes) else query), vars)
+            plan = [row[0] for row in cursor.fetchall()]
+            if savepoint:
+                cursor.execute("RELEASE SAVEPOINT query_log_explain;")
+        except psycopg2.Error as e:
+            if savepoint:
+                cursor.execute("ROLLBACK TO SAVEPOINT query_log_explain;")
+            plan = [f"(not captured: {str(e).strip()})"]
+        finally:
+            cursor.close()
+        with _lock:
+            _plans[label] = (query, plan)
+
+    def _fetched(self, rows):
+        if self._entry is not None:
+            self._entry["bytes"] += sum(map(_value_bytes, rows))
+        return rows
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self._fetched([row])
+        return row
+
+    def fetchmany(self, size=None):
+        return self._fetched(super().fetchmany(self.arraysize if size is None else size))
+
+    def fetchall(self):
+        return self._fetched(super().fetchall())
+
+    def __iter__(self):
+        row = self.fetchone()
+        while row is not None:
+            yield row
+            row = self.fetchone()
+
+
+def report():
+    """The report text for the queries recorded so far."""
+    with _lock:
+        entries = list(_entries)
+    totals = {}
+    for e in entries:
+        t = totals.setdefault(e["label"], {"count": 0, "ms": 0.0, "max": 0.0, "rows": 0, "bytes": 0})
+        t["count"] += 1
+        t["ms"] += e["ms"]
+        t["max"] = max(t["max"], e["ms"])
+        t["rows"] += e["rows"]
+        t["bytes"] += e["bytes"]
+    total_ms = sum(t["ms"] for t in totals.values())
+
+    lines = [f"{' '.join(sys.argv)}",
+             f"{len(entries)} queries, {total_ms / 1000:.2f}s in the database", "",
+             f"{'label':<60}{'count':>7}{'total ms':>11}{'share':>7}{'max ms':>10}{'rows':>10}{'bytes':>12}"]
+    for label, t in sorted(totals.items(), key=lambda item: -item[1]["ms"]):
+        lines.append(f"{label:<60}{t['count']:>7}{t['ms']:>11.1f}{t['ms'] / (total_ms or 1):>7.0%}"
+                     f"{t['max']:>10.1f}{t['rows']:>10}{t['bytes']:>12}")
+
+    lines += ["", f"{'at s':>8}  {'stage':<10}{'ms':>9}{'rows':>8}{'bytes':>10}  label"]
+    for e in entries:
+        lines.append(f"{e['at']:>8.2f}  {e['stage'] or '-':<10}{e['ms']:>9.1f}{e['rows']:>8}"
+                     f"{e['bytes']:>10}  {e['label']}")
+
+    with _lock:
+        plans = list(_plans.items())
+    for label, (sql, plan) in plans:
+        lines += ["", f"-- {label}", re.sub(r"\n\s*\n", "\n", str(sql)).strip(), ""] + plan
+    return "\n".join(lines) + "\n"
+
+
+def write_report():
+    """Write the report to LOG_DIR. Returns its path, or None if nothing ran."""
+    if not _entries:
+        return None
+    os.makedirs(LOG_DIR, exist_ok=True)
+    path = os.path.join(LOG_DIR, f"queries-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}.txt")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(report())
+    print(f"Query log: {len(_entries)} queries -> {path}")
+    return path
+
+
+if enabled():
+    atexit.register(write_report)
@@ -0,0 +1,306 @@
+"""Run the data pipeline stages in one process.
+
+    python scripts/run_pipeline.py                        # every stage
+    python scripts/run_pipeline.py buoy forecast comfort html export
+    python scripts/run_pipeline.py --skip wind
+    python scripts/run_pipeline.py --force comfort html   # ignore fingerprints
+    python scripts/run_pipeline.py --on-busy coalesce     # share work with a running run
+
+Stages are the scripts' main() functions, run as a small DAG: buoy, forecast
+and wind have no inputs from each other and run concurrently; comfort waits
+for buoy and forecast; html and export wait for comfort. Deps that are not
+selected count as satisfied. If a stage fails, its dependents are skipped
+and the run exits non-zero.
+
+comfort, html and export declare their inputs (code files, digests of the
+rows they read, output files; see stage_fingerprint.py). One of them whose
+inputs fingerprint matches its last successful run is reported "unchanged"
+and not run; that counts as success for its dependents. buoy, forecast and
+wind read upstream sources and always run.
+
+Before any stage runs, the run takes an advisory lock per selected stage,
+so overlapping runs (the schedule and a manual refresh) don't hit the
+pool together. --on-busy says what to do if another run holds one: wait
+for it, coalesce (wait, then reuse the stages it ran after this run was
+triggered, unless an upstream stage of this run wrote new results first;
+reported "coalesced"), or exit at once. See pipeline_runs.py.
+
+One SQLAlchemy engine is shared by all stages. Its pool connects with
+db_utils.connect_with_retry on first use, so no stage waits for the
+database before it needs it. pandas stages borrow SQLAlchemy connections.
+psycopg2 stages borrow the pool's raw DBAPI connections; buoy and forecast
+borrow theirs in the background while they fetch. Each stage's module is
+imported inside the stage, so its import cost shows up in that stage's
+wall time.
+"""
+
+import os
+import sys
+import time
+import argparse
+from datetime import datetime, timezone
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import psycopg2
+from dotenv import load_dotenv
+from db_utils import connect_with_retry, sqlalchemy_engine, in_background, close_when_ready
+from stage_fingerprint import collect_inputs, fingerprint_of, is_unchanged, save_fingerprint
+import pipeline_runs
+from query_log import set_stage
+
+load_dotenv()
+DB_URL = os.getenv("SUPABASE_DB_URL")
+
+MAX_WORKERS = 3
+
+# Statuses that let dependents run
+SUCCEEDED = ("ok", "unchanged", "coalesced")
+# Statuses of a stage that left its results as they were
+REUSED = ("unchanged", "coalesced")
+
+
+@contextmanager
+def pooled(engine):
+    """Borrow a psycopg2 connection from the engine's pool."""
+    conn = engine.raw_connection()
+    try:
+        yield conn
+    finally:
+        conn.close()  # back to the pool (rolled back if left open)
+
+
+@contextmanager
+def pooled_later(engine):
+    """Like pooled(), but yields a Future so the stage can fetch meanwhile."""
+    conn = in_background(engine.raw_connection)
+    try:
+        yield conn
+    finally:
+        close_when_ready(conn)
+
+
+def stage_buoy(engine):
+    import download_data
+    with pooled_later(engine) as conn:
+        download_data.main(conn=conn)
+
+
+def stage_forecast(engine):
+    import fetch_forecast
+    with pooled_later(engine) as conn:
+        fetch_forecast.main(conn=conn)
+
+
+def stage_wind(engine):
+    import generate_wind
+    generate_wind.main()
+
+
+def stage_comfort(engine):
+    import compute_comfort
+    with pooled(engine) as conn:
+        compute_comfort.main(conn=conn)
+
+
+def stage_html(engine):
+    import generate_html
+    generate_html.main(engine=engine)
+
+
+def stage_export(engine):
+    import export_comfort_json
+    export_comfort_json.main(engine=engine)
+
+
+# deps: stages that must succeed first; run: the stage function.
+# inputs is None for stages that always run, else (with code and outputs)
+# what the stage's fingerprint is built from. Stages with outputs are
+# never coalesced.
+Stage = namedtuple("Stage", "deps run code inputs outputs")
+
+# In a valid run order
+STAGES = {
+    "buoy": Stage((), stage_buoy, (), None, ()),
+    "forecast": Stage((), stage_forecast, (), None, ()),
+    "wind": Stage((), stage_wind, (), None, ("docs/wind-data.json",)),
+    "comfort": Stage(("buoy", "forecast"), stage_comfort,
+                     ("scripts/compute_comfort.py",),
+                     ("local_date", "buoy_surface_latest", "forecast_window"), ()),
+    "html": Stage(("comfort",), stage_html,
+                  ("scripts/generate_html.py", "templates/template.html"),
+                  ("local_date", "comfort_window", "lake_surface_recent",
+                   "lake_surface_past", "climatology_today"),
+                  ("docs/index.html",)),
+    "export": Stage(("comfort",), stage_export,
+                    ("scripts/export_comfort_json.py",),
+                    ("local_date", "comfort_window", "lake_surface_recent",
+                     "climatology_today", "comfort_run_latest"),
+                    ("docs/comfort-data.json",)),
+}
+
+
+def check_inputs(engine, name, stage):
+    """Fingerprint the stage's inputs. Returns (values, fingerprint, unchanged).
+
+    fingerprint is None if pipeline_fingerprint doesn't exist yet.
+    """
+    with pooled(engine) as conn:
+        cursor = conn.cursor()
+        values = collect_inputs(cursor, stage.code, stage.inputs)
+        fingerprint = fingerprint_of(values)
+        try:
+            unchanged = is_unchanged(cursor, name, fingerprint, stage.outputs)
+        except psycopg2.errors.UndefinedTable:
+            print(f"[{name}] no pipeline_fingerprint table (run migrate_db.py), not skipping")
+            fingerprint, unchanged = None, False
+        conn.rollback()
+        cursor.close()
+    return values, fingerprint, unchanged
+
+
+def record_inputs(engine, name, stage, values, fingerprint):
+    with pooled(engine) as conn:
+        cursor = conn.cursor()
+        save_fingerprint(cursor, name, fingerprint, values, stage.outputs)
+        conn.commit()
+        cursor.close()
+
+
+def run_stage(name, stage, engine, force=False, run=None, upstream=()):
+    """Run one stage unless its inputs are unchanged or it can be coalesced.
+
+    run is the pipeline_runs.Run to record the stage in, if any; upstream
+    the statuses of the stage's deps in this run. A stage is only coalesced
+    if none of them wrote new results, since another run's result could
+    predate them.
+    Returns (status, seconds, error message).
+    """
+    recording = run is not None and run.run_id is not None
+    if recording:
+        coalesce = run.coalesce and not stage.outputs and all(s in REUSED for s in upstream)
+        source = pipeline_runs.coalesce_source(run, name) if coalesce else None
+        if source is not None:
+            pipeline_runs.record_stage(run, name, "coalesced", source_run_id=source)
+            print(f"[{name}] coalesced: run {source} ran it after this run was triggered", flush=True)
+            return "coalesced", 0.0, None
+        pipeline_runs.record_stage(run, name, "running")
+    status, seconds, error = _run_stage(name, stage, engine, force)
+    if recording:
+        pipeline_runs.record_stage(run, name, status, error)
+    return status, seconds, error
+
+
+def _run_stage(name, stage, engine, force):
+    print(f"[{name}] started", flush=True)
+    set_stage(name)  # for the query log, if QUERY_LOG is set
+    start = time.perf_counter()
+    try:
+        fingerprint = None
+        if stage.inputs is not None:
+            values, fingerprint, unchanged = check_inputs(engine, name, stage)
+            if unchanged and not force:
+                seconds = time.perf_counter() - start
+                print(f"[{name}] inputs unchanged, not run ({seconds:.1f}s)", flush=True)
+                return "unchanged", seconds, None
+        stage.run(engine)
+        if fingerprint is not None:
+            record_inputs(engine, name, stage, values, fingerprint)
+    except Exception as e:
+        seconds = time.perf_counter() - start
+        print(f"[{name}] FAILED after {seconds:.1f}s: {type(e).__name__}: {e}", flush=True)
+        return "failed", seconds, f"{type(e).__name__}: {e}"
+    seconds = time.perf_counter() - start
+    print(f"[{name}] done in {seconds:.1f}s", flush=True)
+    return "ok", seconds, None
+
+
+def run_pipeline(engine, selected, workers=MAX_WORKERS, force=False, run=None):
+    """Run the selected stages as soon as their dependencies finish.
+
+    Returns {name: (status, seconds, error)}, status one of
+    ok/unchanged/coalesced/failed/skipped. force runs stages even if
+    unchanged; run (a pipeline_runs.Run) records them and, if it
+    coalesces, lets stages reuse another run's results.
+    """
+    pending = {name: tuple(d for d in STAGES[name].deps if d in selected) for name in selected}
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {}
+        while pending or running:
+            for name in [n for n, deps in pending.items() if all(d in results for d in deps)]:
+                deps = pending.pop(name)
+                blocked = [d for d in deps if results[d][0] not in SUCCEEDED]
+                if blocked:
+                    results[name] = ("skipped", 0.0, f"{', '.join(blocked)} did not succeed")
+                    print(f"[{name}] skipped: {results[name][2]}", flush=True)
+                else:
+                    upstream = [results[d][0] for d in deps]
+                    running[pool.submit(run_stage, name, STAGES[name], engine, force, run, upstream)] = name
+            if not running:
+                continue  # a skip may have released more stages
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results
+
+
+def print_report(results, wall):
+    print(f"\n{'stage':<10}{'status':<11}{'seconds':>9}")
+    for name in STAGES:
+        if name in results:
+            status, seconds, error = results[name]
+            print(f"{name:<10}{status:<11}{seconds:>9.1f}" + (f"  {error}" if error else ""))
+    busy = sum(seconds for _, seconds, _ in results.values())
+    print(f"{'total':<21}{wall:>9.1f}  (stages {busy:.1f}s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("stages", nargs="*", metavar="stage",
+                        help=f"stages to run (default: all of {', '.join(STAGES)})")
+    parser.add_argument("--skip", action="append", default=[], choices=list(STAGES),
+                        help="leave out a stage (repeatable)")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS,
+                        help="stages run at once (default: %(default)s)")
+    parser.add_argument("--force", action="store_true",
+                        help="run stages even if their inputs are unchanged")
+    parser.add_argument("--on-busy", choices=pipeline_runs.ON_BUSY, default="wait",
+                        help="if another run holds a selected stage (default: %(default)s)")
+    parser.add_argument("--wait-timeout", type=float, default=pipeline_runs.WAIT_TIMEOUT,
+                        help="seconds to wait for another run (default: %(default)s)")
+    parser.add_argument("--triggered-at", type=datetime.fromisoformat,
+                        help="when the run was requested, ISO 8601 with offset, for --on-busy "
+                             "coalesce (default: now)")
+    args = parser.parse_args()
+    unknown = [s for s in args.stages if s not in STAGES]
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(unknown)}")
+
+    selected = [s for s in (args.stages or STAGES) if s not in args.skip]
+    triggered_at = args.triggered_at or datetime.now(timezone.utc)
+    start = time.perf_counter()
+
+    # The locks live as long as this connection; the stages use the engine's pool
+    lock_conn = connect_with_retry(DB_URL)
+    lock_conn.autocommit = True
+    try:
+        waited = pipeline_runs.acquire(lock_conn, selected, args.on_busy, args.wait_timeout)
+    except TimeoutError as e:
+        sys.exit(f"Gave up waiting: {e}")
+    if waited is None:
+        print("Another run holds some of these stages, exiting (--on-busy exit)")
+        sys.exit(0)
+    run = pipeline_runs.start_run(lock_conn, triggered_at, selected, args.on_busy, waited)
+
+    engine = sqlalchemy_engine(DB_URL)
+    results = run_pipeline(engine, selected, args.workers, args.force, run)
+    engine.dispose()
+    if run.run_id is not None:
+        pipeline_runs.finish_run(run, results)
+    lock_conn.close()
+    print_report(results, time.perf_counter() - start)
+
+    if any(status not in SUCCEEDED for status, _, _ in results.values()):
+        sys.exit(1)
@@ -0,0 +1,158 @@
+"""Input fingerprints for pipeline stages (pipeline_fingerprint table).
+
+A stage that only derives data from the database (comfort, html, export)
+declares what it depends on:
+
+  code     source files whose contents change its output (script, template)
+  inputs   names from INPUT_QUERIES; each query returns a digest of exactly
+           the rows the stage reads, computed in Postgres
+  outputs  files the stage writes
+
+Its fingerprint is a sha256 over the code and input digests. After a
+successful run the fingerprint and the sha256 of each output file are
+stored in pipeline_fingerprint. The runner skips the stage next time if the
+fingerprint is the same and the output files on disk still match.
+
+Upstream stages are not part of the fingerprint. Their effect shows up in
+the rows a stage reads: if buoy and forecast bring nothing new, comfort's
+inputs are unchanged and it is skipped; comfort_score then stays the same,
+so html and export are skipped too. If comfort reruns but produces the same
+scores, html is still skipped; export reruns, since it reports the latest
+comfort run. Tables refreshed outside the pipeline (climatology_doy, by
+the seasonal forecast) are inputs too.
+
+The local date is an input wherever a query window is anchored to today.
+The "current" comfort row (closest hour to now) is not an input: the page
+and the app pick the hour from the forecast rows themselves.
+"""
+
+import hashlib
+import json
+
+# name -> query returning one text digest. Windows match the stage queries.
+INPUT_QUERIES = {
+    "local_date": "SELECT CURRENT_DATE::text;",
+
+    # compute_comfort.get_latest_buoy_data
+    "buoy_surface_latest": """
+        SELECT MAX(date)::text || ':' || md5(string_agg(
+                   ROW(depth_m, temperature_c, turbidity_ntu, phycocyanin_ugl)::text,
+                   ',' ORDER BY depth_m))
+        FROM lake_data
+        WHERE depth_m < 1.5 AND temperature_c IS NOT NULL
+          AND date = (SELECT MAX(date) FROM lake_data
+                      WHERE depth_m < 1.5 AND temperature_c IS NOT NULL);
+    """,
+
+    # compute_comfort.get_forecast_hours, without fetched_at: a refetch that
+    # returns the same forecast does not change the digest
+    "forecast_window": """
+        SELECT md5(COALESCE(string_agg(ROW(f.*)::text, ',' ORDER BY f.forecast_time), ''))
+        FROM (
+            SELECT
+                forecast_time, feels_like_f, wind_speed_mph, solar_radiation_w,
+                precip_probability, us_aqi, uv_index, temperature_f, wind_direction_deg
+            FROM weather_forecast_latest
+            WHERE forecast_time >= DATE_TRUNC('day', NOW()) - INTERVAL '1 day'
+              AND forecast_time < DATE_TRUNC('day', NOW()) + INTERVAL '9 days'
+        ) f;
+    """,
+
+    # The comfort forecast both outputs publish, without computed_at
+    "comfort_window": """
+        SELECT md5(COALESCE(string_agg(ROW(
+                   score_time, overall_score, label,
+                   water_temp_score, air_temp_score, wind_score, sun_score,
+                   rain_score, clarity_score, algae_score, aqi_score,
+                   override_reason, input_snapshot)::text, ',' ORDER BY score_time), ''))
+        FROM comfort_score
+        WHERE score_time >= DATE_TRUNC('day', NOW()) - INTERVAL '1 day'
+          AND score_time < DATE_TRUNC('day', NOW()) + INTERVAL '9 days';
+    """,
+
+    # Surface temperatures around today (generate_html's current-year chart)
+    # plus the latest buoy timestamp both outputs report
+    "lake_surface_recent": """
+        SELECT COALESCE(MAX(date)::text, '') || ':' || md5(COALESCE(string_agg(
+                   ROW(date, depth_m, temperature_c)::text, ',' ORDER BY date, depth_m), ''))
+        FROM lake_data
+        WHERE date >= CURRENT_DATE - INTERVAL '22 days'
+          AND depth_m < 1.5 AND temperature_c IS NOT NULL;
+    """,
+
+    # generate_html.QUERY_PAST: the same days in the previous five years
+    "lake_surface_past": """
+        SELECT md5(COALESCE(string_agg(ROW(p.*)::text, ',' ORDER BY p.date), ''))
+        FROM (
+            SELECT date, MAX(temperature_c) AS max_temperature_c
+            FROM lake_data
+            WHERE date >= DATE_TRUNC('year', LOCALTIMESTAMP) - INTERVAL '5 years'
+              AND date < DATE_TRUNC('year', LOCALTIMESTAMP)
+              AND day_of_year BETWEEN EXTRACT(DOY FROM CURRENT_DATE - 7)::int - 1
+                                  AND EXTRACT(DOY FROM CURRENT_DATE + 7)::int + 1
+              AND TO_CHAR(date, 'MM-DD') BETWEEN TO_CHAR(CURRENT_DATE - 7, 'MM-DD')
+                                             AND TO_CHAR(CURRENT_DATE + 7, 'MM-DD')
+              AND depth_m < 1.5
+            GROUP BY date
+        ) p;
+    """,
+
+    # The QUERY_HIST_WEATHER norms of both outputs (today's climatology_doy row)
+    "climatology_today": """
+        SELECT COALESCE(md5(ROW(air_max_c, wind_ms, solar_w, precip_mm, aqi)::text), '')
+        FROM (SELECT 1) one
+        LEFT JOIN climatology_doy ON doy = EXTRACT(DOY FROM LOCALTIMESTAMP);
+    """,
+
+    # The run export_comfort_json reports (comfort_run_id, comfort_computed_at)
+    "comfort_run_latest": """
+        SELECT COALESCE(MAX(run_id)::text, '') FROM comfort_run;
+    """,
+}
+
+
+def file_digest(path):
+    """sha256 of a file's contents, or None if it doesn't exist."""
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def collect_inputs(cursor, code, inputs):
+    """Digest the stage's code files and run its input queries."""
+    values = {"code": {path: file_digest(path) for path in code}, "inputs": {}}
+    for name in inputs:
+        cursor.execute(INPUT_QUERIES[name])
+        values["inputs"][name] = cursor.fetchone()[0]
+    return values
+
+
+def fingerprint_of(values):
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+
+def is_unchanged(cursor, stage, fingerprint, outputs):
+    """True if the stage last ran with this fingerprint and its outputs are intact."""
+    cursor.execute(
+        "SELECT fingerprint, outputs FROM pipeline_fingerprint WHERE stage = %s;", (stage,))
+    row = cursor.fetchone()
+    if row is None or row[0] != fingerprint:
+        return False
+    stored = row[1] or {}
+    return all(file_digest(path) == stored.get(path) for path in outputs)
+
+
+def save_fingerprint(cursor, stage, fingerprint, values, outputs):
+    """Record a successful run; the caller commits."""
+    cursor.execute("""
+        INSERT INTO pipeline_fingerprint (stage, fingerprint, inputs, outputs, updated_at)
+        VALUES (%s, %s, %s, %s, NOW())
+        ON CONFLICT (stage) DO UPDATE
+        SET fingerprint = EXCLUDED.fingerprint,
+            inputs = EXCLUDED.inputs,
+            outputs = EXCLUDED.outputs,
+            updated_at = EXCLUDED.updated_at;
+    """, (stage, fingerprint, json.dumps(values),
+          json.dumps({path: file_digest(path) for path in outputs})))
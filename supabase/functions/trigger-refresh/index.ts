@@ -58,7 +58,8 @@ Deno.serve(async (req: Request) => {
         "X-GitHub-Api-Version": "2022-11-28",
         "Content-Type": "application/json",
       },
-      body: JSON.stringify({ ref: REF }),
+      // The pipeline reuses stages another run started after this moment
+      body: JSON.stringify({ ref: REF, inputs: { triggered_at: triggeredAt } }),
     }
   )
 